@@ -2,6 +2,7 @@ import os
 import sys
 import argparse
 import pandas as pd
+from gffio import read_gff, write_gff
 
 pd.options.mode.chained_assignment = None # default='warn'
 
@@ -15,33 +16,102 @@ def parse_args():
                         help='GFF3 output filename')
     parser.add_argument('-s', '--seqid',  default='.', nargs='?',
                         help='seq_id')
+    parser.add_argument('--orfs', default=None,
+                        help='Operon Mapper "ORFs_coordinates" file, takes seq_id of every gene from it '
+                             '(needed for multi-sequence genomes)')
+    parser.add_argument('--pairs', default=None,
+                        help='Operon Mapper "operonic_gene_pairs" file, rebuilds operons from adjacent gene pairs '
+                             '(pairs of "Operon" class are joined unless a cutoff is given)')
+    parser.add_argument('-p', '--min-probability', default=None, type=float,
+                        help='join adjacent genes with pair probability not lower than this (needs --pairs)')
+    parser.add_argument('-d', '--max-distance', default=None, type=int,
+                        help='join adjacent genes not farther than this, bp (needs --pairs)')
 
     return parser.parse_args()
 
 
-def convert_to_gff3(data: pd.DataFrame, seq_id: str) -> pd.DataFrame:
+def read_gene_seq_ids(orfs_path: str) -> pd.Series:
+    """
+    reads correspondence between gene id and seq_id from Operon Mapper "ORFs_coordinates" file
+    :param orfs_path: (str) path to ORFs_coordinates file
+    :return: (pandas.Series) of seq_ids indexed by gene id
+    """
+    orfs = read_gff(orfs_path, columns=['seq_id'], attributes=['ID'], categorical=False)
+    return orfs.set_index('ID')['seq_id']
+
+
+def read_gene_pairs(pairs_path: str) -> pd.DataFrame:
+    """
+    reads Operon Mapper "operonic_gene_pairs" file
+    :param pairs_path: (str) path to operonic_gene_pairs file
+    :return: (pandas.DataFrame) of adjacent gene pairs
+    """
+    pairs = pd.read_csv(pairs_path, sep='\t', dtype={'idGen1': str, 'idGen2': str, 'CLASS': str})
+    pairs['idGen1'] = pairs['idGen1'].str.strip()
+    pairs['idGen2'] = pairs['idGen2'].str.strip()
+    return pairs
+
+
+def resegment_operons(data: pd.DataFrame, pairs: pd.DataFrame,
+                      min_probability: float = None, max_distance: int = None) -> pd.DataFrame:
+    """
+    rebuilds operons from adjacent gene pairs: neighbouring genes stay in one operon
+    if their pair passes all given cutoffs (or is of "Operon" class if no cutoff is given)
+    :param data: (pandas.DataFrame) of genes with seq_id, start and IdGene columns
+    :param pairs: (pandas.DataFrame) of gene pairs (see read_gene_pairs)
+    :param min_probability: (float) minimal pair probability
+    :param max_distance: (int) maximal distance between genes
+    :return: (pandas.DataFrame) of genes sorted by position with renumbered "Operon" column
+    """
+    joined = pd.Series(True, index=pairs.index)
+    if min_probability is not None:
+        joined &= pd.to_numeric(pairs['Probability'], errors='coerce') >= min_probability
+    if max_distance is not None:
+        joined &= pd.to_numeric(pairs['Dist'], errors='coerce') <= max_distance
+    if min_probability is None and max_distance is None:
+        joined &= pairs['CLASS'].str.strip() == 'Operon'
+    joined_pairs = pd.MultiIndex.from_arrays([pairs.loc[joined, 'idGen1'], pairs.loc[joined, 'idGen2']])
+
+    data = data.sort_values(['seq_id', 'start'], kind='stable').reset_index(drop=True)
+    gene_ids = data['IdGene'].str.strip()
+    neighbours = pd.MultiIndex.from_arrays([gene_ids.shift(), gene_ids])
+    same_seq = data['seq_id'].eq(data['seq_id'].shift())
+    linked = same_seq & neighbours.isin(joined_pairs)
+
+    data['Operon'] = (~linked).cumsum()
+    return data
+
+
+def convert_to_gff3(data: pd.DataFrame, seq_id: str, gene_seq_ids: pd.Series = None,
+                    pairs: pd.DataFrame = None, min_probability: float = None,
+                    max_distance: int = None) -> pd.DataFrame:
     data.rename(columns={'PosLeft': 'start',
                                  'postRight': 'end',
                                  'Strand': 'strand',
                                  'Type': 'type',
                                  }, inplace=True)
 
-    data['Operon'] = data['Operon'].fillna(method='ffill')
+    data['Operon'] = data['Operon'].ffill()
     data[['Function', 'COGgene', 'strand', 'IdGene']] = data[['Function', 'COGgene', 'strand', 'IdGene']].fillna('.')
-    data = data.groupby("Operon").apply(lambda group: group.iloc[1:]).reset_index(drop=True)
+    data = data[data.groupby("Operon").cumcount() > 0].reset_index(drop=True)
 
-    data['attributes'] = ('operon=' + data['Operon'].astype(int).astype(str).str.strip() + ';' +
-                             'coggene=' + data['COGgene'].str.strip(' ').str.strip() + ';' +
-                             'function=' + data['Function'].str.strip(' ').str.replace(' ', '_').str.replace(';', '_').str.strip() + ';' +
-                             'gene_name=' + data['IdGene'].str.strip()  + ';' +
-                             'locus_tag=' + data['IdGene'].str.strip()
-                            )
     data['score'] = '.'
     data['source'] = 'OperonMapper'
     data['seq_id'] = seq_id
+    if gene_seq_ids is not None:
+        data['seq_id'] = data['IdGene'].str.strip().map(gene_seq_ids).fillna(seq_id)
     data['phase'] = 0
     data['start'] = data['start'].astype(int)
     data['end'] = data['end'].astype(int)
+    if pairs is not None:
+        data = resegment_operons(data, pairs, min_probability, max_distance)
+
+    data['attributes'] = ('operon=' + data['Operon'].astype(int).astype(str).str.strip() + ';' +
+                             'coggene=' + data['COGgene'].str.strip(' ').str.strip() + ';' +
+                             'function=' + data['Function'].str.strip(' ').str.replace(' ', '_').str.replace(';', '_').str.strip() + ';' +
+                             'gene_name=' + data['IdGene'].str.strip()  + ';' +
+                             'locus_tag=' + data['IdGene'].str.strip()
+                            )
     data = data[["seq_id", "source","type","start","end","score","strand","phase","attributes"]]
     return data
 
@@ -50,10 +120,17 @@ if __name__ == '__main__':
     input_file = parse_args().input[0]
     output_file = parse_args().output
     seq_id = parse_args().seqid
+    orfs_file = parse_args().orfs
+    pairs_file = parse_args().pairs
+    min_probability = parse_args().min_probability
+    max_distance = parse_args().max_distance
 
     if not os.path.isfile(input_file):
         print('Input file not found')
         sys.exit(1)
+    if pairs_file is None and (min_probability is not None or max_distance is not None):
+        print('Operon cutoffs need gene pairs file (--pairs)')
+        sys.exit(1)
 
     if output_file is None:
         output_file = os.path.splitext(input_file)[0] + '.gff3'
@@ -63,6 +140,9 @@ if __name__ == '__main__':
             output_file = output_file + '.gff3'
 
     operons_data = pd.read_csv(input_file, sep='\t')
-    operons_data = convert_to_gff3(operons_data, seq_id=seq_id)
-    operons_data.to_csv(output_file, sep='\t', index=False, header=False)
+    gene_seq_ids = read_gene_seq_ids(orfs_file) if orfs_file else None
+    pairs = read_gene_pairs(pairs_file) if pairs_file else None
+    operons_data = convert_to_gff3(operons_data, seq_id=seq_id, gene_seq_ids=gene_seq_ids, pairs=pairs,
+                                   min_probability=min_probability, max_distance=max_distance)
+    write_gff(operons_data, output_file)
     print('GFF3 written to', output_file, 'file')
@@ -1,5 +1,10 @@
 import argparse
-from Bio.SeqIO.FastaIO import SimpleFastaParser
+from gffio import attribute_pattern
+from fastaindex import FastaIndex
+
+
+HYPOTHETICAL = 'hypothetical protein'
+LOCUS_TAG = attribute_pattern('locus_tag')
 
 
 def parse_args():
@@ -13,46 +18,28 @@ def parse_args():
     parser.add_argument('out_file', default=None, nargs='?')
     return parser.parse_args()
 
-def find_hypo(gff_path: str) -> set:
+def find_hypo(gff_path: str) -> list:
     """
     finds all hypothetical proteins IDS, based on "hypothetical protein" keyword.
     :param gff_path: (str) path to bacta resulting gff file
-    :return: (set) of protein IDS, corresponding to hypothetical proteins
+    :return: (list) of protein IDS, corresponding to hypothetical proteins, in gff order
     """
-    prot_ids = set()
+    prot_ids = {}
     with open(gff_path, 'rt') as gff_file:
         for line in gff_file:
-            if 'hypothetical protein' in line:
-                attributes = line.strip().split('\t')[-1]
-                attributes_dict = {i.split('=')[0]:
-                                    i.split('=')[1] for i in attributes.split(';')}
-
-                prot_id = attributes_dict['locus_tag']
-                prot_ids.add(prot_id)
-    return prot_ids
-
-
-def read_fasta(fasta_path: str) -> dict:
-    """
-    reads fasta file into dict
-    :param fasta_path: (str) path to fasta file
-    :return: (dict) of correspondence between protID and sequence
-    """
-    records = {}
-    with open(fasta_path, 'rt') as fasta:
-        for record in SimpleFastaParser(fasta):
-            seq_id = record[0].split(' ')[0]
-            sequence = record[1]
-            records[seq_id] = sequence
-    return records
+            if HYPOTHETICAL in line:
+                match = LOCUS_TAG.search(line.rstrip('\n').rsplit('\t', 1)[-1])
+                if match:
+                    prot_ids[match.group(1)] = None
+    return list(prot_ids)
 
 
-def extract_hypo(prot_ids: set, sequences: dict) -> list:
+def extract_hypo(prot_ids: list, sequences: FastaIndex) -> list:
     """
     Extracts sequences for hypothetical proteins from Prodigal&Bacta pipe
-    :param prot_ids: (set) of protein IDS, corresponding to hypothetical proteins
-    :param sequences: (dict) of correspondence between prot_id and sequence
-    :return:
+    :param prot_ids: (list) of protein IDS, corresponding to hypothetical proteins
+    :param sequences: (FastaIndex) of the proteome, reads only the requested records
+    :return: (list) of tuples: (seqid, sequence)
     """
     targets = []
     for prot_id in prot_ids:
@@ -81,6 +68,6 @@ if __name__ == '__main__':
     out_file = parse_args().out_file
 
     hypo_ids = find_hypo(gff_path=in_gff)
-    fasta_all = read_fasta(fasta_path=in_faa)
-    fasta_hypos = extract_hypo(prot_ids=hypo_ids, sequences=fasta_all)
+    with FastaIndex(in_faa) as proteome:
+        fasta_hypos = extract_hypo(prot_ids=hypo_ids, sequences=proteome)
     write_fasta(sequences_entries=fasta_hypos, out_fa_path=out_file)
@@ -2,7 +2,7 @@ import os
 import sys
 import argparse
 import pandas as pd
-import genomenotebook as gn
+from gffio import read_gff
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
@@ -59,7 +59,7 @@ if __name__ == '__main__':
         if not output_file.endswith('.tsv'):
             output_file = output_file + '.tsv'
 
-    operons_gff = gn.parse_gff(input_file)
+    operons_gff = read_gff(input_file, attributes=['operon'])
     operons = extract_operons(operons_gff, color)
     operons.to_csv(output_file, sep='\t', index=False)
     print('Operons data written to', output_file, 'file')
@@ -0,0 +1,155 @@
+"""
+faidx-style random access to (protein) FASTA files.
+
+The index is the samtools .fai table (name, length, offset, line bases,
+line width) stored next to the FASTA and rebuilt when the FASTA is newer.
+Sequences are read from a memory map of the FASTA, so fetching a few
+records by id (ex. locus tag) touches only their bytes.
+
+    fastaindex.py FASTA [ID ...]
+
+builds the index and writes the requested records.
+"""
+import os
+import sys
+import mmap
+import argparse
+from typing import NamedTuple
+
+
+INDEX_SUFFIX = '.fai'
+
+
+class IndexEntry(NamedTuple):
+    name: str
+    length: int
+    offset: int
+    line_bases: int
+    line_width: int
+
+
+def build_index(fasta_path: str) -> list:
+    """
+    scans FASTA once, every record must have lines of one length except the last one
+    :param fasta_path: (str) path to uncompressed FASTA
+    :return: (list) of IndexEntry in file order
+    """
+    entries = []
+    record = None
+
+    def _close(record):
+        name, length, offset, line_bases, line_width, _ = record
+        entries.append(IndexEntry(name, length, offset, line_bases or 1, line_width or 2))
+
+    with open(fasta_path, 'rb') as fasta:
+        position = 0
+        for line in fasta:
+            if line.startswith(b'>'):
+                if record is not None:
+                    _close(record)
+                name = line[1:].split(None, 1)[0].decode() if line[1:].strip() else ''
+                record = [name, 0, position + len(line), 0, 0, False]
+            elif record is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if record[5] and bases:
+                    raise ValueError(f'{fasta_path}: lines of different length in record {record[0]}')
+                if record[3] == 0:
+                    record[3], record[4] = bases, len(line)
+                elif bases != record[3] or len(line) != record[4]:
+                    # only the last line of a record may be shorter (or blank)
+                    if bases > record[3]:
+                        raise ValueError(f'{fasta_path}: lines of different length in record {record[0]}')
+                    record[5] = True
+                record[1] += bases
+            position += len(line)
+        if record is not None:
+            _close(record)
+    return entries
+
+
+def write_index(entries: list, index_path: str) -> None:
+    with open(index_path, 'wt') as index_file:
+        for entry in entries:
+            index_file.write('\t'.join(map(str, entry)))
+            index_file.write('\n')
+
+
+def read_index(index_path: str) -> dict:
+    """
+    :param index_path: (str) path to .fai index
+    :return: (dict) of IndexEntry by name
+    """
+    entries = {}
+    with open(index_path, 'rt') as index_file:
+        for line in index_file:
+            name, *fields = line.rstrip('\n').split('\t')
+            entries[name] = IndexEntry(name, *map(int, fields[:4]))
+    return entries
+
+
+class FastaIndex:
+    """
+    Random access to records of indexed FASTA by id
+    """
+
+    def __init__(self, fasta_path: str, index_path: str = None):
+        """
+        :param fasta_path: (str) path to uncompressed FASTA
+        :param index_path: (str) path to .fai index, built (or rebuilt if older than FASTA) when needed
+        """
+        index_path = index_path or fasta_path + INDEX_SUFFIX
+        if not os.path.isfile(index_path) or os.path.getmtime(index_path) < os.path.getmtime(fasta_path):
+            write_index(build_index(fasta_path), index_path)
+        self.entries = read_index(index_path)
+        self.file = open(fasta_path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(fasta_path) else b''
+
+    def fetch(self, name: str) -> str:
+        """
+        :param name: (str) record id (first word of FASTA title)
+        :return: (str) sequence
+        """
+        entry = self.entries[name]
+        full_lines, rest = divmod(entry.length, entry.line_bases)
+        end = entry.offset + full_lines * entry.line_width + rest
+        return self.map[entry.offset:end].replace(b'\n', b'').replace(b'\r', b'').decode()
+
+    def __getitem__(self, name: str) -> str:
+        return self.fetch(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def close(self) -> None:
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index FASTA and fetch records by id')
+    parser.add_argument('fasta', help='uncompressed FASTA, index is written next to it')
+    parser.add_argument('ids', nargs='*', help='ids of records to write')
+    args = parser.parse_args()
+
+    with FastaIndex(args.fasta) as index:
+        for name in args.ids:
+            if name not in index:
+                sys.exit(f'{name} not found in {args.fasta}')
+            sys.stdout.write(f'>{name}\n{index[name]}\n')
+
+
+if __name__ == '__main__':
+    main()
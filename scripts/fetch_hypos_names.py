@@ -1,12 +1,47 @@
+"""
+Fetches protein titles of BLASTP hits from NCBI.
+
+Accessions are sent many at once per esummary request, requests run
+concurrently but start no faster than the NCBI rate limit (3 per second,
+10 with an API key), and every fetched title is kept in a sqlite cache
+shared by all runs, so only accessions never seen before go to NCBI.
+Accessions NCBI answers with an ERROR (ex. suppressed records) are cached
+as missing and asked for again only after MISSING_TTL days.
+The E-utilities URL can point to a local stand-in serving esummary XML.
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import asyncio
 import argparse
+import httpx
+import xml.etree.ElementTree as ET
 
+from os.path import join
 from collections import defaultdict
-from Bio import Entrez
+
+
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils'
+CACHE_PATH = os.environ.get('WOOF_ENTREZ_CACHE', join(os.path.expanduser('~'), '.cache', 'woof', 'entrez_titles.sqlite'))
+TOOL = 'woof'
+HYPOTHETICAL = 'hypothetical protein'
+
+BATCH_SIZE = 200
+CONCURRENCY = 3
+RATE = 3  # requests per second without API key
+API_KEY_RATE = 10
+RETRIES = 5
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 30.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MISSING_TTL = 30  # days before accessions answered with ERROR are asked for again
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description=
-                                     """Part annotation of hypothetical proteins in operons. 
+                                     """Part annotation of hypothetical proteins in operons.
                                      Fetch hypothetical proteins names for WP proteins
                                      """
                                      )
@@ -15,24 +50,191 @@ def parse_args():
 
     parser.add_argument('email', default=None, nargs='?')
     parser.add_argument('out_file', default=None, nargs='?')
+    parser.add_argument('--cache', default=CACHE_PATH,
+                        help='sqlite cache of fetched titles shared by runs (env WOOF_ENTREZ_CACHE)')
+    parser.add_argument('--api-key', default=os.environ.get('NCBI_API_KEY'),
+                        help=f'NCBI API key, raises the rate limit from {RATE} to {API_KEY_RATE} requests per second '
+                             f'(env NCBI_API_KEY)')
+    parser.add_argument('--batch-size', default=BATCH_SIZE, type=int, help='accessions per esummary request')
+    parser.add_argument('--concurrency', default=CONCURRENCY, type=int, help='requests in flight')
+    parser.add_argument('--eutils', default=EUTILS_URL, help='E-utilities base URL')
+    parser.add_argument('--missing-ttl', default=MISSING_TTL, type=float,
+                        help='days before accessions NCBI answered with ERROR are fetched again')
     return parser.parse_args()
 
 
-def fetch_gene_product(protein_id: str, email: str) -> str:
+class TitleCache:
+    """
+    Accession -> title store in a sqlite file, accessions without title are stored as NULL.
+    Accessions NCBI answered with ERROR are kept apart as missing, with the time they were asked for
     """
-    fetches gene product from ncbi
-    :param protein_id: (str) protein id
+
+    def __init__(self, path: str, missing_ttl: float = MISSING_TTL):
+        """
+        :param path: (str) path to sqlite file, created if absent
+        :param missing_ttl: (float) days a missing accession is answered from cache
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.missing_ttl = missing_ttl
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS titles (accession TEXT PRIMARY KEY, title TEXT, fetched REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS missing (accession TEXT PRIMARY KEY, error TEXT, fetched REAL)')
+
+    def get(self, accessions: list) -> dict:
+        """
+        :param accessions: (list) of protein accessions
+        :return: (dict) of title (None if NCBI has none or answered with ERROR less than missing_ttl days ago)
+         of every cached accession
+        """
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (accession TEXT PRIMARY KEY)')
+        self.db.execute('DELETE FROM wanted')
+        self.db.executemany('INSERT OR IGNORE INTO wanted VALUES (?)', ((accession,) for accession in accessions))
+        titles = dict(self.db.execute('SELECT accession, title FROM titles JOIN wanted USING (accession)'))
+        expired = time.time() - self.missing_ttl * 86400
+        titles.update((accession, None) for accession, in self.db.execute(
+            'SELECT accession FROM missing JOIN wanted USING (accession) WHERE fetched >= ?', (expired,)))
+        return titles
+
+    def add(self, titles: dict) -> None:
+        """
+        :param titles: (dict) of title (or None) by accession
+        """
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO titles VALUES (?, ?, ?)',
+                                ((accession, title, now) for accession, title in titles.items()))
+            self.db.executemany('DELETE FROM missing WHERE accession = ?', ((accession,) for accession in titles))
+
+    def add_missing(self, errors: dict) -> None:
+        """
+        :param errors: (dict) of ERROR message by accession NCBI returned no DocSum for
+        """
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO missing VALUES (?, ?, ?)',
+                                ((accession, error, now) for accession, error in errors.items()))
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RateLimiter:
+    """
+    Lets requests start no more often than rate per second
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next_start = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def parse_esummary(xml: bytes) -> tuple:
+    """
+    :param xml: (bytes) esummary (version 1) XML of db=protein
+    :return: (tuple) of title by accession, with and without version (dict), and ERROR messages (list)
+    """
+    root = ET.fromstring(xml)
+    titles = {}
+    for docsum in root.iter('DocSum'):
+        items = {item.get('Name'): item.text for item in docsum.iter('Item')}
+        for accession in (items.get('AccessionVersion'), items.get('Caption')):
+            if accession:
+                titles[accession] = items.get('Title') or None
+    return titles, [error.text for error in root.iter('ERROR')]
+
+
+async def _esummary(client: httpx.AsyncClient, limiter: RateLimiter, accessions: list, params: dict) -> tuple:
+    """
+    fetches titles of one batch of accessions. Rate limit and server errors are retried, so are accessions
+    left out of a partial DocSum list: only they are asked for again. Accessions an ERROR names (or all
+    accessions without DocSum if no ERROR names any) are not retried
+    :return: (tuple) of title (None if NCBI has none) of every accession that came back in a DocSum (dict)
+     and ERROR message of every accession answered with ERROR (dict)
+    """
+    titles, missing = {}, {}
+    pending = list(accessions)
+    answered = False
+    delay = RETRY_DELAY
+    for attempt in range(RETRIES):
+        await limiter.wait()
+        try:
+            r = await client.post('esummary.fcgi', data={'db': 'protein', 'id': ','.join(pending), **params})
+            if r.status_code not in RETRY_STATUSES:
+                r.raise_for_status()
+                found, errors = parse_esummary(r.content)
+                answered = True
+                titles.update((accession, found[accession]) for accession in pending if accession in found)
+                pending = [accession for accession in pending if accession not in found]
+                if errors:
+                    # ERROR naming the accession (ex. "Invalid uid ..."), any ERROR if none names it
+                    words = [(error, set(error.replace(',', ' ').split())) for error in reversed(errors)]
+                    named = {accession: error for accession in pending for error, tokens in words
+                             if accession in tokens}
+                    missing.update(named or {accession: errors[0] for accession in pending})
+                    pending = [accession for accession in pending if named and accession not in named]
+                if not pending:
+                    return titles, missing
+        except (httpx.TransportError, ET.ParseError):
+            if attempt == RETRIES - 1:
+                raise
+        if attempt < RETRIES - 1:
+            await asyncio.sleep(delay)
+        delay = min(delay * 2, MAX_RETRY_DELAY) * random.uniform(0.8, 1.2)
+    if not answered:
+        raise Exception(f'esummary failed {RETRIES} times for {accessions[0]}..{accessions[-1]}')
+    print(f'{len(pending)} accessions ({pending[0]}..) not returned by esummary after {RETRIES} attempts, '
+          f'they are not cached', file=sys.stderr)
+    return titles, missing
+
+
+async def fetch_titles(accessions: list, email: str, api_key: str = None, batch_size: int = BATCH_SIZE,
+                       concurrency: int = CONCURRENCY, url: str = EUTILS_URL) -> dict:
+    """
+    fetches protein titles from ncbi, batch_size accessions per request
+    :param accessions: (list) of protein accessions
     :param email: (str) email is obligatory for Entrez work
-    :return: (str) product title for protein id
+    :param api_key: (str) NCBI API key
+    :param batch_size: (int) accessions per esummary request
+    :param concurrency: (int) requests in flight
+    :param url: (str) E-utilities base URL
+    :return: (tuple) of title (None if NCBI has none) by accession (dict), accessions esummary did not return
+     are absent, and ERROR message by accession answered with ERROR (dict)
     """
-    Entrez.email = email
-    with Entrez.esummary(db="protein", id=protein_id, rettype="docsum", retmode="text") as lhandle:
-        record = Entrez.read(lhandle)
-        if 'Title' in record[0].keys():
-            seq_title = record[0]['Title']
-        else:
-            seq_title = None
-    return seq_title
+    params = {'tool': TOOL, 'email': email}
+    if api_key:
+        params['api_key'] = api_key
+    limiter = RateLimiter(API_KEY_RATE if api_key else RATE)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _batch(batch):
+        async with semaphore:
+            return await _esummary(client, limiter, batch, params)
+
+    titles, missing = {}, {}
+    async with httpx.AsyncClient(base_url=url.rstrip('/') + '/', limits=limits,
+                                 timeout=httpx.Timeout(60.0, connect=30.0)) as client:
+        batches = [accessions[i:i + batch_size] for i in range(0, len(accessions), batch_size)]
+        for found, errors in await asyncio.gather(*map(_batch, batches)):
+            titles.update(found)
+            missing.update(errors)
+    return titles, missing
 
 
 def read_tsv(tsv_path: str) -> dict:
@@ -50,23 +252,38 @@ def read_tsv(tsv_path: str) -> dict:
             blast_results[query].append(hit)
     return blast_results
 
-def fetch_gene_products(blast_results: dict, email: str) -> dict:
+
+def fetch_gene_products(blast_results: dict, email: str, cache: TitleCache, **fetch_options) -> dict:
     """
-    fetches blast hits for all blast results, based on known (WP_numbers)
+    fetches blast hits for all blast results, based on known (WP_numbers). Cached titles are used,
+    all other WP_ hits are fetched at once. Hits answered with ERROR are cached as missing (see TitleCache),
+    other hits esummary did not return count as hypothetical in this run only and are fetched again next time
     :param blast_results: (dict) with correspondence between query and hits
     :param email: (str) email is obligatory for Entrez work
+    :param cache: (TitleCache) persistent title cache
+    :param fetch_options: options of fetch_titles
     :return: (dict) with correspondence between query and blast results (gene title)
     """
+    accessions = list(dict.fromkeys(hit for hits in blast_results.values() for hit in hits if hit.startswith('WP_')))
+    titles = cache.get(accessions)
+    new = [accession for accession in accessions if accession not in titles]
+    print(f'{len(accessions) - len(new)} of {len(accessions)} WP_ accessions found in cache')
+    if new:
+        fetched, missing = asyncio.run(fetch_titles(new, email, **fetch_options))
+        cache.add(fetched)
+        cache.add_missing(missing)
+        titles.update(fetched)
+
     funcs = {}
     for query in blast_results.keys():
         for hit in blast_results[query]:
             if hit.startswith('WP_'):
-                product = fetch_gene_product(protein_id=hit, email=email)
+                product = titles.get(hit)
                 if product is not None:
                     funcs[query] = product
                     break
                 else:
-                    funcs[query] = 'hypothetical protein'
+                    funcs[query] = HYPOTHETICAL
     return funcs
 
 
@@ -83,10 +300,12 @@ def write_tsv(blast_prot_titles: dict, out_file: str) -> None:
             out_file.write('\n')
 
 if __name__ == '__main__':
-    in_tsv = parse_args().in_tsv
-    email = parse_args().email
-    out_file = parse_args().out_file
+    args = parse_args()
 
-    blast_results = read_tsv(tsv_path=in_tsv)
-    fetched_blast_results = fetch_gene_products(blast_results=blast_results, email=email)
-    write_tsv(blast_prot_titles=fetched_blast_results, out_file=out_file)
+    blast_results = read_tsv(tsv_path=args.in_tsv)
+    with TitleCache(args.cache, args.missing_ttl) as title_cache:
+        fetched_blast_results = fetch_gene_products(blast_results=blast_results, email=args.email,
+                                                    cache=title_cache, api_key=args.api_key,
+                                                    batch_size=args.batch_size, concurrency=args.concurrency,
+                                                    url=args.eutils)
+    write_tsv(blast_prot_titles=fetched_blast_results, out_file=args.out_file)
@@ -1,5 +1,13 @@
-import pandas as pd
 import argparse
+import numpy as np
+import pandas as pd
+from gffio import read_gff, write_gff
+
+
+CLUSTER_SOURCE = 'findtargetoperon'
+CLUSTER_TYPE = 'gene_cluster'
+MAX_GAP = 5000  # bp between consecutive target genes of one cluster
+MAX_SKIPPED = 5  # non-target genes (ex. IS element) between consecutive target genes of one cluster
 
 
 def parse_args():
@@ -12,6 +20,13 @@ def parse_args():
     parser.add_argument('in_tsv', default=None, nargs='?')
     parser.add_argument('out_file', default=None, nargs='?')
     parser.add_argument('kegg_num_threshold', default=None, nargs='?')
+    parser.add_argument('--clusters', default=None,
+                        help='also write dense runs of target genes along contigs, regardless of operon ids, '
+                             'into this gff')
+    parser.add_argument('--max-gap', default=MAX_GAP, type=int,
+                        help='maximal distance (bp) between consecutive target genes of one cluster')
+    parser.add_argument('--max-skipped', default=MAX_SKIPPED, type=int,
+                        help='maximal number of non-target genes between consecutive target genes of one cluster')
     return parser.parse_args()
 
 
@@ -30,29 +45,6 @@ def read_tsv(tsv_path: str) -> set:
     return target_loci_ids
 
 
-def _split_attributes(attrs: str):
-    pairs = attrs.split(';')
-    kvs = (pair.split('=', maxsplit=1) for pair in pairs) 
-    return {k:v for k, v in kvs}
-
-
-def read_gff(gff_path: str):
-    """
-    reads gff file into pd dataframe
-    :param gff_path: (str) path to gff file
-    :return: pd.DataFrame from gff file
-    """
-    colnames = ['seq_id', 'source', 'type', 'start', 'end', 'score', 'strand', 'phase', 'attributes']
-    gff_data = pd.read_csv(gff_path, sep='\t', names=colnames, skiprows=1)
-    gff_data['attribute_dict'] = gff_data['attributes'].apply(_split_attributes)
-    
-    norm_attribute = pd.json_normalize(gff_data.attribute_dict)
-    gff_data = pd.concat([gff_data, norm_attribute], axis=1)
-    # remove temp columns:
-    gff_data = gff_data.drop(columns=['attribute_dict'])
-    return gff_data
-
-
 def extract_operons(gff_df, targets: set, thres: int):
     """
     extract operons
@@ -63,22 +55,64 @@ def extract_operons(gff_df, targets: set, thres: int):
     """
     gff_of_selected = gff_df[gff_df['locus_tag'].isin(targets)]
 
-    grouped = gff_of_selected.groupby('operon').count()
-    operons_interest = set(grouped.loc[grouped['locus_tag'] >= thres].index)
+    grouped = gff_of_selected.groupby('operon')['locus_tag'].count()
+    operons_interest = set(grouped.loc[grouped >= thres].index)
     gff_of_selected = gff_df[gff_df['operon'].isin(operons_interest)]
 
     return gff_of_selected
 
 
-def write_gff(gff_df, out_path: str) -> None:
+def find_clusters(gff_df, targets: set, thres: int, max_gap: int = MAX_GAP, max_skipped: int = MAX_SKIPPED):
     """
-    writes pandas.DataFrame into gff file
-    :param gff_df: (pandas.DataFrame) needed to be written into gff file
-    :param out_path: (str) path to output file
-    :return: None
+    slides along genes sorted by coordinate on every contig and joins consecutive target genes into one
+    cluster while they are close enough, so clusters split by the operon caller or interrupted by
+    an IS element are still found
+    :param gff_df: (pandas.DataFrame), containing information from gff file
+    :param targets: (set) of loci_ids, genes, responsible for O-antigen biosynthesis
+    :param thres: (int) minimal number of target genes in cluster
+    :param max_gap: (int) maximal distance (bp) between consecutive target genes of one cluster
+    :param max_skipped: (int) maximal number of non-target genes between consecutive target genes of one cluster
+    :return: (pandas.DataFrame) of clusters as gff regions
     """
-    gff_df = gff_df[['seq_id', 'source', 'type', 'start', 'end', 'score', 'strand', 'phase', 'attributes']]
-    gff_df.to_csv(out_path, sep='\t', index=False, header=False)
+    genes = gff_df.sort_values(['seq_id', 'start', 'end'], kind='stable').reset_index(drop=True)
+    contig = genes['seq_id'].astype(str).to_numpy()
+    is_target = genes['locus_tag'].isin(targets).to_numpy()
+
+    # gene order number and running count of target genes give skipped genes between neighbouring targets
+    position = np.flatnonzero(is_target)
+    hits = genes.iloc[position]
+    starts = hits['start'].to_numpy()
+    ends = hits['end'].to_numpy()
+    hit_contig = contig[position]
+    running_end = np.maximum.accumulate(ends) if len(ends) else ends
+
+    linked = np.zeros(len(position), dtype=bool)
+    linked[1:] = ((hit_contig[1:] == hit_contig[:-1])
+                  & (np.diff(position) - 1 <= max_skipped)
+                  & (starts[1:] - running_end[:-1] <= max_gap))
+    cluster = np.cumsum(~linked)
+
+    clusters = pd.DataFrame({'seq_id': hit_contig, 'start': starts, 'end': ends, 'cluster': cluster,
+                             'first': position, 'last': position,
+                             'locus_tag': hits['locus_tag'].to_numpy(),
+                             'operon': hits['operon'].to_numpy()})
+    clusters = clusters.groupby('cluster', sort=True).agg(
+        seq_id=('seq_id', 'first'), start=('start', 'min'), end=('end', 'max'),
+        first=('first', 'first'), last=('last', 'last'), targets=('locus_tag', 'size'),
+        target_genes=('locus_tag', ','.join),
+        operons=('operon', lambda operon: ','.join(pd.unique(operon.dropna().astype(str)))))
+    clusters = clusters[clusters['targets'] >= thres].reset_index(drop=True)
+
+    clusters['attributes'] = [
+        f'ID=cluster_{i};targets={row.targets};genes={row.last - row.first + 1};'
+        f'operons={row.operons};target_genes={row.target_genes}'
+        for i, row in enumerate(clusters.itertuples(index=False), start=1)]
+    clusters['source'] = CLUSTER_SOURCE
+    clusters['type'] = CLUSTER_TYPE
+    clusters['score'] = '.'
+    clusters['strand'] = '.'
+    clusters['phase'] = '.'
+    return clusters
 
 
 if __name__ == '__main__':
@@ -88,7 +122,13 @@ if __name__ == '__main__':
     kegg_num_threshold = int(parse_args().kegg_num_threshold)
 
     targets = read_tsv(tsv_path=in_tsv)
-    gff = read_gff(gff_path=in_gff)
+    gff = read_gff(gff_path=in_gff, attributes=['locus_tag', 'operon'])
     operons = extract_operons(gff_df = gff, targets = targets, thres=kegg_num_threshold)
 
     write_gff(gff_df=operons, out_path=out_file)
+
+    clusters_file = parse_args().clusters
+    if clusters_file is not None:
+        clusters = find_clusters(gff_df=gff, targets=targets, thres=kegg_num_threshold,
+                                 max_gap=parse_args().max_gap, max_skipped=parse_args().max_skipped)
+        write_gff(gff_df=clusters, out_path=clusters_file)
@@ -1,7 +1,10 @@
 import os
 import sys
 import argparse
+import numpy as np
 import pandas as pd
+from gffio import read_gff, write_gff
+
 
 def parse_args():
     parser = argparse.ArgumentParser(usage='gff_fuse.py -c CONTIGS -b BAKTA -a ANTIGENS -o OUTPUT',
@@ -15,16 +18,79 @@ def parse_args():
                         help='O-antigens operons GFF file')
     parser.add_argument('-o', '--output', default=None, nargs=1,
                         help='Output GFF filename')
+    parser.add_argument('-t', '--tolerance', default=0, type=int,
+                        help='Match features whose start and end differ by at most this many bp '
+                             '(ex. start codon disagreements), default: exact coordinates')
     return parser.parse_args()
 
-def read_gff(path_to_gff):
-    """ function to read the .gff file """
-    column_names=["chromosome","source","type","start","end","score","strand","phase","attributes"] # set the column names
-    gff_data = pd.read_csv(path_to_gff, sep='\t', names=column_names) # read the file
-    gff_data = gff_data[gff_data.chromosome.str.startswith("#") == False] # skip the commented lines
-    gff_data = gff_data.astype({'start': 'int', 'end': 'int'}) # set the int type for start and end
-    return gff_data.reset_index(drop=True) # reset index so that after commentaries skipping indexation will be ok
 
+def _contig_codes(left: pd.Series, right: pd.Series) -> tuple:
+    codes, _ = pd.factorize(pd.concat([left.astype(str), right.astype(str)], ignore_index=True))
+    return codes[:len(left)], codes[len(left):]
+
+
+def join_features(left: pd.DataFrame, right: pd.DataFrame, tolerance: int = 0) -> tuple:
+    """
+    interval join of two feature tables on (seq_id, start, end). Right features are sorted once by
+    (contig, start), every left feature looks up its start window with searchsorted and the candidates
+    are checked by end, so the work is linear in the number of features and matching pairs
+    :param left: (pandas.DataFrame) with seq_id, start and end columns
+    :param right: (pandas.DataFrame) with seq_id, start and end columns
+    :param tolerance: (int) maximal difference (bp) of start and of end, 0 is exact key join
+    :return: (tuple) of positional indices (np.ndarray) of matching left and right rows,
+     in order of left rows and then right rows (as pandas.merge)
+    """
+    left_contig, right_contig = _contig_codes(left['seq_id'], right['seq_id'])
+    left_start = left['start'].to_numpy(dtype=np.int64)
+    left_end = left['end'].to_numpy(dtype=np.int64)
+    right_start = right['start'].to_numpy(dtype=np.int64)
+    right_end = right['end'].to_numpy(dtype=np.int64)
+
+    # (contig, start) packed into one sortable key, shifted so start +- tolerance stays in the contig range
+    span = int(max(left_start.max(initial=0), right_start.max(initial=0))) + 2 * tolerance + 1
+    right_key = right_contig * span + right_start + tolerance
+    order = np.argsort(right_key, kind='stable')
+    right_key = right_key[order]
+
+    left_key = left_contig * span + left_start + tolerance
+    lo = np.searchsorted(right_key, left_key - tolerance, side='left')
+    hi = np.searchsorted(right_key, left_key + tolerance, side='right')
+    counts = hi - lo
+
+    # expand every left feature into its candidate range of sorted right features
+    left_idx = np.repeat(np.arange(len(left_key)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    right_idx = order[np.repeat(lo, counts) + offsets]
+
+    matched = np.abs(left_end[left_idx] - right_end[right_idx]) <= tolerance
+    left_idx, right_idx = left_idx[matched], right_idx[matched]
+    pairs = np.lexsort((right_idx, left_idx))
+    return left_idx[pairs], right_idx[pairs]
+
+
+def fuse_annotations(bakta: pd.DataFrame, antigens: pd.DataFrame, tolerance: int = 0) -> pd.DataFrame:
+    """
+    takes Bakta features matching O-antigen operon genes, moves their ID to the end of attributes,
+    adds the operon attribute and relabels transposases
+    :param bakta: (pandas.DataFrame) of Bakta gff (seq_id renamed to contig names)
+    :param antigens: (pandas.DataFrame) of O-antigen operons gff
+    :param tolerance: (int) maximal difference (bp) of start and of end of matching features
+    :return: (pandas.DataFrame) of fused features and insertion sequences sorted by start
+    """
+    bakta_idx, antigens_idx = join_features(bakta, antigens, tolerance)
+    merged = bakta.iloc[bakta_idx].reset_index(drop=True)
+
+    # split instead of partition: it keeps its shape when nothing is matched
+    bakta_attributes = merged['attributes'].astype(str).str.split(';', n=1)
+    first, rest = bakta_attributes.str[0], bakta_attributes.str[1]
+    rotated = first.where(rest.isna(), rest + ';' + first)
+    operon = antigens['attributes'].astype(str).str.split(';', n=1).str[0].to_numpy()[antigens_idx]
+    merged['attributes'] = rotated + ';' + operon
+
+    merged['type'] = merged['type'].astype(str)
+    merged.loc[merged['attributes'].str.contains('transposase', case=False, regex=False), 'type'] = 'Transposase'
+    transposons = antigens[antigens['type'] == 'insertion_sequence']
+    return pd.concat([merged, transposons]).sort_values(by='start')
 
 if __name__ == '__main__':
     contigs_file = parse_args().contigs[0]
@@ -55,31 +121,9 @@ if __name__ == '__main__':
     bakta_inp = read_gff(bakta_file)
     operon_mapper_inp = read_gff(antigens_file)
 
-    contig_to_id = dict(zip(bakta_inp.chromosome.unique(), lines))
-    bakta_inp["chromosome"] = bakta_inp.chromosome.apply(lambda x: contig_to_id[x]) # rename chromosome field
-
-    # intersect gffs
-    merged = bakta_inp \
-        .merge(operon_mapper_inp, left_on='chromosome', right_on='chromosome')\
-        .query('start_x == start_y and end_x == end_y')\
-        .drop(["start_y", "end_y"], axis=1)\
-        .rename(columns={
-            "start_x": "start",
-            "end_x": "end",
-            "source_x": "source",
-            "type_x": "type",
-            "score_x": "score",
-            "strand_x": "strand",
-            "phase_x": "phase"
-        })
-
-    # make attributes
-    merged["attributes_raw"] = merged["attributes_x"].apply(lambda x: ";".join(x.split(";")[1:] + [x.split(";")[0]]))
-    merged["attributes"] = merged.attributes_raw + ";" + merged.attributes_y.apply(lambda x: x.split(";")[0])
-    merged = merged.drop(["attributes_x", "attributes_y", "attributes_raw"], axis=1)
-    merged.loc[merged.attributes.apply(lambda x: "transposase" in x.lower()), 'type'] = "Transposase"
-    merged = merged.drop(["source_y", "type_y", "score_y", "strand_y", "phase_y"], axis=1)
-    transposons = operon_mapper_inp[operon_mapper_inp.type == "insertion_sequence"]
-    output = pd.concat([merged, transposons]).sort_values(by="start")
-
-    output.to_csv(output_file, sep='\t', index=False, header=False)
+    contig_to_id = dict(zip(bakta_inp.seq_id.unique(), lines))
+    bakta_inp["seq_id"] = bakta_inp.seq_id.cat.rename_categories(contig_to_id) # rename seq_id field
+
+    output = fuse_annotations(bakta_inp, operon_mapper_inp, parse_args().tolerance)
+
+    write_gff(output, output_file)
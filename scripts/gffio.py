@@ -0,0 +1,143 @@
+"""
+Shared GFF reading/writing used by the pipeline scripts.
+
+Coordinates are stored as int32, the low-cardinality columns
+(seq_id, source, type, strand) as categoricals, and attributes are only
+parsed for the keys a caller asks for.
+"""
+import re
+import csv
+import gzip
+import pandas as pd
+
+
+GFF_COLUMNS = ['seq_id', 'source', 'type', 'start', 'end', 'score', 'strand', 'phase', 'attributes']
+CATEGORICAL_COLUMNS = ['seq_id', 'source', 'type', 'strand']
+GFF_HEADER = '##gff-version 3'
+
+
+def _open(path: str):
+    if str(path).endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path, 'rt')
+
+
+def _data_lines(handle):
+    """
+    yields feature lines only: skips comments and blank lines, stops at the ##FASTA section
+    """
+    for line in handle:
+        if line.startswith('##FASTA'):
+            break
+        if line.startswith('#') or not line.strip():
+            continue
+        yield line
+
+
+class _DataReader:
+    """
+    file-like view of feature lines (see _data_lines) read by pandas in chunks, the whole file is never
+    held in memory
+    """
+
+    def __init__(self, lines, rest: str = ''):
+        """
+        :param lines: (iterator) of feature lines
+        :param rest: (str) text read before lines
+        """
+        self.lines = lines
+        self.rest = rest
+
+    def read(self, size: int = -1) -> str:
+        chunks, length = [self.rest], len(self.rest)
+        for line in self.lines:
+            chunks.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+        data = ''.join(chunks)
+        if size is None or size < 0:
+            size = len(data)
+        self.rest = data[size:]
+        return data[:size]
+
+    def __iter__(self):
+        # pandas only checks that file-like objects are iterable, chunks are taken with read
+        return iter(self.read().splitlines(keepends=True))
+
+
+def _dtypes(categorical: bool) -> dict:
+    dtypes = {column: 'str' for column in GFF_COLUMNS}
+    dtypes['start'] = 'int32'
+    dtypes['end'] = 'int32'
+    if categorical:
+        for column in CATEGORICAL_COLUMNS:
+            dtypes[column] = 'category'
+    return dtypes
+
+
+def attribute_pattern(key: str):
+    """
+    regex capturing the value of one attribute key in a GFF attributes string
+    :param key: (str) attribute key, ex. locus_tag
+    :return: compiled regex
+    """
+    return re.compile(f'(?:^|;){re.escape(key)}=([^;]*)')
+
+
+def parse_attributes(gff_df: pd.DataFrame, keys) -> pd.DataFrame:
+    """
+    adds one column per requested attribute key, values missing from a feature become NaN
+    :param gff_df: (pandas.DataFrame) with "attributes" column
+    :param keys: (iterable) of attribute keys to extract, ex. ['locus_tag', 'operon']
+    :return: (pandas.DataFrame) with extra columns named after the keys
+    """
+    attributes = gff_df['attributes'].astype(str)
+    for key in keys:
+        gff_df[key] = attributes.str.extract(attribute_pattern(key), expand=False)
+    return gff_df
+
+
+def read_gff(gff_path: str, columns=None, attributes=(), categorical: bool = True) -> pd.DataFrame:
+    """
+    reads gff (optionally gzipped) file into pd dataframe
+    :param gff_path: (str) path to gff file
+    :param columns: (list) of GFF columns to keep (defaults to all nine)
+    :param attributes: (iterable) of attribute keys to parse into separate columns
+    :param categorical: (bool) store seq_id, source, type and strand as categoricals
+    :return: pd.DataFrame from gff file
+    """
+    columns = list(GFF_COLUMNS if columns is None else columns)
+    attributes = list(attributes)
+    usecols = [column for column in GFF_COLUMNS
+               if column in columns or (column == 'attributes' and attributes)]
+    dtypes = _dtypes(categorical)
+
+    with _open(gff_path) as gff_file:
+        lines = _data_lines(gff_file)
+        first = next(lines, None)
+        if first is None:
+            gff_data = pd.DataFrame({column: pd.Series(dtype=dtypes[column]) for column in usecols})
+        else:
+            gff_data = pd.read_csv(_DataReader(lines, first), sep='\t', names=GFF_COLUMNS, header=None,
+                                   usecols=usecols, dtype={column: dtypes[column] for column in usecols},
+                                   quoting=csv.QUOTE_NONE, na_filter=False)
+
+    if attributes:
+        gff_data = parse_attributes(gff_data, attributes)
+    return gff_data[columns + attributes]
+
+
+def write_gff(gff_df: pd.DataFrame, out_path: str, header: bool = True) -> None:
+    """
+    writes pandas.DataFrame into gff file
+    :param gff_df: (pandas.DataFrame) needed to be written into gff file
+    :param out_path: (str) path to output file
+    :param header: (bool) start the file with "##gff-version 3" line
+    :return: None
+    """
+    with open(out_path, 'wt') as out_file:
+        if header:
+            out_file.write(GFF_HEADER + '\n')
+        gff_df[GFF_COLUMNS].to_csv(out_file, sep='\t', index=False, header=False,
+                                   quoting=csv.QUOTE_NONE, lineterminator='\n')
@@ -0,0 +1,272 @@
+"""
+Persistent store of HMM search results of unique protein sequences.
+
+Proteins are keyed by MD5 of their sequence and every profile by SHA-256
+of its own record in the .hmm file, so adding profiles to the file only
+leaves the new ones to be searched. For every (profile, sequence) pair the
+store remembers up to which p-value hits were kept, and the hits
+themselves as raw p-values and scores. P-values do not depend on the size
+of the searched database, so stored hits answer any genome and any looser
+threshold up to the stored one.
+
+    hitstore.py export STORE HMMS DECODER PROTEOME -o OUTPUT -E EVALUE
+
+writes the same tsv as searchhmm.py (and parsehmm.py) from the store alone.
+"""
+import os
+import sys
+import sqlite3
+import hashlib
+import argparse
+from parsehmm import Hit, BEST_CHOICES, filter_hits, best_per_kegg, best_per_protein, read_decoder, \
+    prettify_tsv, write_tsv
+
+
+HASH_CHUNK = 1 << 20
+STORE_PVALUE = 1.0  # keep every hit passing HMMER filters, looser thresholds are answered from the store
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS profiles (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS searched (
+    profile INTEGER NOT NULL,
+    seq_hash BLOB NOT NULL,
+    max_pvalue REAL NOT NULL,
+    PRIMARY KEY (profile, seq_hash)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hits (
+    profile INTEGER NOT NULL,
+    seq_hash BLOB NOT NULL,
+    pvalue REAL NOT NULL,
+    score REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hits_by_seq ON hits (seq_hash, profile);
+'''
+
+
+def sequence_hash(seq: str) -> bytes:
+    """
+    :param seq: (str) protein sequence
+    :return: (bytes) MD5 digest of upper-case sequence
+    """
+    return hashlib.md5(seq.upper().encode()).digest()
+
+
+def profile_keys(hmm_path: str) -> list:
+    """
+    checksums every profile of HMMER3 text file
+    :param hmm_path: (str) path to .hmm file
+    :return: (list) of tuples (hex SHA-256 of profile record, profile name) in file order
+    """
+    keys = []
+    digest = hashlib.sha256()
+    name = None
+    with open(hmm_path, 'rb') as hmm_file:
+        for line in hmm_file:
+            digest.update(line)
+            if line.startswith(b'NAME '):
+                name = line.split(None, 1)[1].strip().decode()
+            elif line.strip() == b'//':
+                keys.append((digest.hexdigest(), name))
+                digest = hashlib.sha256()
+                name = None
+    return keys
+
+
+class HitStore:
+    """
+    Sequence hash x profile -> hits store in a sqlite file
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: (str) path to sqlite file, created if absent
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def _profile_ids(self, keys: list) -> list:
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO profiles (key, name) VALUES (?, ?)', keys)
+        ids = dict(self.db.execute('SELECT key, id FROM profiles'))
+        return [ids[key] for key, _ in keys]
+
+    def _wanted(self, hashes: list) -> None:
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (seq_hash BLOB PRIMARY KEY)')
+        self.db.execute('DELETE FROM wanted')
+        self.db.executemany('INSERT OR IGNORE INTO wanted VALUES (?)', ((seq_hash,) for seq_hash in hashes))
+
+    def missing(self, keys: list, hashes: list, max_pvalue: float) -> list:
+        """
+        :param keys: (list) of (profile key, name) (see profile_keys)
+        :param hashes: (list) of sequence hashes
+        :param max_pvalue: (float) p-value threshold the hits are needed up to
+        :return: (list) of sets of hashes not searched with at least this threshold, one per profile
+        """
+        ids = self._profile_ids(keys)
+        self._wanted(hashes)
+        done = {}
+        for profile, seq_hash in self.db.execute(
+                'SELECT searched.profile, searched.seq_hash FROM searched JOIN wanted USING (seq_hash) '
+                'WHERE searched.max_pvalue >= ?', (max_pvalue,)):
+            done.setdefault(profile, set()).add(seq_hash)
+        return [set(hashes) - done.get(profile, set()) for profile in ids]
+
+    def hits(self, keys: list, hashes: list) -> dict:
+        """
+        :param keys: (list) of (profile key, name) (see profile_keys)
+        :param hashes: (list) of sequence hashes
+        :return: (dict) of lists of hits (profile index in keys, profile name, p-value, score) by hash
+        """
+        ids = self._profile_ids(keys)
+        query = {profile: (i, keys[i][1]) for i, profile in enumerate(ids)}
+        self._wanted(hashes)
+        found = {}
+        for profile, seq_hash, pvalue, score in self.db.execute(
+                'SELECT hits.profile, hits.seq_hash, hits.pvalue, hits.score FROM hits JOIN wanted USING (seq_hash)'):
+            if profile in query:
+                found.setdefault(seq_hash, []).append((*query[profile], pvalue, score))
+        return found
+
+    def add(self, keys: list, hashes: list, hits: dict, max_pvalue: float) -> None:
+        """
+        records search results of sequences with profiles
+        :param keys: (list) of (profile key, name) of searched profiles
+        :param hashes: (list) of searched sequence hashes
+        :param hits: (dict) of lists of hits (profile index in keys, profile name, p-value, score) by hash
+        :param max_pvalue: (float) p-value threshold the search reported hits up to
+        """
+        ids = self._profile_ids(keys)
+        self._wanted(hashes)
+        with self.db:
+            for profile in ids:
+                self.db.execute('DELETE FROM hits WHERE profile = ? AND seq_hash IN (SELECT seq_hash FROM wanted)',
+                                (profile,))
+            self.db.executemany('INSERT OR REPLACE INTO searched VALUES (?, ?, ?)',
+                                ((profile, seq_hash, max_pvalue) for profile in ids for seq_hash in hashes))
+            self.db.executemany('INSERT INTO hits VALUES (?, ?, ?, ?)',
+                                ((ids[query], seq_hash, pvalue, score) for seq_hash in hashes
+                                 for query, _, pvalue, score in hits.get(seq_hash, ())))
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def demultiplex(genomes: list, totals: list, hits: dict, evalue: float = 10.0) -> list:
+    """
+    fans hits of unique sequences out to proteins of every genome. Every genome gets E-value = p-value * its
+    own size, the reporting threshold and the order (by profile, E-value, protein id) of its own search
+    :param genomes: (list) of lists of (protein id, hash), one per genome
+    :param totals: (list) of numbers of proteins of every genome
+    :param hits: (dict) of lists of hits (profile index, profile name, p-value, score) by hash
+    :param evalue: (float) reporting E-value threshold
+    :return: (list) of lists of Hit, one per genome
+    """
+    demultiplexed = []
+    for genome, total in zip(genomes, totals):
+        genome_hits = []
+        for name, seq_hash in genome:
+            for query, kegg_id, pvalue, score in hits.get(seq_hash, ()):
+                genome_evalue = pvalue * total
+                if genome_evalue <= evalue:
+                    genome_hits.append((query, pvalue, name, Hit(name, kegg_id, f'{genome_evalue:.2g}', score)))
+        genome_hits.sort(key=lambda hit: hit[:3])
+        demultiplexed.append([hit[3] for hit in genome_hits])
+    return demultiplexed
+
+
+def max_pvalue(evalue: float, totals: list) -> float:
+    """
+    :return: (float) p-value threshold covering E-value threshold of every genome
+    """
+    return evalue / max(min(totals, default=1), 1) * (1 + 1e-9)
+
+
+def read_proteins(fasta_path: str, prefilter: tuple = None, min_shared: int = None) -> tuple:
+    """
+    :param fasta_path: (str) path to proteome fasta
+    :param prefilter: (tuple) of k-mer index, k and alphabet (see kmerfilter.load_index)
+    :param min_shared: (int) minimal number of k-mers shared with prefilter index
+    :return: (tuple) of list of (protein id, sequence) of (shortlisted) proteins and total number of proteins
+    """
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+    with open(fasta_path) as fasta:
+        proteins = [(title.split(None, 1)[0], seq) for title, seq in SimpleFastaParser(fasta)]
+    total = len(proteins)
+    if prefilter is not None:
+        from kmerfilter import shortlist
+        index, k, alphabet = prefilter
+        passed = shortlist([seq for _, seq in proteins], index, k, alphabet, min_shared)
+        proteins = [protein for protein, keep in zip(proteins, passed) if keep]
+    return proteins, total
+
+
+def _export(args):
+    from kmerfilter import load_index, MIN_SHARED
+
+    prefilter = load_index(args.prefilter) if args.prefilter else None
+    proteins, total = read_proteins(args.proteome, prefilter, args.min_shared or MIN_SHARED)
+    genome = [(name, sequence_hash(seq)) for name, seq in proteins]
+    hashes = list({seq_hash for _, seq_hash in genome})
+    keys = profile_keys(args.hmms)
+
+    with HitStore(args.store) as store:
+        missing = sum(map(len, store.missing(keys, hashes, max_pvalue(args.evalue, [total]))))
+        if missing:
+            sys.exit(f'{missing} profile x protein pairs of {args.proteome} are not in {args.store}, '
+                     f'search them with searchhmm.py --cohort --store first')
+        hits = store.hits(keys, hashes)
+
+    hits = demultiplex([genome], [total], hits, args.evalue)[0]
+    hits = filter_hits(hits, min_score=args.score)
+    if args.best == 'kegg':
+        hits = best_per_kegg(hits)
+    elif args.best == 'protein':
+        hits = best_per_protein(hits)
+    missing_keggs = set()
+    written = write_tsv(prettify_tsv(hits, read_decoder(args.decoder), missing=missing_keggs), args.output)
+    if missing_keggs:
+        print(f'KEGG ids absent from {args.decoder}: {", ".join(sorted(missing_keggs))}', file=sys.stderr)
+    print(f'{written} hits of {args.proteome} written to {args.output}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Persistent store of HMM search hits')
+    subs = parser.add_subparsers(required=True)
+
+    export = subs.add_parser('export', help='write hits of a proteome from the store in parsehmm.py tsv format')
+    export.add_argument('store', help='sqlite store (see searchhmm.py --store)')
+    export.add_argument('hmms', help='HMM profiles (.hmm) the proteome was searched with')
+    export.add_argument('decoder', help='tsv table of kegg id to gene name correspondence')
+    export.add_argument('proteome', help='proteome fasta')
+    export.add_argument('-o', '--output', required=True, help='output tsv')
+    export.add_argument('-E', '--evalue', default=10.0, type=float,
+                        help='report hits with full sequence E-value not higher than this')
+    export.add_argument('-T', '--score', default=None, type=float,
+                        help='report hits with full sequence bit score not lower than this')
+    export.add_argument('--best', default='kegg', choices=BEST_CHOICES,
+                        help='keep only the best hit per protein x KEGG (default), per protein or keep all hits')
+    export.add_argument('--prefilter', default=None,
+                        help='k-mer index the proteome was searched with (see kmerfilter.py)')
+    export.add_argument('--min-shared', default=None, type=int,
+                        help='minimal number of k-mers shared with the prefilter index')
+    export.set_defaults(func=_export)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    main()
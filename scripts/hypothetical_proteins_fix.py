@@ -1,22 +1,106 @@
 import os
 import sys
 import argparse
-import pandas as pd
+
+
+# characters escaped in GFF3 attribute values
+GFF_ESCAPES = {'%': '%25', ';': '%3B', '=': '%3D', '&': '%26', ',': '%2C', '\t': '%09', '\n': '%0A'}
+LOOKUP_KEYS = ('locus_tag', 'ID')
+
 
 def parse_args():
     parser = argparse.ArgumentParser(usage='hypothetical_proteins_fix.py -g GFF -h HYPOTHETICAL -o OUTPUT',
-                                     description='''Fuse GFF annotations from Operon Mapper and Bakta into one file.''')
-
+                                     description='''Adds names of hypothetical proteins found with BLASTP
+                                     to Bakta-annotated GFF.''', add_help=False)
 
+    parser.add_argument('--help', action='help', help='show this help message and exit')
     parser.add_argument('-g', '--gff', default=None, nargs=1,
                         help='Bakta-annotated gff file')
     parser.add_argument('-h', '--hypothetical', default=None, nargs=1,
-                        help='Hypothetical proteins BLASP search results')
+                        help='Hypothetical proteins BLASTP search results: ID, gene name and protein name '
+                             'or ID and protein name (see fetch_hypos_names.py) per line')
     parser.add_argument('-o', '--output', default=None, nargs=1,
                         help='Output GFF filename')
     return parser.parse_args()
-    
-    
+
+
+def escape(value: str) -> str:
+    """
+    :param value: (str) attribute value
+    :return: (str) value with GFF3 reserved characters percent-encoded
+    """
+    return ''.join(GFF_ESCAPES.get(char, char) for char in value)
+
+
+def read_hypothetical(hypothetical_path: str) -> dict:
+    """
+    reads BLASTP naming table into hash index, the first line of every ID is kept
+    :param hypothetical_path: (str) path to tab separated table: ID, gene name, protein name
+     or ID, protein name (protein name is used as gene name)
+    :return: (dict) of correspondence between ID and (gene name, protein name)
+    """
+    names = {}
+    with open(hypothetical_path, 'rt') as tsv_file:
+        for line in tsv_file:
+            entry = line.rstrip('\n').split('\t')
+            if len(entry) < 2 or not entry[0]:
+                continue
+            gene_name, protein_name = (entry[1], entry[2]) if len(entry) > 2 else (entry[1], entry[1])
+            names.setdefault(entry[0], (escape(gene_name), escape(protein_name)))
+    return names
+
+
+def patch_attributes(attributes: str, names: dict) -> str:
+    """
+    sets Name and product of a feature whose locus_tag (or ID) is in names, other attributes keep their order
+    :param attributes: (str) GFF attributes column
+    :param names: (dict) of correspondence between ID and (gene name, protein name) (see read_hypothetical)
+    :return: (str) patched attributes, the same string if feature is not in names
+    """
+    pairs = [attribute.partition('=') for attribute in attributes.split(';')]
+    values = {key: value for key, _, value in pairs}
+    for key in LOOKUP_KEYS:
+        if values.get(key) in names:
+            gene_name, protein_name = names[values[key]]
+            break
+    else:
+        return attributes
+
+    patched = {'Name': gene_name, 'product': protein_name}
+    attributes = [f'{key}={patched.pop(key)}' if key in patched else f'{key}{sep}{value}'
+                  for key, sep, value in pairs]
+    attributes.extend(f'{key}={value}' for key, value in patched.items())
+    return ';'.join(attributes)
+
+
+def fix_gff(gff_path: str, names: dict, out_path: str) -> int:
+    """
+    rewrites gff line by line, comments and ##FASTA section are copied as they are
+    :param gff_path: (str) path to Bakta-annotated gff file
+    :param names: (dict) of correspondence between ID and (gene name, protein name) (see read_hypothetical)
+    :param out_path: (str) path to output gff file
+    :return: (int) number of patched features
+    """
+    patched = 0
+    with open(gff_path, 'rt') as gff_file, open(out_path, 'wt') as out_file:
+        for line in gff_file:
+            if line.startswith('##FASTA'):
+                out_file.write(line)
+                out_file.writelines(gff_file)
+                break
+            if line.startswith('#') or not line.strip():
+                out_file.write(line)
+                continue
+            fields = line.rstrip('\n').split('\t')
+            attributes = patch_attributes(fields[8], names)
+            if attributes is not fields[8]:
+                fields[8] = attributes
+                patched += 1
+            out_file.write('\t'.join(fields))
+            out_file.write('\n')
+    return patched
+
+
 if __name__ == '__main__':
     gff_file = parse_args().gff[0]
     hypothetical_file = parse_args().hypothetical[0]
@@ -33,37 +117,9 @@ if __name__ == '__main__':
         output_file = 'output_file_fixed_hypothetical.gff3'
     else:
         output_file = output_file[0]
-        if not output_file.endsw# data upload
-	o_ag_annot = pd.read_csv(gff_file, sep='\t') 
-	hypothetical = pd.read_csv(hypothetical_file, sep='\t', header=None)\
-		.rename(columns={0: "ID", 1: "Gene_name", 2: "Protein_name"}) 
-
-	dict_hypothetical = hypothetical.to_dict(orient='records')
-
-	for index, row in o_ag_annot.iterrows():
-		for hypo in dict_hypothetical:
-		    if hypo["ID"] in row['attributes']:
-		        attrs = row['attributes'].split(";")
-		        attrs[0] = f'Name={hypo["Gene_name"]}'
-		        attrs[2] = f'product={hypo["Protein_name"]}'
-		        o_ag_annot.at[index, 'attributes'] = ";".join(attrs)
-
-	o_ag_annot.to_csv(output_file, sep='\t', index=False)ith('.gff3'):
+        if not output_file.endswith('.gff3'):
             output_file = output_file + '.gff3'
-            
-	# data upload
-	o_ag_annot = pd.read_csv(gff_file, sep='\t') 
-	hypothetical = pd.read_csv(hypothetical_file, sep='\t', header=None)\
-		.rename(columns={0: "ID", 1: "Gene_name", 2: "Protein_name"}) 
-
-	dict_hypothetical = hypothetical.to_dict(orient='records')
-
-	for index, row in o_ag_annot.iterrows():
-		for hypo in dict_hypothetical:
-		    if hypo["ID"] in row['attributes']:
-		        attrs = row['attributes'].split(";")
-		        attrs[0] = f'Name={hypo["Gene_name"]}'
-		        attrs[2] = f'product={hypo["Protein_name"]}'
-		        o_ag_annot.at[index, 'attributes'] = ";".join(attrs)
-
-	o_ag_annot.to_csv(output_file, sep='\t', index=False)
+
+    hypothetical = read_hypothetical(hypothetical_file)
+    fixed = fix_gff(gff_file, hypothetical, output_file)
+    print(f'{fixed} features of {len(hypothetical)} named hypothetical proteins patched in {output_file}')
@@ -0,0 +1,246 @@
+"""
+Amino-acid k-mer prefilter for the HMM stage.
+
+Seed proteins of the target families (consensus and sampled sequences of
+the profiles and/or seed fasta files) are cut into k-mers, over the 20 amino acids
+or a reduced 10-letter alphabet. The sorted k-mer array is the index. Proteomes are screened
+with one vectorized pass over all their k-mers at once: proteins sharing
+at least `min_shared` k-mers with the index are shortlisted for the HMM search.
+"""
+import sys
+import argparse
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+
+ALPHABETS = {
+    'full': tuple('ACDEFGHIKLMNPQRSTVWY'),
+    # Murphy et al. 10-letter reduced alphabet, similar residues share a letter
+    'murphy10': ('LVIM', 'C', 'A', 'G', 'ST', 'P', 'FYW', 'EDNQ', 'KR', 'H'),
+}
+ALPHABET = 'full'
+# unvalidated defaults: recall was only checked on the proteome the test profiles were built from,
+# check it on held-out homologs (`recall`) before relying on them
+K = 4
+MIN_SHARED = 8
+SAMPLES = 0
+UNKNOWN = 255
+
+
+def _code_table(alphabet: str) -> np.ndarray:
+    codes = np.full(256, UNKNOWN, dtype=np.uint8)
+    for code, letters in enumerate(ALPHABETS[alphabet]):
+        for letter in letters:
+            codes[ord(letter)] = code
+            codes[ord(letter.lower())] = code
+    return codes
+
+
+_CODES = {alphabet: _code_table(alphabet) for alphabet in ALPHABETS}
+
+
+def encode(sequences: list, alphabet: str = ALPHABET) -> tuple:
+    """
+    concatenates sequences into one array of alphabet codes separated by UNKNOWN
+    :param sequences: (list) of str sequences
+    :param alphabet: (str) one of ALPHABETS
+    :return: (tuple) of codes (np.ndarray) and start of every sequence in them (np.ndarray)
+    """
+    joined = '\0'.join(sequences).encode()
+    codes = _CODES[alphabet][np.frombuffer(joined, dtype=np.uint8)]
+    lengths = np.fromiter((len(seq) + 1 for seq in sequences), dtype=np.int64, count=len(sequences))
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    return codes, starts
+
+
+def kmer_values(codes: np.ndarray, k: int = K, alphabet: str = ALPHABET) -> tuple:
+    """
+    packs every window of k codes into one integer
+    :param codes: (np.ndarray) of codes (see encode)
+    :param k: (int) k-mer length
+    :param alphabet: (str) one of ALPHABETS
+    :return: (tuple) of k-mer values and validity mask (windows without UNKNOWN)
+    """
+    if len(codes) < k:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=bool)
+    windows = sliding_window_view(codes, k)
+    valid = (windows != UNKNOWN).all(axis=1)
+    weights = len(ALPHABETS[alphabet]) ** np.arange(k - 1, -1, -1, dtype=np.uint64)
+    values = (windows.astype(np.uint64) * weights).sum(axis=1, dtype=np.uint64)
+    return values, valid
+
+
+def build_index(sequences: list, k: int = K, alphabet: str = ALPHABET) -> np.ndarray:
+    """
+    :param sequences: (list) of seed sequences
+    :param k: (int) k-mer length
+    :param alphabet: (str) one of ALPHABETS
+    :return: (np.ndarray) of sorted unique k-mers
+    """
+    codes, _ = encode(sequences, alphabet)
+    values, valid = kmer_values(codes, k, alphabet)
+    return np.unique(values[valid])
+
+
+def shared_kmers(sequences: list, index: np.ndarray, k: int = K, alphabet: str = ALPHABET) -> np.ndarray:
+    """
+    counts k-mers of every sequence found in index
+    :param sequences: (list) of protein sequences
+    :param index: (np.ndarray) of sorted k-mers (see build_index)
+    :param k: (int) k-mer length the index was built with
+    :param alphabet: (str) alphabet the index was built with
+    :return: (np.ndarray) of shared k-mer counts, one per sequence
+    """
+    if not sequences:
+        return np.zeros(0, dtype=np.int64)
+    codes, starts = encode(sequences, alphabet)
+    values, valid = kmer_values(codes, k, alphabet)
+    found = np.searchsorted(index, values)
+    found = valid & (found < len(index)) & (index[np.minimum(found, len(index) - 1)] == values)
+    owner = np.searchsorted(starts, np.flatnonzero(found), side='right') - 1
+    return np.bincount(owner, minlength=len(sequences))
+
+
+def shortlist(sequences: list, index: np.ndarray, k: int = K, alphabet: str = ALPHABET,
+              min_shared: int = MIN_SHARED) -> np.ndarray:
+    """
+    :return: (np.ndarray) boolean mask of sequences sharing at least min_shared k-mers with index
+    """
+    return shared_kmers(sequences, index, k, alphabet) >= min_shared
+
+
+def save_index(index: np.ndarray, k: int, alphabet: str, out_path: str) -> None:
+    np.savez_compressed(out_path, kmers=index, k=k, alphabet=alphabet,
+                        letters=','.join(ALPHABETS[alphabet]))
+
+
+def load_index(index_path: str) -> tuple:
+    """
+    :param index_path: (str) path to .npz index (see save_index)
+    :return: (tuple) of sorted k-mers, k and alphabet
+    """
+    with np.load(index_path) as data:
+        alphabet = str(data['alphabet'])
+        if alphabet not in ALPHABETS or str(data['letters']) != ','.join(ALPHABETS[alphabet]):
+            raise ValueError(f'{index_path} was built with unknown alphabet')
+        return data['kmers'], int(data['k']), alphabet
+
+
+def read_fasta(fasta_path: str) -> tuple:
+    """
+    :param fasta_path: (str) path to fasta
+    :return: (tuple) of lists of titles and sequences
+    """
+    with open(fasta_path) as fasta:
+        records = list(SimpleFastaParser(fasta))
+    return [title for title, _ in records], [seq for _, seq in records]
+
+
+def profile_seeds(hmm_path: str, samples: int = SAMPLES, seed: int = 42) -> list:
+    """
+    takes consensus and sequences sampled from the core model of every profile
+    :param hmm_path: (str) path to .hmm file
+    :param samples: (int) number of sampled sequences per profile
+    :param seed: (int) random seed
+    :return: (list) of seed sequences
+    """
+    from pyhmmer.easel import Randomness
+    from pyhmmer.plan7 import HMMFile
+
+    rng = Randomness(seed)
+    sequences = []
+    with HMMFile(hmm_path) as hmm_file:
+        for hmm in hmm_file:
+            if hmm.consensus:
+                sequences.append(hmm.consensus.upper())
+            for _ in range(samples):
+                sequences.append(hmm.emit_sequence(rng).textize().sequence)
+    return sequences
+
+
+def _build(args):
+    sequences = []
+    for hmm_path in args.hmms:
+        sequences.extend(profile_seeds(hmm_path, args.samples))
+    for fasta_path in args.seeds:
+        sequences.extend(read_fasta(fasta_path)[1])
+    if not sequences:
+        sys.exit('No seeds: give profiles (--hmms) or seed fasta (--seeds)')
+    index = build_index(sequences, args.k, args.alphabet)
+    save_index(index, args.k, args.alphabet, args.output)
+    print(f'{len(index)} {args.k}-mers of {len(sequences)} seeds written to {args.output}')
+
+
+def _screen(args):
+    index, k, alphabet = load_index(args.index)
+    titles, sequences = read_fasta(args.proteome)
+    passed = shortlist(sequences, index, k, alphabet, args.min_shared)
+    with open(args.output, 'wt') as out:
+        for title, seq in zip(np.array(titles, dtype=object)[passed], np.array(sequences, dtype=object)[passed]):
+            out.write(f'>{title}\n{seq}\n')
+    print(f'{passed.sum()} of {len(sequences)} proteins shortlisted into {args.output}')
+
+
+def _recall(args):
+    from searchhmm import load_profiles, search
+    from parsehmm import best_per_kegg
+    from pyhmmer.easel import TextSequence, TextSequenceBlock
+
+    index, k, alphabet = load_index(args.index)
+    profiles = load_profiles(args.hmms)
+
+    print('proteome\tmin_shared\tproteins\tshortlisted\thits\trecalled\trecall')
+    for proteome in args.proteomes:
+        titles, sequences = read_fasta(proteome)
+        names = np.array([title.split(None, 1)[0] for title in titles], dtype=object)
+        shared = shared_kmers(sequences, index, k, alphabet)
+        block = TextSequenceBlock(TextSequence(name=name, sequence=seq)
+                                  for name, seq in zip(names, sequences)).digitize(profiles[0].alphabet)
+        hits = {hit[:2] for hit in best_per_kegg(search(profiles, block, cpus=args.cpu, evalue=args.evalue,
+                                                        dom_evalue=args.evalue))}
+
+        for min_shared in args.min_shared:
+            kept = set(names[shared >= min_shared])
+            recalled = sum(target in kept for target, _ in hits)
+            print(f'{proteome}\t{min_shared}\t{len(names)}\t{len(kept)}\t{len(hits)}\t{recalled}\t'
+                  f'{recalled / len(hits) if hits else 1:.4f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Amino-acid k-mer prefilter for HMM search')
+    subs = parser.add_subparsers(required=True)
+
+    build = subs.add_parser('build', help='build k-mer index of seed sequences')
+    build.add_argument('-m', '--hmms', nargs='*', default=[], help='profiles to take seeds from (needs pyhmmer)')
+    build.add_argument('-s', '--seeds', nargs='*', default=[], help='seed protein fasta files')
+    build.add_argument('-k', type=int, default=K, help='k-mer length')
+    build.add_argument('-a', '--alphabet', default=ALPHABET, choices=list(ALPHABETS), help='k-mer alphabet')
+    build.add_argument('--samples', type=int, default=SAMPLES, help='sequences sampled from every profile')
+    build.add_argument('-o', '--output', required=True, help='index file (.npz)')
+    build.set_defaults(func=_build)
+
+    screen = subs.add_parser('screen', help='write shortlisted proteins of a proteome')
+    screen.add_argument('index', help='k-mer index (.npz)')
+    screen.add_argument('proteome', help='proteome fasta')
+    screen.add_argument('-n', '--min-shared', type=int, default=MIN_SHARED,
+                        help='minimal number of k-mers shared with the index')
+    screen.add_argument('-o', '--output', required=True, help='shortlisted proteins fasta')
+    screen.set_defaults(func=_screen)
+
+    recall = subs.add_parser('recall', help='report recall of the prefilter against unfiltered HMM search')
+    recall.add_argument('index', help='k-mer index (.npz)')
+    recall.add_argument('hmms', help='profiles (.hmm)')
+    recall.add_argument('proteomes', nargs='+', help='proteome fasta files')
+    recall.add_argument('-n', '--min-shared', type=int, nargs='+', default=[1, 2, 4, MIN_SHARED, 16],
+                        help='minimal numbers of k-mers shared with the index to report')
+    recall.add_argument('-E', '--evalue', type=float, default=1e-19, help='E-value threshold of the search')
+    recall.add_argument('--cpu', type=int, default=0, help='number of threads, 0 is all cores')
+    recall.set_defaults(func=_recall)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Coordinate liftover between transposon-free and original sequences.
+
+Every excised insertion is described by its index in the transposon-free
+sequence and its length. Sorted insertion indexes plus the cumulative
+excised length form an offset table, so all coordinates are lifted with
+a single searchsorted call.
+"""
+import numpy as np
+import pandas as pd
+
+
+TRANSPOSON_SOURCE = 'transposon_cutter'
+TRANSPOSON_TYPE = 'insertion_sequence'
+TRANSPOSON_ATTRIBUTES = 'function=transposasa'
+
+
+def offset_table(insert_index, lengths) -> tuple:
+    """
+    builds sorted offset table from restore data
+    :param insert_index: (array-like) insertion positions in transposon-free sequence
+    :param lengths: (array-like) lengths of excised insertions
+    :return: (tuple) of sorted positions and cumulative shift applied from each position on
+    """
+    insert_index = np.asarray(insert_index, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    order = np.argsort(insert_index, kind='stable')
+    return insert_index[order], np.cumsum(lengths[order])
+
+
+def lift(coords, positions: np.ndarray, shifts: np.ndarray) -> np.ndarray:
+    """
+    maps transposon-free coordinates to original ones.
+    A coordinate equal to an insertion position lands after the insertion
+    :param coords: (array-like) transposon-free coordinates
+    :param positions: (np.ndarray) sorted insertion positions (see offset_table)
+    :param shifts: (np.ndarray) cumulative shifts (see offset_table)
+    :return: (np.ndarray) original coordinates
+    """
+    coords = np.asarray(coords, dtype=np.int64)
+    shift = np.concatenate(([0], shifts))
+    return coords + shift[np.searchsorted(positions, coords, side='right')]
+
+
+def lift_annotation(annotation: pd.DataFrame, positions: np.ndarray, shifts: np.ndarray) -> pd.DataFrame:
+    """
+    lifts start and end of every feature in one pass
+    :param annotation: (pandas.DataFrame) gff annotation of transposon-free sequence
+    :param positions: (np.ndarray) sorted insertion positions (see offset_table)
+    :param shifts: (np.ndarray) cumulative shifts (see offset_table)
+    :return: (pandas.DataFrame) annotation in original coordinates
+    """
+    annotation = annotation.copy()
+    annotation['start'] = lift(annotation['start'], positions, shifts).astype('int32')
+    annotation['end'] = lift(annotation['end'], positions, shifts).astype('int32')
+    return annotation
+
+
+def insertion_features(seq_id: str, insert_index, lengths, score, strand) -> pd.DataFrame:
+    """
+    builds gff features for all restored insertions at once
+    :param seq_id: (str) sequence id
+    :param insert_index: (array-like) insertion positions in transposon-free sequence
+    :param lengths: (array-like) lengths of excised insertions
+    :param score: (array-like) insertion scores
+    :param strand: (array-like) insertion strands, missing ones default to "+"
+    :return: (pandas.DataFrame) of insertion_sequence features in original coordinates
+    """
+    insert_index = np.asarray(insert_index, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    order = np.argsort(insert_index, kind='stable')
+    starts = np.empty_like(insert_index)
+    starts[order] = insert_index[order] + np.cumsum(lengths[order]) - lengths[order]
+
+    return pd.DataFrame({
+        'seq_id': seq_id,
+        'source': TRANSPOSON_SOURCE,
+        'type': TRANSPOSON_TYPE,
+        'start': starts.astype('int32'),
+        'end': (starts + lengths).astype('int32'),
+        'score': pd.Series(score, dtype='str').fillna('.').to_numpy(),
+        'strand': pd.Series(strand, dtype='str').fillna('+').to_numpy(),
+        'phase': '0',
+        'attributes': TRANSPOSON_ATTRIBUTES,
+    })
+
+
+def fill_operons(annotation: pd.DataFrame) -> pd.DataFrame:
+    """
+    marks insertions as transposases and puts an insertion into an operon
+    when the closest operon genes on both sides belong to the same operon
+    :param annotation: (pandas.DataFrame) sorted by start, with "operon" column
+    :return: (pandas.DataFrame) with updated attributes and operon of insertions
+    """
+    annotation = annotation.copy()
+    is_insertion = (annotation['type'] == TRANSPOSON_TYPE).to_numpy()
+    operon = pd.to_numeric(annotation['operon'], errors='coerce')
+    by_seq = operon.groupby(annotation['seq_id'].astype(str), sort=False)
+    before = by_seq.ffill()
+    after = by_seq.bfill()
+
+    inside = is_insertion & operon.isna().to_numpy() & (before == after).to_numpy()
+    annotation.loc[is_insertion, 'attributes'] = TRANSPOSON_ATTRIBUTES
+    annotation.loc[inside, 'attributes'] = (TRANSPOSON_ATTRIBUTES + ';operon=' +
+                                            before[inside].astype(int).astype(str))
+    annotation['operon'] = annotation['operon'].astype(object)
+    annotation.loc[inside, 'operon'] = before[inside].astype(int).astype(str)
+    return annotation
+
+
+def write_chain(chain_file, seq_id: str, clean_length: int, insert_index, lengths, chain_id: int = 1) -> None:
+    """
+    writes UCSC chain lifting transposon-free coordinates (target) to original ones (query)
+    :param chain_file: opened text file
+    :param seq_id: (str) sequence id, same name is used for both sides
+    :param clean_length: (int) length of transposon-free sequence
+    :param insert_index: (array-like) insertion positions in transposon-free sequence
+    :param lengths: (array-like) lengths of excised insertions
+    :param chain_id: (int) chain id
+    :return: None
+    """
+    positions, shifts = offset_table(insert_index, lengths)
+    # insertions sharing a position form one gap
+    positions, last = np.unique(positions[::-1], return_index=True)
+    shifts = shifts[len(shifts) - 1 - last]
+    lengths = np.diff(np.concatenate(([0], shifts)))
+    orig_length = clean_length + int(lengths.sum())
+
+    q_start = int(lengths[0]) if len(positions) and positions[0] == 0 else 0
+    inner = (positions > 0) & (positions < clean_length)
+    q_end = orig_length - (int(lengths[-1]) if len(positions) and positions[-1] == clean_length else 0)
+
+    print('chain', clean_length, seq_id, clean_length, '+', 0, clean_length,
+          seq_id, orig_length, '+', q_start, q_end, chain_id, file=chain_file)
+    blocks = np.diff(np.concatenate(([0], positions[inner], [clean_length])))
+    for size, gap in zip(blocks[:-1], lengths[inner]):
+        print(size, 0, gap, sep='\t', file=chain_file)
+    print(blocks[-1], file=chain_file)
+    print(file=chain_file)
@@ -0,0 +1,252 @@
+"""
+Local homology naming of hypothetical proteins.
+
+`build` collapses protein fasta files of known O-antigen cluster proteins
+(UniProt or NCBI headers) into a compact database: one record per unique
+sequence with its accession, gene and product. `search` aligns hypothetical
+proteins (see extract_hypo.py) against it with phmmer on all cores and
+writes the ID, gene name, protein name tsv that hypothetical_proteins_fix.py
+consumes. The best hit of every sequence is cached by sequence MD5 and
+database checksum, so a protein is searched only once across a cohort and
+stricter cutoffs are answered from the cache.
+"""
+import os
+import re
+import sys
+import sqlite3
+import hashlib
+import argparse
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from hitstore import sequence_hash, HASH_CHUNK
+
+
+CACHE_EVALUE = 10.0  # best hits are cached up to this E-value, stricter cutoffs are applied on reading
+EVALUE = 1e-10
+MIN_IDENTITY = 0.3
+MIN_COVERAGE = 0.5
+UNKNOWN_GENE = '-'
+
+UNIPROT_HEADER = re.compile(r'^(?:sp|tr)\|(?P<accession>[^|]+)\|\S+\s+(?P<product>.*?)(?:\s+OS=.*?)?(?:\s+GN=(?P<gene>\S+).*)?$')
+NCBI_HEADER = re.compile(r'^(?P<accession>\S+)\s*(?P<product>.*?)(?:\s+\[[^\]]*\])?$')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS best_hits (
+    db TEXT NOT NULL,
+    seq_hash BLOB NOT NULL,
+    target TEXT,
+    gene TEXT,
+    product TEXT,
+    evalue REAL,
+    score REAL,
+    identity REAL,
+    coverage REAL,
+    PRIMARY KEY (db, seq_hash)
+) WITHOUT ROWID;
+'''
+
+
+def parse_header(title: str) -> tuple:
+    """
+    :param title: (str) fasta title, UniProt (sp|P37745|RFBX_ECOLI ... GN=rfbX ...) or NCBI (WP_... product [organism])
+    :return: (tuple) of accession, gene (UNKNOWN_GENE if absent) and product
+    """
+    match = UNIPROT_HEADER.match(title) or NCBI_HEADER.match(title)
+    accession, product = match.group('accession'), match.group('product').strip()
+    gene = match.groupdict().get('gene') or UNKNOWN_GENE
+    return accession, gene, product or accession
+
+
+def build_database(fasta_paths: list, out_path: str) -> tuple:
+    """
+    writes unique sequences of fasta files as ">accession gene product" records, the first title of
+    every sequence is kept
+    :param fasta_paths: (list) of paths to protein fasta files
+    :param out_path: (str) path to database fasta
+    :return: (tuple) of numbers of read and written sequences
+    """
+    seen = set()
+    read = 0
+    with open(out_path, 'wt') as out_file:
+        for fasta_path in fasta_paths:
+            with open(fasta_path, 'rt') as fasta:
+                for title, seq in SimpleFastaParser(fasta):
+                    read += 1
+                    seq = seq.replace('*', '').upper()
+                    seq_hash = sequence_hash(seq)
+                    if seq_hash in seen:
+                        continue
+                    seen.add(seq_hash)
+                    accession, gene, product = parse_header(title)
+                    out_file.write(f'>{accession} {gene} {product}\n{seq}\n')
+    return read, len(seen)
+
+
+def database_key(db_path: str) -> str:
+    """
+    :param db_path: (str) path to database fasta
+    :return: (str) hex SHA-256 of database file
+    """
+    digest = hashlib.sha256()
+    with open(db_path, 'rb') as db_file:
+        for chunk in iter(lambda: db_file.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class NameCache:
+    """
+    (database, sequence hash) -> best hit store in a sqlite file, sequences without hits have NULL target
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: (str) path to sqlite file, created if absent
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def get(self, db_key: str, hashes: list) -> dict:
+        """
+        :param db_key: (str) database checksum (see database_key)
+        :param hashes: (list) of sequence hashes
+        :return: (dict) of best hit (target, gene, product, evalue, score, identity, coverage) by cached hash
+        """
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (seq_hash BLOB PRIMARY KEY)')
+        self.db.execute('DELETE FROM wanted')
+        self.db.executemany('INSERT OR IGNORE INTO wanted VALUES (?)', ((seq_hash,) for seq_hash in hashes))
+        return {row[0]: row[1:] for row in self.db.execute(
+            'SELECT seq_hash, target, gene, product, evalue, score, identity, coverage '
+            'FROM best_hits JOIN wanted USING (seq_hash) WHERE db = ?', (db_key,))}
+
+    def add(self, db_key: str, best_hits: dict) -> None:
+        """
+        :param db_key: (str) database checksum (see database_key)
+        :param best_hits: (dict) of best hit (see get) by hash, all None if no hit
+        """
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO best_hits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                ((db_key, seq_hash, *hit) for seq_hash, hit in best_hits.items()))
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def search(sequences: dict, db_path: str, cpus: int = 0, evalue: float = CACHE_EVALUE) -> dict:
+    """
+    aligns sequences against database with phmmer
+    :param sequences: (dict) of protein sequence by hash
+    :param db_path: (str) path to database fasta (see build_database)
+    :param cpus: (int) number of threads, 0 is all cores
+    :param evalue: (float) reporting E-value threshold
+    :return: (dict) of best hit (target, gene, product, evalue, score, identity, coverage) by hash,
+     all None if no hit
+    """
+    from pyhmmer.hmmer import phmmer
+    from pyhmmer.easel import Alphabet, SequenceFile, TextSequence, TextSequenceBlock
+
+    alphabet = Alphabet.amino()
+    with SequenceFile(db_path, digital=True, alphabet=alphabet) as db_file:
+        targets = db_file.read_block()
+    names = {target.name: target.description for target in targets}
+    queries = TextSequenceBlock(TextSequence(name=seq_hash.hex(), sequence=seq)
+                                for seq_hash, seq in sequences.items()).digitize(alphabet)
+
+    best_hits = {seq_hash: (None,) * 7 for seq_hash in sequences}
+    for top_hits in phmmer(queries, targets, cpus=cpus, E=evalue, domE=evalue):
+        for hit in top_hits.reported:
+            alignment = hit.best_domain.alignment
+            identity = sum(char.isalpha() for char in alignment.identity_sequence) / len(alignment.identity_sequence)
+            coverage = (alignment.hmm_to - alignment.hmm_from + 1) / alignment.hmm_length
+            gene, _, product = names[hit.name].partition(' ')
+            best_hits[bytes.fromhex(top_hits.query.name)] = (hit.name, gene, product, hit.evalue, hit.score,
+                                                            identity, coverage)
+            break
+    return best_hits
+
+
+def name_proteins(proteins: list, best_hits: dict, evalue: float = EVALUE, min_identity: float = MIN_IDENTITY,
+                  min_coverage: float = MIN_COVERAGE):
+    """
+    :param proteins: (list) of (protein id, hash)
+    :param best_hits: (dict) of best hit by hash (see search)
+    :param evalue: (float) maximal E-value of the best hit
+    :param min_identity: (float) minimal identity of the best domain alignment
+    :param min_coverage: (float) minimal fraction of the hypothetical protein in the best domain alignment
+    :return: (generator) of (protein id, gene name, protein name), gene name is the product if gene is unknown
+    """
+    for protein_id, seq_hash in proteins:
+        target, gene, product, hit_evalue, _, identity, coverage = best_hits[seq_hash]
+        if target is None or hit_evalue > evalue or identity < min_identity or coverage < min_coverage:
+            continue
+        yield protein_id, product if gene == UNKNOWN_GENE else gene, product
+
+
+def _build(args):
+    read, written = build_database(args.fasta, args.output)
+    print(f'{written} unique of {read} sequences written to {args.output}')
+
+
+def _search(args):
+    with open(args.query, 'rt') as fasta:
+        proteins = [(title.split(None, 1)[0], seq.replace('*', '').upper()) for title, seq in SimpleFastaParser(fasta)]
+    sequences = {sequence_hash(seq): seq for _, seq in proteins}
+    proteins = [(protein_id, sequence_hash(seq)) for protein_id, seq in proteins]
+    db_key = database_key(args.db)
+
+    with NameCache(args.cache) as cache:
+        best_hits = cache.get(db_key, list(sequences))
+        missing = {seq_hash: seq for seq_hash, seq in sequences.items() if seq_hash not in best_hits}
+        print(f'{len(sequences) - len(missing)} of {len(sequences)} unique proteins found in cache')
+        if missing:
+            found = search(missing, args.db, args.cpu)
+            cache.add(db_key, found)
+            best_hits.update(found)
+
+    written = 0
+    with open(args.output, 'wt') as out_file:
+        for entry in name_proteins(proteins, best_hits, args.evalue, args.min_identity, args.min_coverage):
+            out_file.write('\t'.join(entry))
+            out_file.write('\n')
+            written += 1
+    print(f'{written} of {len(proteins)} hypothetical proteins named in {args.output}', file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local homology naming of hypothetical proteins')
+    subs = parser.add_subparsers(required=True)
+
+    build = subs.add_parser('build', help='build database of known proteins')
+    build.add_argument('fasta', nargs='+', help='protein fasta files with UniProt or NCBI titles')
+    build.add_argument('-o', '--output', required=True, help='database fasta')
+    build.set_defaults(func=_build)
+
+    search_parser = subs.add_parser('search', help='name hypothetical proteins by their best database hit')
+    search_parser.add_argument('query', help='hypothetical proteins fasta (see extract_hypo.py)')
+    search_parser.add_argument('db', help='database fasta (see build)')
+    search_parser.add_argument('-o', '--output', required=True,
+                               help='tsv of ID, gene name, protein name (see hypothetical_proteins_fix.py)')
+    search_parser.add_argument('--cache', required=True,
+                               help='sqlite cache of best hits shared by runs, created if absent')
+    search_parser.add_argument('-E', '--evalue', default=EVALUE, type=float,
+                               help=f'maximal E-value of the best hit (cached up to {CACHE_EVALUE})')
+    search_parser.add_argument('--min-identity', default=MIN_IDENTITY, type=float,
+                               help='minimal identity of the best alignment')
+    search_parser.add_argument('--min-coverage', default=MIN_COVERAGE, type=float,
+                               help='minimal fraction of the hypothetical protein aligned')
+    search_parser.add_argument('--cpu', default=0, type=int, help='number of threads, 0 is all cores')
+    search_parser.set_defaults(func=_search)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    main()
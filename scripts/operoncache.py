@@ -0,0 +1,198 @@
+"""
+Local content-addressed cache of OperonMapper results.
+
+Entries are keyed by SHA-256 of the submitted FASTA, the optional GFF and
+the submission options which change the result. Every entry is a directory
+with the extracted result files and a small meta.json; the least recently
+used entries are evicted once the cache grows over its size limit.
+"""
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+from os.path import join
+
+
+CACHE_DIR = os.environ.get('WOOF_CACHE', join(os.path.expanduser('~'), '.cache', 'woof', 'operonmapper'))
+MAX_CACHE_SIZE = '20G'
+META_FILE = 'meta.json'
+HASH_CHUNK = 1 << 20
+
+_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(size: str) -> int:
+    """
+    parses human readable size
+    :param size: (str) size like 500M or 20G
+    :return: (int) size in bytes
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', str(size).upper())
+    if not match:
+        raise ValueError(f'Wrong size: {size}')
+    return int(float(match.group(1)) * _UNITS[match.group(2)])
+
+
+def _update_file(digest, path: str):
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+
+
+def cache_key(fasta: str, gff: str = None, options: dict = None) -> str:
+    """
+    computes cache key of a submission
+    :param fasta: (str) path to fasta file
+    :param gff: (str) path to optional gff file
+    :param options: (dict) submission options which change the result
+    :return: (str) hex key
+    """
+    digest = hashlib.sha256()
+    digest.update(b'fasta\0')
+    _update_file(digest, fasta)
+    digest.update(b'\0gff\0')
+    if gff:
+        _update_file(digest, gff)
+    digest.update(b'\0options\0')
+    digest.update(json.dumps(options or {}, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def _entry(cache_dir: str, key: str) -> str:
+    return join(cache_dir, key[:2], key)
+
+
+def _dir_size(path: str) -> int:
+    return sum(os.path.getsize(join(root, file)) for root, _, files in os.walk(path) for file in files)
+
+
+def _read_meta(entry: str) -> dict:
+    with open(join(entry, META_FILE)) as meta:
+        return json.load(meta)
+
+
+def _write_meta(entry: str, meta: dict):
+    with open(join(entry, META_FILE), 'w') as out:
+        json.dump(meta, out, indent=1)
+
+
+def _copy(src: str, dst: str):
+    """
+    copies file, never hardlinks: result files are rewritten in place by later runs and
+    a link would let them overwrite the cache entry
+    """
+    if os.path.exists(dst):
+        os.remove(dst)
+    shutil.copy2(src, dst)
+
+
+def find(key: str, cache_dir: str = CACHE_DIR) -> dict:
+    """
+    :param key: (str) cache key (see cache_key)
+    :param cache_dir: (str) cache directory
+    :return: (dict) meta of cache entry or None if there is no such entry
+    """
+    entry = _entry(cache_dir, key)
+    if not os.path.isfile(join(entry, META_FILE)):
+        return None
+    return _read_meta(entry)
+
+
+def lookup(key: str, output: str, cache_dir: str = CACHE_DIR) -> list:
+    """
+    puts cached result files into output directory
+    :param key: (str) cache key (see cache_key)
+    :param output: (str) output directory
+    :param cache_dir: (str) cache directory
+    :return: (list) of result files or None if there is no such entry
+    """
+    meta = find(key, cache_dir)
+    if meta is None:
+        return None
+
+    entry = _entry(cache_dir, key)
+    os.makedirs(output, exist_ok=True)
+    for file in meta['files']:
+        _copy(join(entry, file), join(output, file))
+
+    meta['last_used'] = time.time()
+    _write_meta(entry, meta)
+    return sorted(meta['files'])
+
+
+def store(key: str, output: str, files: list, info: dict = None,
+          cache_dir: str = CACHE_DIR, max_size: int = None) -> str:
+    """
+    stores result files from output directory in cache
+    :param key: (str) cache key (see cache_key)
+    :param output: (str) output directory
+    :param files: (list) of result file names
+    :param info: (dict) extra information kept in meta.json (task id, fasta name, ...)
+    :param cache_dir: (str) cache directory
+    :param max_size: (int) cache size limit in bytes, older entries are evicted
+    :return: (str) entry directory
+    """
+    entry = _entry(cache_dir, key)
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+    tmp = tempfile.mkdtemp(prefix='.tmp_', dir=os.path.dirname(entry))
+    files = [file for file in files if os.path.isfile(join(output, file)) and not file.startswith('.')]
+    for file in files:
+        _copy(join(output, file), join(tmp, file))
+    now = time.time()
+    _write_meta(tmp, {**(info or {}), 'key': key, 'files': files,
+                      'size': _dir_size(tmp), 'created': now, 'last_used': now})
+
+    if os.path.isdir(entry):
+        shutil.rmtree(entry)
+    os.rename(tmp, entry)
+
+    if max_size is not None:
+        prune(cache_dir, max_size=max_size)
+    return entry
+
+
+def entries(cache_dir: str = CACHE_DIR) -> list:
+    """
+    lists cache entries, the most recently used first
+    :param cache_dir: (str) cache directory
+    :return: (list) of meta dicts
+    """
+    found = []
+    if not os.path.isdir(cache_dir):
+        return found
+    for prefix in os.listdir(cache_dir):
+        prefix_dir = join(cache_dir, prefix)
+        if not os.path.isdir(prefix_dir):
+            continue
+        for key in os.listdir(prefix_dir):
+            entry = join(prefix_dir, key)
+            if os.path.isfile(join(entry, META_FILE)):
+                found.append(_read_meta(entry))
+    return sorted(found, key=lambda meta: meta['last_used'], reverse=True)
+
+
+def prune(cache_dir: str = CACHE_DIR, max_size: int = None, older_than: float = None) -> list:
+    """
+    evicts least recently used entries
+    :param cache_dir: (str) cache directory
+    :param max_size: (int) keep total size of entries under this limit, bytes
+    :param older_than: (float) evict entries unused for this number of seconds
+    :return: (list) of evicted keys
+    """
+    evicted = []
+    total = 0
+    now = time.time()
+    for meta in entries(cache_dir):
+        total += meta['size']
+        too_old = older_than is not None and now - meta['last_used'] > older_than
+        too_big = max_size is not None and total > max_size
+        if too_old or too_big:
+            shutil.rmtree(_entry(cache_dir, meta['key']))
+            evicted.append(meta['key'])
+            total -= meta['size']
+    return evicted
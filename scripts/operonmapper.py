@@ -5,30 +5,63 @@ https://biocomputo.ibt.unam.mx/operon_mapper/
 import os
 import io
 import re
+import sys
+import csv
 import httpx
 import time
+import random
+import asyncio
+import shutil
 import tarfile
 
 from os.path import join
+from operoncache import CACHE_DIR, MAX_CACHE_SIZE, cache_key, find, lookup, store, entries, prune, parse_size
 
 
 OPERON_MAPPER_URL = 'https://biocomputo.ibt.unam.mx/operon_mapper'
 REUSE_FILE = '.reuse'
+SUBMIT_OPTIONS = {'todoscomprimido': 'si'}
 
+POLL_INTERVAL = 15
+MAX_POLL_INTERVAL = 300
+POLL_BACKOFF = 1.5
+POLL_JITTER = 0.2
 
-def _submit(fastafile: io.TextIOWrapper,
-            gfffile: io.TextIOWrapper = None,
-            description: str = 'An Operon Search',
-            email: str = None):
+DOWNLOAD_CHUNK = 1 << 20
+DOWNLOAD_RETRIES = 5
+PIPELINE_MEMBERS = ['list_of_operons', 'operonic_gene_pairs', 'predicted_protein_sequences', 'ORFs_coordinates']
+
+
+def _client(url: str = OPERON_MAPPER_URL, concurrency: int = 4) -> httpx.AsyncClient:
     """
-        Submit task to operon mapper using fasta file and optional gff annotation
+        Shared connection pool for all requests to operon mapper
     """
-    form_action = f'{OPERON_MAPPER_URL}/capta_forma_01.pl'
+    origin = re.match(r'https?://[^/]+', url).group(0)
+    headers = {
+        'Origin': origin,
+        'Referer': url.rstrip('/') + '/',
+    }
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    return httpx.AsyncClient(base_url=url, headers=headers, limits=limits,
+                             timeout=httpx.Timeout(60.0, connect=30.0))
 
+
+def _status_url(client: httpx.AsyncClient, out_id):
+    return f'{str(client.base_url).rstrip("/")}/out/out_{out_id}.html'
+
+
+async def _submit(client: httpx.AsyncClient,
+                  fastafile: io.TextIOWrapper,
+                  gfffile: io.TextIOWrapper = None,
+                  description: str = 'An Operon Search',
+                  email: str = None):
+    """
+        Submit task to operon mapper using fasta file and optional gff annotation
+    """
     data = {
         'fastaseq': fastafile.read(),
         'descri': description,
-        'todoscomprimido': 'si'
+        **SUBMIT_OPTIONS
     }
 
     if gfffile:
@@ -36,12 +69,7 @@ def _submit(fastafile: io.TextIOWrapper,
     if email:
         data['email1'] = email
 
-    headers = {
-        'Origin': 'https://biocomputo.ibt.unam.mx',
-        'Referer': 'https://biocomputo.ibt.unam.mx/operon_mapper/',
-    }
-
-    r = httpx.post(url=form_action, headers=headers, data=data)
+    r = await client.post('capta_forma_01.pl', data=data)
     r.raise_for_status()
 
     match = re.search(r'out_(?P<id>\d+)\.html', r.text, re.MULTILINE)
@@ -51,45 +79,82 @@ def _submit(fastafile: io.TextIOWrapper,
     raise Exception('Link to results page not found\n' + r.text)
 
 
-def _read(out_id, out_dir):
+def _extract(archive_path, out_id, out_dir, members=None):
+    """
+    Streams archive members straight into output directory, dropping task id from their names.
+    Every member goes to a temporary file replacing the old one, so a file shared with another path
+    (ex. copied in by hand as a hardlink) is never written through
+    :return: (list) of extracted file names
+    """
+    extracted = []
+    with tarfile.open(archive_path, mode='r|gz') as targz:
+        for member in targz:
+            folder, file = os.path.split(member.name)
+            if not member.isfile() or folder != out_id:
+                continue
+            file_no_id = file.rsplit('_', maxsplit=1)[0]
+            if members is not None and file_no_id not in members:
+                continue
+            part = join(out_dir, f'.{file_no_id}.part')
+            with targz.extractfile(member) as src, open(part, 'wb') as dst:
+                shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK)
+            os.replace(part, join(out_dir, file_no_id))
+            extracted.append(file_no_id)
+
+    return sorted(extracted)
+
+
+async def _download(client: httpx.AsyncClient, url, path, retries: int = DOWNLOAD_RETRIES):
+    """
+    Streams url into file. Partial file is kept between attempts and runs,
+    and the download is resumed with a Range request
+    """
+    part = path + '.part'
+    for attempt in range(retries + 1):
+        done = os.path.getsize(part) if os.path.isfile(part) else 0
+        headers = {'Range': f'bytes={done}-'} if done else {}
+        try:
+            async with client.stream('GET', url, headers=headers) as rsp:
+                if rsp.status_code == 416:  # nothing left to download
+                    break
+                rsp.raise_for_status()
+                mode = 'ab' if rsp.status_code == 206 else 'wb'
+                with open(part, mode) as out:
+                    async for chunk in rsp.aiter_bytes(DOWNLOAD_CHUNK):
+                        out.write(chunk)
+            break
+        except httpx.TransportError:
+            if attempt == retries:
+                raise
+            await asyncio.sleep(_next_delay(1, MAX_POLL_INTERVAL) * (attempt + 1))
+    os.replace(part, path)
+    return path
+
+
+async def _read(client: httpx.AsyncClient, out_id, out_dir, members=None):
     """
     Out id example http://biocomputo.ibt.unam.mx/operon_mapper/out/2614089.tar.gz
     """
     os.makedirs(out_dir, exist_ok=True)
-    rsp = httpx.get(f'{OPERON_MAPPER_URL}/out/{out_id}.tar.gz')
-    rsp.raise_for_status()
-
-    with tarfile.open(fileobj=io.BytesIO(rsp.read())) as targz:
-        targz.extractall(out_dir)
-
-    out_folder = join(out_dir, out_id)
-    files = os.listdir(out_folder)
-
-    for file in files:
-        fullname = join(out_folder, file)
-        if os.path.isdir(fullname):
-            continue
-        file_no_id = file.rsplit('_', maxsplit=1)[0]
-        os.rename(fullname, join(out_dir, file_no_id))
-
-    os.rmdir(out_folder)
+    archive = await _download(client, f'out/{out_id}.tar.gz', join(out_dir, f'{out_id}.tar.gz'))
 
-    return sorted(file for file in os.listdir(out_dir))
+    files = await asyncio.to_thread(_extract, archive, out_id, out_dir, members)
+    os.remove(archive)
+    return files
 
 
-def _peek(out_id):
-    """ 
-    Checks wether results is ready or not 
-    recommended peek time - 1/30sec
+async def _peek(client: httpx.AsyncClient, out_id):
     """
-    url = f'{OPERON_MAPPER_URL}/out/out_{out_id}.html'
-    rsp = httpx.get(url)
+    Checks wether results is ready or not
+    """
+    url = _status_url(client, out_id)
+    rsp = await client.get(f'out/out_{out_id}.html')
     rsp.raise_for_status()
     text = rsp.text
-    
+
     if '======== Error code ========' in text:
         raise Exception(f'Operon mapper exception. Visit {url} for details')
-    
+
     if 'too many errors' in text:
         raise Exception(f'Operon mapper exception. Visit {url} for details')
 
@@ -99,36 +164,119 @@ def _peek(out_id):
     return False
 
 
-def _find_operons(args):
-    if not args.description:
-        args.description = os.path.basename(args.fasta)
+def _next_delay(delay: float, max_delay: float) -> float:
+    """
+    Exponential backoff with jitter
+    """
+    delay = min(delay * POLL_BACKOFF, max_delay)
+    return delay * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
 
-    fastafile = args.fasta and open(args.fasta)
-    gfffile = args.gff and open(args.gff)
 
-    args.task_id = _submit(fastafile, gfffile, args.description, args.email)
+async def _wait(client: httpx.AsyncClient, task_id, name: str,
+                interval: float = POLL_INTERVAL, max_interval: float = MAX_POLL_INTERVAL):
+    """
+    Polls task until results are ready, returns waiting time
+    """
+    started = time.monotonic()
+    delay = interval
+    while not await _peek(client, task_id):
+        waited = time.monotonic() - started
+        print(f'{name}: results are not ready yet, next check in {delay:.0f}sec ({waited:.0f}sec passed)')
+        await asyncio.sleep(delay)
+        delay = _next_delay(delay, max_interval)
+    return time.monotonic() - started
+
+
+def _write_reuse(output, task_id):
+    reuse_file = join(output, REUSE_FILE)
+    os.makedirs(output, exist_ok=True)
+    with open(reuse_file, 'w') as reusef:
+        print(task_id, file=reusef)
+        print(f'Task id was written to reuse file {reuse_file}')
 
-    fastafile and fastafile.close()
-    gfffile and gfffile.close()
 
-    print('Operon finder task submitted')
-    print('\tTask id:', args.task_id)
-    print('Visit', f'{OPERON_MAPPER_URL}/out/out_{args.task_id}.html', 'to manually check status')
+def _read_reuse(output):
+    reuse_file = join(output, REUSE_FILE)
+    if not os.path.isfile(reuse_file):
+        print(f'Reuse not availabe: no reuse file found at {reuse_file}.')
+        return None
+
+    with open(reuse_file, 'r') as reusef:
+        task_id = reusef.read().strip()
+    print(f'Found reuse file "{reuse_file}". Continue pooling with task_id {task_id}')
+    return task_id
+
+
+async def _start_task(client: httpx.AsyncClient, fasta, gff, description, email, output):
+    with open(fasta) as fastafile:
+        gfffile = gff and open(gff)
+        try:
+            task_id = await _submit(client, fastafile, gfffile, description, email)
+        finally:
+            gfffile and gfffile.close()
+
+    print(f'{description}: operon finder task submitted')
+    print('\tTask id:', task_id)
+    print('Visit', _status_url(client, task_id), 'to manually check status')
+
+    if output:
+        _write_reuse(output, task_id)
+    return task_id
 
-    reuse_file = join(args.output, REUSE_FILE)
-    os.makedirs(args.output, exist_ok=True)
-    with open(reuse_file, 'w') as reusef:
-        print(args.task_id, file=reusef)
-        print(f'Task id was written to reuse file {reuse_file}')
 
-    return _do_pooling(args)
+async def _pool_task(client: httpx.AsyncClient, task_id, output, name, args):
+    t = await _wait(client, task_id, name, args.interval, args.max_interval)
+    files = await _read(client, task_id, output, args.members)
+
+    print(f'{name}: result is ready, it took only {t:.0f} seconds\n')
+    print('Output files are:')
+    for f in files:
+        print('\t', output + '/' + f)
+    return files
 
 
-def _prettysleep(n, freq=3):
-    rate = 1/freq
-    for _ in range(n*freq):
-        time.sleep(rate)
-        yield rate
+async def _find_one(client: httpx.AsyncClient, fasta, gff, name, email, output, args):
+    """
+    Takes result from cache, continues reused task or submits a new one
+    """
+    key = None
+    if not args.no_cache:
+        # description and email do not change the result, so they are not a part of the key
+        key = cache_key(fasta, gff, {**SUBMIT_OPTIONS, 'url': args.url})
+        meta = find(key, args.cache_dir)
+        if meta is not None and (meta.get('complete') or
+                                 args.members is not None and set(args.members) <= set(meta['files'])):
+            output = output or 'operonmapper_output_' + meta['task_id']
+            files = lookup(key, output, args.cache_dir)
+            print(f'{name}: found cached result of task {meta["task_id"]}\n')
+            print('Output files are:')
+            for f in files:
+                print('\t', output + '/' + f)
+            return files
+
+    task_id = _read_reuse(output) if args.reuse and output else None
+    if task_id is None:
+        task_id = await _start_task(client, fasta, gff, name, email, output)
+    output = output or 'operonmapper_output_' + task_id
+    files = await _pool_task(client, task_id, output, name, args)
+
+    if key is not None:
+        store(key, output, files, {'task_id': task_id, 'fasta': os.path.abspath(fasta),
+                                   'complete': args.members is None},
+              cache_dir=args.cache_dir, max_size=parse_size(args.cache_max_size))
+    return files
+
+
+def _find_operons(args):
+    if not args.description:
+        args.description = os.path.basename(args.fasta)
+
+    async def run():
+        async with _client(args.url) as client:
+            return await _find_one(client, args.fasta, args.gff, args.description,
+                                   args.email, args.output, args)
+
+    return asyncio.run(run())
 
 
 def _do_pooling(args):
@@ -136,44 +284,89 @@ def _do_pooling(args):
     if not args.output:
         args.output = 'operonmapper_output_' + args.task_id
 
-    task_id = args.task_id
-    t = 0
-    while not _peek(task_id):
-        for dt in _prettysleep(15):
-            t += dt
-            print(f'\rResults are not ready yet, keep waiting ({t:.2f}sec passed)', end='')
+    async def run():
+        async with _client(args.url) as client:
+            return await _pool_task(client, args.task_id, args.output, args.task_id, args)
 
-    print()
+    return asyncio.run(run())
 
-    files = _read(task_id, args.output)
 
-    print(f'Result is ready, it took only {t} seconds\n')
-    print('Output files are:')
-    for f in files:
-        print('\t', args.output + '/' + f)
+def read_sample_sheet(sheet_path: str) -> list:
+    """
+    reads tab-separated sample sheet with "name" and "fasta" columns and optional "gff" and "output" ones
+    :param sheet_path: (str) path to sample sheet
+    :return: (list) of samples as dicts
+    """
+    with open(sheet_path, newline='') as sheet:
+        samples = [row for row in csv.DictReader(sheet, delimiter='\t')]
+    for sample in samples:
+        sample['gff'] = sample.get('gff') or None
+        sample['output'] = sample.get('output') or f'operonmapper_output_{sample["name"]}'
+    return samples
 
 
-def _should_reuse(args):
-    if not args.reuse:
-        return
-    
-    reuse_file = os.path.join(args.output, '.reuse')
+async def _run_sample(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, sample: dict, args):
+    async with semaphore:
+        return await _find_one(client, sample['fasta'], sample['gff'], sample['name'],
+                               args.email, sample['output'], args)
 
-    if not os.path.isfile(reuse_file):
-        print(f'Reuse not availabe: no reuse file found at {reuse_file}.')
-        return
 
-    with open(reuse_file, 'r') as reusef:
-        args.task_id = reusef.read().strip()
-    print(f'Found reuse file "{reuse_file}". Continue pooling with task_id {args.task_id}')
-    args.func = _do_pooling
+def _batch(args):
+    samples = read_sample_sheet(args.samples)
+
+    async def run():
+        semaphore = asyncio.Semaphore(args.jobs)
+        async with _client(args.url, concurrency=args.jobs) as client:
+            return await asyncio.gather(*(_run_sample(client, semaphore, sample, args) for sample in samples),
+                                        return_exceptions=True)
+
+    results = asyncio.run(run())
+    failed = [(sample['name'], result) for sample, result in zip(samples, results)
+              if isinstance(result, BaseException)]
+    for name, error in failed:
+        print(f'{name}: failed: {error}', file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+def _cache_list(args):
+    total = 0
+    for meta in entries(args.cache_dir):
+        total += meta['size']
+        used = time.strftime('%Y-%m-%d %H:%M', time.localtime(meta['last_used']))
+        print(meta['key'][:16], meta['task_id'], f'{meta["size"] / (1 << 20):.1f}M', used,
+              meta.get('fasta', ''), sep='\t')
+    print(f'Total: {total / (1 << 20):.1f}M in {args.cache_dir}')
+
+
+def _cache_prune(args):
+    max_size = 0 if args.all else args.max_size and parse_size(args.max_size)
+    older_than = args.older_than and args.older_than * 24 * 3600
+    evicted = prune(args.cache_dir, max_size=max_size, older_than=older_than)
+    print(f'{len(evicted)} cache entries removed')
 
 
 def main():
-    import sys
     import argparse
 
     main_parser = argparse.ArgumentParser()
+    main_parser.add_argument('--url', default=os.environ.get('OPERON_MAPPER_URL', OPERON_MAPPER_URL),
+                             help='operon mapper url (defaults to $OPERON_MAPPER_URL or the public server)')
+    main_parser.add_argument('--interval', type=float, default=POLL_INTERVAL,
+                             help='initial delay between status checks, seconds')
+    main_parser.add_argument('--max-interval', type=float, default=MAX_POLL_INTERVAL,
+                             help='maximal delay between status checks, seconds')
+    main_parser.add_argument('--cache-dir', default=CACHE_DIR,
+                             help='result cache directory (defaults to $WOOF_CACHE or ~/.cache/woof/operonmapper)')
+    main_parser.add_argument('--cache-max-size', default=MAX_CACHE_SIZE,
+                             help='cache size limit, least recently used results are evicted (ex. 500M, 20G)')
+    main_parser.add_argument('--no-cache', action='store_true',
+                             help='neither use nor fill result cache')
+    main_parser.add_argument('--members', type=lambda members: members.split(','), default=None,
+                             help='extract only these comma-separated result files '
+                                  '(ex. list_of_operons,predicted_protein_sequences)')
+    main_parser.add_argument('--pipeline-members', dest='members', action='store_const', const=PIPELINE_MEMBERS,
+                             help=f'extract only files used by the pipeline: {", ".join(PIPELINE_MEMBERS)}')
     subs = main_parser.add_subparsers(required=True)
 
     parser = subs.add_parser('start')
@@ -195,8 +388,31 @@ def main():
     continue_parser.add_argument('-o', '--output', default=None,
                                  help='(defaults to task_id)')
 
+    batch_parser = subs.add_parser('batch')
+    batch_parser.add_argument('samples',
+                              help='tab-separated sample sheet with "name", "fasta" and optional '
+                                   '"gff", "output" columns')
+    batch_parser.add_argument('--email', default=None,
+                              help='email to be notified regarding job status')
+    batch_parser.add_argument('-j', '--jobs', type=int, default=4,
+                              help='maximal number of jobs submitted and polled at once')
+    batch_parser.add_argument('--reuse', action='store_true',
+                              help='continue pooling tasks found in reuse files of sample outputs')
+    batch_parser.set_defaults(func=_batch)
+
+    cache_parser = subs.add_parser('cache')
+    cache_subs = cache_parser.add_subparsers(required=True)
+    list_parser = cache_subs.add_parser('list')
+    list_parser.set_defaults(func=_cache_list)
+    prune_parser = cache_subs.add_parser('prune')
+    prune_parser.add_argument('--max-size', default=None,
+                              help='evict least recently used results above this size (ex. 500M, 20G)')
+    prune_parser.add_argument('--older-than', type=float, default=None,
+                              help='evict results unused for this number of days')
+    prune_parser.add_argument('--all', action='store_true', help='clear the cache')
+    prune_parser.set_defaults(func=_cache_prune)
+
     args = main_parser.parse_args()
-    _should_reuse(args)
 
     return args.func(args)
 
@@ -1,9 +1,25 @@
+import sys
 import argparse
+from typing import NamedTuple
+
+
+# (target, query, full sequence E-value, full sequence score) columns
+TBLOUT_FIELDS = (0, 2, 4, 5)
+DOMTBLOUT_FIELDS = (0, 3, 6, 7)
+BEST_CHOICES = ('kegg', 'protein', 'none')
+MISSING_GENE = 'NA'
+
+
+class Hit(NamedTuple):
+    target: str
+    kegg_id: str
+    evalue: str  # kept as written by hmmsearch
+    score: float
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description=
-                                     """Part of finding domains using hmms pipeline. 
+                                     """Part of finding domains using hmms pipeline.
                                      Converts \s separated file into tab separated file (tsv) and
                                      adds genes info.
                                      """
@@ -11,27 +27,79 @@ def parse_args():
     parser.add_argument('in_file', default=None, nargs='?')
     parser.add_argument('decoder', default=None, nargs='?')
     parser.add_argument('out_file', default=None, nargs='?')
+    parser.add_argument('--domtblout', action='store_true',
+                        help='input is hmmsearch --domtblout table (default: --tblout)')
+    parser.add_argument('-E', '--evalue', default=None, type=float,
+                        help='report hits with full sequence E-value not higher than this')
+    parser.add_argument('-T', '--score', default=None, type=float,
+                        help='report hits with full sequence bit score not lower than this')
+    parser.add_argument('--best', default='kegg', choices=BEST_CHOICES,
+                        help='keep only the best hit per protein x KEGG (default), per protein or keep all hits')
     return parser.parse_args()
 
 
-def parse_hmm(hmm_data: str) -> list:
+def parse_hmm(hmm_data: str, domtblout: bool = False):
     """
-    reads hmmsearch results and convert it into tsv file
-    :param hmm_data: (str) path to hmmsearch results
-    :return: (list) of hmmsearch hits
+    reads hmmsearch results line by line
+    :param hmm_data: (str) path to hmmsearch --tblout or --domtblout results
+    :param domtblout: (bool) input is --domtblout table
+    :return: (generator) of Hit
     """
-    lines = []
+    target, query, evalue, score = DOMTBLOUT_FIELDS if domtblout else TBLOUT_FIELDS
     with open(hmm_data, 'r') as table:
         for line in table:
-            if not line.startswith('#'):
-                lines.append(line.strip().split())
-    entries = []
-    for line in lines:
-        entry = line[:18]
-        description = ' '.join(line[18:])
-        entry.append(description)
-        entries.append(entry)
-    return entries
+            if line.startswith('#') or not line.strip():
+                continue
+            entry = line.split(maxsplit=max(target, query, evalue, score) + 1)
+            yield Hit(entry[target], entry[query], entry[evalue], float(entry[score]))
+
+
+def filter_hits(hits, max_evalue: float = None, min_score: float = None):
+    """
+    :param hits: (iterable) of hits (see parse_hmm)
+    :param max_evalue: (float) maximal full sequence E-value
+    :param min_score: (float) minimal full sequence bit score
+    :return: (generator) of hits passing cutoffs
+    """
+    for hit in hits:
+        if max_evalue is not None and float(hit[2]) > max_evalue:
+            continue
+        if min_score is not None and hit[3] < min_score:
+            continue
+        yield hit
+
+
+def best_per_kegg(hits):
+    """
+    keeps the best hit of every protein x KEGG pair. hmmsearch writes hits of one profile together
+    (and domains of one protein one after another), so only the previous hit is kept in memory
+    :param hits: (iterable) of hits (see parse_hmm)
+    :return: (generator) of hits
+    """
+    best = None
+    for hit in hits:
+        if best is not None and hit[:2] == best[:2]:
+            if hit[3] > best[3]:
+                best = hit
+            continue
+        if best is not None:
+            yield best
+        best = hit
+    if best is not None:
+        yield best
+
+
+def best_per_protein(hits):
+    """
+    keeps the best hit of every protein over all profiles, holds one hit per protein
+    :param hits: (iterable) of hits (see parse_hmm)
+    :return: (generator) of hits in order of first protein appearance
+    """
+    best = {}
+    for hit in hits:
+        if hit[0] not in best or hit[3] > best[hit[0]][3]:
+            best[hit[0]] = hit
+    yield from best.values()
 
 
 def read_decoder(dec_path: str) -> dict:
@@ -53,42 +121,59 @@ def read_decoder(dec_path: str) -> dict:
     return kegg2gene
 
 
-def write_tsv(entries: list, out_path: str) -> None:
+def write_tsv(entries, out_path: str) -> int:
     """
-    writes entries into file in .tsv format (tab-separated table)
-    :param entries: (list) of filtered hmmsearch hits (see prettify_tsv)
+    writes entries into file in .tsv format (tab-separated table) as they come
+    :param entries: (iterable) of filtered hmmsearch hits (see prettify_tsv)
     :param out_path: (str) path to output file
-    :return: None
+    :return: (int) number of written entries
     """
+    written = 0
     with open(out_path, 'wt') as out_file:
         for entry in entries:
             out_file.write('\t'.join(entry))
             out_file.write('\n')
+            written += 1
+    return written
 
 
-def prettify_tsv(entries: list, decoder: dict) -> list:
+def prettify_tsv(entries, decoder: dict, missing: set = None):
     """
     adds gene names to table and removes "useless columns"
-    :param entries: (list) of hmmsearch hits
+    :param entries: (iterable) of hmmsearch hits
     :param decoder: (dict) of correspondence between kegg id (ex. K00973) and
      gene name (ex. rfbA) {kegg_id: gene_name}
-    :return: (list) of filtered hmmsearch hits
+    :param missing: (set) collects kegg ids absent from decoder, their gene name is "NA"
+    :return: (generator) of filtered hmmsearch hits
     """
-    filtered_entries = []
-    for entry in entries:
-        filtered_entry = [entry[0], entry[2], decoder[entry[2]], entry[4]]
-        filtered_entries.append(filtered_entry)
-    return filtered_entries
+    for target, kegg_id, evalue, _ in entries:
+        gene_name = decoder.get(kegg_id)
+        if gene_name is None:
+            gene_name = MISSING_GENE
+            if missing is not None:
+                missing.add(kegg_id)
+        yield [target, kegg_id, gene_name, evalue]
 
 
 if __name__ == '__main__':
     in_file = parse_args().in_file
     decoder_tsv = parse_args().decoder
     out_file = parse_args().out_file
+    domtblout = parse_args().domtblout
+    max_evalue = parse_args().evalue
+    min_score = parse_args().score
+    best = parse_args().best
 
     kegg2gene = read_decoder(dec_path=decoder_tsv)
 
-    hmms = parse_hmm(hmm_data=in_file)
-    hmms_prettified = prettify_tsv(entries=hmms, decoder=kegg2gene)
+    hmms = filter_hits(parse_hmm(hmm_data=in_file, domtblout=domtblout), max_evalue, min_score)
+    if best == 'kegg':
+        hmms = best_per_kegg(hmms)
+    elif best == 'protein':
+        hmms = best_per_protein(hmms)
+    missing_keggs = set()
+    hmms_prettified = prettify_tsv(entries=hmms, decoder=kegg2gene, missing=missing_keggs)
 
-    write_tsv(entries=hmms_prettified, out_path=out_file)
\ No newline at end of file
+    write_tsv(entries=hmms_prettified, out_path=out_file)
+    if missing_keggs:
+        print(f'KEGG ids absent from {decoder_tsv}: {", ".join(sorted(missing_keggs))}', file=sys.stderr)
@@ -1,10 +1,22 @@
 import os
 import sys
 import argparse
+import tempfile
+import numpy as np
 import pandas as pd
 import genomenotebook as gn
 from collections import defaultdict
+from multiprocessing import Pool
 from bokeh.models import Title
+from gffio import read_gff, write_gff
+
+
+FEATURE_TYPES = ['CDS', 'insertion_sequence']
+WINDOW_MARGIN = 1000
+
+# set once per worker process (see _init_worker), not sent with every operon
+_operons = None
+_output_dir = None
 
 
 def parse_args():
@@ -18,9 +30,103 @@ def parse_args():
                         help='O-antiigens operons table')
     parser.add_argument('-o', '--output', default='operons_imgs', nargs=1,
                         help='Output directory')
+    parser.add_argument('-t', '--threads', default=os.cpu_count(), type=int,
+                        help='Number of operons rendered at once')
     return parser.parse_args()
     
     
+def index_features(gff: pd.DataFrame) -> dict:
+    """
+    sorts features of every contig by start once, so features of any window are one slice
+    :param gff: (pandas.DataFrame) of gff features
+    :return: (dict) of (sorted features, their starts, longest feature length) by seq_id
+    """
+    index = {}
+    for seq_id, features in gff.groupby('seq_id', observed=True, sort=False):
+        features = features.sort_values('start', kind='stable')
+        index[seq_id] = (features, features['start'].to_numpy(),
+                         int((features['end'] - features['start']).max()) + 1)
+    return index
+
+
+def window_features(index: dict, seq_id: str, left: int, right: int) -> pd.DataFrame:
+    """
+    :param index: (dict) of sorted features by seq_id (see index_features)
+    :param seq_id: (str) contig
+    :param left: (int) window start
+    :param right: (int) window end
+    :return: (pandas.DataFrame) of features overlapping the window
+    """
+    features, starts, max_length = index[seq_id]
+    lo = np.searchsorted(starts, left - max_length, side='left')
+    hi = np.searchsorted(starts, right, side='left')
+    window = features.iloc[lo:hi]
+    return window[window['end'] > left]
+
+
+def _glyphs() -> dict:
+    glyphs = defaultdict()
+    glyphs["CDS"] = gn.Glyph(glyph_type="arrow", 
+                            colors="blue", 
+                            height=0.8, 
+                            show_name=True)
+    glyphs["insertion_sequence"] = gn.Glyph(glyph_type="arrow", 
+                            colors="red", 
+                            height=0.8, 
+                            show_name=True)
+    return glyphs
+
+
+def _init_worker(operons: pd.DataFrame, output_dir: str) -> None:
+    """
+    keeps the data shared by all operons in the worker process
+    :param operons: (pandas.DataFrame) of all operons, highlighted on every plot
+    :param output_dir: (str) output directory
+    """
+    global _operons, _output_dir
+    _operons, _output_dir = operons, output_dir
+
+
+def plot_operon(job) -> str:
+    """
+    renders one operon into svg. The browser reads a gff of the operon window only, not the whole annotation
+    :param job: (tuple) of operon row (pandas.Series), window features and operon genes
+    :return: (str) operon id
+    """
+    row, window, operon_genes_gff = job
+    n_genes = len(operon_genes_gff)
+    max_gene_name_len = operon_genes_gff.locus_tag.str.len().max()
+
+    with tempfile.NamedTemporaryFile('wt', suffix='.gff3', delete=False) as window_file:
+        window_gff = window_file.name
+    try:
+        write_gff(window, window_gff)
+        g=gn.GenomeBrowser(gff_path=window_gff, #genome_path=genome_path,
+                       glyphs=_glyphs(), 
+                       search = False,
+                       init_win = row.right + 3000 - row.left, 
+                       bounds = (row.left - WINDOW_MARGIN, row.right + WINDOW_MARGIN),
+                       feature_types= FEATURE_TYPES,
+                       height=int(50 + max_gene_name_len*13 + n_genes * 26),
+                       output_backend="svg",
+                       feature_height=0.1,
+                       attributes = ["locus_tag","product","start","end"], #will be displayed when hovering,
+                       title=f"Operon {row.operon}"
+                       )
+    finally:
+        os.remove(window_gff)
+    g.highlight(data=_operons, hover_data=['operon', 'N_genes'])
+    g.gene_track.title.align = 'center'
+    g.gene_track.title.text_font_size = "25px"
+
+    for gene_i, gene_row in operon_genes_gff.iterrows():
+        text = f'{gene_row.locus_tag}:  {gene_row["product"]}'
+        g.gene_track.add_layout(Title(text=text, text_font_size="9pt", text_font_style="normal"), 'below')
+        
+    g.save(os.path.join(_output_dir, f'{row.operon}.svg'))
+    return row.operon
+
+
 if __name__ == '__main__':
     gff_file = parse_args().gff[0]
     antigens_file = parse_args().antigens[0]
@@ -40,46 +146,25 @@ if __name__ == '__main__':
         print(f'Creating {output_dir} directory')
         os.makedirs(output_dir)
    
-    gff = gn.parse_gff(gff_file)
+    gff = read_gff(gff_file, attributes=['operon', 'locus_tag', 'product'])
     operons = pd.read_csv(antigens_file, sep='\t')
-    
-    glyphs = gn.get_default_glyphs()
-    glyphs = defaultdict()
-    glyphs["CDS"] = gn.Glyph(glyph_type="arrow", 
-                            colors="blue", 
-                            height=0.8, 
-                            show_name=True)
-    glyphs["insertion_sequence"] = gn.Glyph(glyph_type="arrow", 
-                            colors="red", 
-                            height=0.8, 
-                            show_name=True)
-    
-    for index, row in operons.iterrows():
-        operon_genes_gff = gff[gff.operon == str(row.operon)]
-        n_genes = len(operon_genes_gff)
-        max_gene_name_len = operon_genes_gff.locus_tag.str.len().max()
-        print(row.operon)
-        g=gn.GenomeBrowser(gff_path=gff_file, #genome_path=genome_path,
-                       glyphs=glyphs, 
-                       search = False,
-                       init_win = row.right + 3000 - row.left, 
-                       bounds = (row.left - 1000, row.right + 1000),
-                       feature_types= ['CDS', 'insertion_sequence'],
-                       height=int(50 + max_gene_name_len*13 + n_genes * 26),
-                       output_backend="svg",
-                       feature_height=0.1,
-                       attributes = ["locus_tag","product","start","end"], #will be displayed when hovering,
-                       title=f"Operon {row.operon}"
-                       )
-        g.highlight(data=operons, hover_data=['operon', 'N_genes'])
-        g.gene_track.title.align = 'center'
-        g.gene_track.title.text_font_size = "25px"
-
-        for gene_i, gene_row in operon_genes_gff.iterrows():
-            text = f'{gene_row.locus_tag}:  {gene_row["product"]}'
-            g.gene_track.add_layout(Title(text=text, text_font_size="9pt", text_font_style="normal"), 'below')
-            
-        g.save(os.path.join(output_dir, f'{row.operon}.svg'))
-        
+
+    index = index_features(gff[gff['type'].isin(FEATURE_TYPES)])
+    genes = {operon: operon_genes for operon, operon_genes in gff.groupby('operon', sort=False)}
+    default_seq_id = gff['seq_id'].iloc[0]
+
+    jobs = []
+    for _, row in operons.iterrows():
+        seq_id = row['chr'] if 'chr' in operons else default_seq_id
+        if seq_id in index:
+            window = window_features(index, seq_id, row.left - WINDOW_MARGIN, row.right + WINDOW_MARGIN)
+        else:
+            window = gff.iloc[:0]
+        jobs.append((row, window, genes.get(str(row.operon), gff.iloc[:0])))
+
+    with Pool(max(parse_args().threads, 1), initializer=_init_worker, initargs=(operons, output_dir)) as pool:
+        for operon in pool.imap_unordered(plot_operon, jobs):
+            print(operon)
+
     with open(os.path.join(output_dir, 'finished.txt'), 'w') as f:
         print('Done generating images!', file=f)
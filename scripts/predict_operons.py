@@ -0,0 +1,259 @@
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+from Bio.Seq import Seq
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from gffio import read_gff, write_gff
+
+
+# distance model fitted on the bundled E. coli OperonMapper output (data/operonmapper_output):
+# adjacent same-strand genes closer than ~40 bp are always operonic there, farther ones fade out
+DISTANCE_MIDPOINT = 70
+DISTANCE_SCALE = 25
+THRESHOLD = 0.5
+GENE_TYPES = 'CDS,tRNA,rRNA'
+START_CODONS = {'ATG', 'GTG', 'TTG'}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(usage='predict_operons.py -g GFF -f FASTA -o OUTPUT',
+                                     description='''Local operon prediction from gene coordinates, intergenic distance
+                                      and strand. Writes OperonMapper-like "list_of_operons",
+                                      "operonic_gene_pairs", "predicted_protein_sequences"
+                                      and "ORFs_coordinates" files.''')
+
+    parser.add_argument('-g', '--gff', default=None, nargs=1,
+                        help='Gene annotation (Prodigal or Bakta GFF)')
+    parser.add_argument('-f', '--fasta', default=None, nargs=1,
+                        help='Genome the annotation refers to')
+    parser.add_argument('-o', '--output', default=None, nargs=1,
+                        help='Output directory')
+    parser.add_argument('-t', '--types', default=GENE_TYPES, nargs='?',
+                        help=f'comma-separated feature types treated as genes (defaults to {GENE_TYPES})')
+    parser.add_argument('--midpoint', default=DISTANCE_MIDPOINT, type=float,
+                        help='intergenic distance with operon probability 0.5, bp')
+    parser.add_argument('--scale', default=DISTANCE_SCALE, type=float,
+                        help='steepness of the distance model, bp')
+    parser.add_argument('--threshold', default=THRESHOLD, type=float,
+                        help='minimal probability to join adjacent genes into one operon')
+    parser.add_argument('-b', '--benchmark', default=None, nargs='?',
+                        help='OperonMapper output directory to report agreement with')
+    return parser.parse_args()
+
+
+def read_genes(gff_path: str, types: list) -> pd.DataFrame:
+    """
+    reads genes sorted by position, gene id is taken from locus_tag or ID attribute
+    :param gff_path: (str) path to gff file
+    :param types: (list) of feature types treated as genes
+    :return: (pandas.DataFrame) of genes
+    """
+    genes = read_gff(gff_path, attributes=['locus_tag', 'ID', 'product'])
+    genes = genes[genes['type'].isin(types)]
+    genes['gene_id'] = genes['locus_tag'].fillna(genes['ID'])
+    return genes.sort_values(['seq_id', 'start'], kind='stable').reset_index(drop=True)
+
+
+def intergenic_distance(genes: pd.DataFrame) -> np.ndarray:
+    """
+    distances between adjacent genes in OperonMapper "Dist" convention: start of gene i + 1 minus end of gene i
+    :param genes: (pandas.DataFrame) of genes sorted by position
+    :return: (np.ndarray) of distances, bp
+    """
+    return genes['start'].to_numpy(dtype=np.int64)[1:] - genes['end'].to_numpy(dtype=np.int64)[:-1]
+
+
+def operon_probability(genes: pd.DataFrame, midpoint: float = DISTANCE_MIDPOINT,
+                       scale: float = DISTANCE_SCALE) -> np.ndarray:
+    """
+    scores every pair of adjacent genes at once
+    :param genes: (pandas.DataFrame) of genes sorted by position
+    :param midpoint: (float) intergenic distance with operon probability 0.5
+    :param scale: (float) steepness of the distance model
+    :return: (np.ndarray) of probabilities that gene i and gene i + 1 share an operon
+    """
+    seq_id = genes['seq_id'].astype(str).to_numpy()
+    strand = genes['strand'].astype(str).to_numpy()
+
+    distance = intergenic_distance(genes)
+    probability = 1 / (1 + np.exp(np.clip((distance - midpoint) / scale, -50, 50)))
+    same = (seq_id[1:] == seq_id[:-1]) & (strand[1:] == strand[:-1]) & np.isin(strand[1:], ['+', '-'])
+    return np.where(same, probability, 0.0)
+
+
+def assign_operons(genes: pd.DataFrame, probability: np.ndarray, threshold: float = THRESHOLD) -> pd.DataFrame:
+    """
+    numbers operons along the genome, a new operon starts where adjacent genes are not joined
+    :param genes: (pandas.DataFrame) of genes sorted by position
+    :param probability: (np.ndarray) of adjacent pairs probabilities (see operon_probability)
+    :param threshold: (float) minimal probability to join genes
+    :return: (pandas.DataFrame) of genes with "operon" column
+    """
+    starts_operon = np.concatenate(([True], probability < threshold))
+    genes['operon'] = np.cumsum(starts_operon)
+    return genes
+
+
+def translate_genes(genes: pd.DataFrame, fasta_path: str) -> list:
+    """
+    translates CDS features with bacterial genetic code
+    :param genes: (pandas.DataFrame) of genes
+    :param fasta_path: (str) path to genome
+    :return: (list) of tuples (gene_id, protein sequence)
+    """
+    cds = genes[genes['type'] == 'CDS']
+    by_seq = {seq_id: group for seq_id, group in cds.groupby('seq_id', observed=True, sort=False)}
+    proteins = []
+    with open(fasta_path) as fasta:
+        for title, seq in SimpleFastaParser(fasta):
+            group = by_seq.get(title.split(None, 1)[0])
+            if group is None:
+                continue
+            for gene_id, start, end, strand in zip(group['gene_id'], group['start'], group['end'], group['strand']):
+                nucleotides = Seq(seq[start - 1:end])
+                if strand == '-':
+                    nucleotides = nucleotides.reverse_complement()
+                nucleotides = nucleotides[:len(nucleotides) - len(nucleotides) % 3]
+                protein = str(nucleotides.translate(table=11))
+                if str(nucleotides[:3]).upper() in START_CODONS:
+                    protein = 'M' + protein[1:]
+                proteins.append((gene_id, protein))
+    return proteins
+
+
+def write_list_of_operons(genes: pd.DataFrame, out_path: str) -> None:
+    """
+    writes operons in OperonMapper "list_of_operons" layout: operon number line followed by its genes
+    :param genes: (pandas.DataFrame) of genes with "operon" column
+    :param out_path: (str) path to output file
+    :return: None
+    """
+    new_operon = genes['operon'].ne(genes['operon'].shift())
+    function = genes['product'].fillna('NA').str.replace('\t', ' ')
+    gene_lines = ('\t' + genes['gene_id'] + '\t' + genes['type'].astype(str) + '\tNA\t' +
+                  genes['start'].astype(str) + '\t' + genes['end'].astype(str) + '\t' +
+                  genes['strand'].astype(str) + '\t' + function)
+    lines = np.where(new_operon, genes['operon'].astype(str) + '\n', '') + gene_lines
+
+    with open(out_path, 'wt') as out_file:
+        out_file.write('Operon\tIdGene\tType\tCOGgene\tPosLeft\tpostRight\tStrand\tFunction\n')
+        out_file.write('\n'.join(lines))
+        out_file.write('\n')
+
+
+def write_gene_pairs(genes: pd.DataFrame, probability: np.ndarray, out_path: str,
+                     threshold: float = THRESHOLD) -> None:
+    """
+    writes scored adjacent same-strand pairs in OperonMapper "operonic_gene_pairs" layout
+    :param genes: (pandas.DataFrame) of genes sorted by position
+    :param probability: (np.ndarray) of adjacent pairs probabilities (see operon_probability)
+    :param out_path: (str) path to output file
+    :param threshold: (float) minimal probability of "Operon" class
+    :return: None
+    """
+    scored = probability > 0
+    pairs = pd.DataFrame({
+        'idGen1': genes['gene_id'].to_numpy()[:-1][scored],
+        'idGen2': genes['gene_id'].to_numpy()[1:][scored],
+        'COGgene1': 'NA',
+        'GOGgene2': 'NA',
+        'Dist': intergenic_distance(genes)[scored],
+        'STRING': 'NA',
+        'CLASS': np.where(probability[scored] >= threshold, 'Operon', 'noOperon'),
+        'Probability': probability[scored].round(2),
+    })
+    pairs.to_csv(out_path, sep='\t', index=False)
+
+
+def write_fasta(sequences_entries: list, out_fa_path: str) -> None:
+    """
+    writes entries into fasta file
+    :param sequences_entries: (list) of tuples: (seqid, sequence) to write
+    :param out_fa_path: (str) path to output file
+    :return: None
+    """
+    with open(out_fa_path, 'wt') as out_fa:
+        for line in sequences_entries:
+            out_fa.write(f'>{line[0]}\n{line[1]}\n')
+
+
+def read_reference_operons(list_path: str) -> pd.Series:
+    """
+    reads OperonMapper "list_of_operons" into operon number per gene id
+    :param list_path: (str) path to list_of_operons
+    :return: (pandas.Series) of operon numbers indexed by gene id
+    """
+    operons = pd.read_csv(list_path, sep='\t')
+    operons['Operon'] = operons['Operon'].ffill()
+    operons = operons[operons['IdGene'].notna()]
+    return pd.Series(operons['Operon'].to_numpy(), index=operons['IdGene'].str.strip())
+
+
+def benchmark(genes: pd.DataFrame, reference: pd.Series) -> dict:
+    """
+    compares predicted operons with reference ones on adjacent gene pairs and whole operons
+    :param genes: (pandas.DataFrame) of genes with "operon" column
+    :param reference: (pandas.Series) of reference operon numbers indexed by gene id
+    :return: (dict) of agreement statistics
+    """
+    genes = genes[genes['gene_id'].isin(reference.index)].reset_index(drop=True)
+    ref = genes['gene_id'].map(reference).to_numpy()
+    pred = genes['operon'].to_numpy()
+    same_seq = (genes['seq_id'].astype(str).to_numpy()[1:] == genes['seq_id'].astype(str).to_numpy()[:-1])
+
+    ref_joined = (ref[1:] == ref[:-1])[same_seq]
+    pred_joined = (pred[1:] == pred[:-1])[same_seq]
+    true_joined = (ref_joined & pred_joined).sum()
+
+    pred_sets = set(genes.groupby('operon')['gene_id'].agg(frozenset))
+    ref_sets = set(genes.groupby(ref)['gene_id'].agg(frozenset))
+
+    return {
+        'genes': len(genes),
+        'pairs': int(len(ref_joined)),
+        'pair_agreement': float((ref_joined == pred_joined).mean()),
+        'pair_precision': float(true_joined / max(pred_joined.sum(), 1)),
+        'pair_recall': float(true_joined / max(ref_joined.sum(), 1)),
+        'operons': len(ref_sets),
+        'exact_operons': float(len(pred_sets & ref_sets) / max(len(ref_sets), 1)),
+    }
+
+
+if __name__ == '__main__':
+    gff_file = parse_args().gff[0]
+    fasta_file = parse_args().fasta
+    output_dir = parse_args().output[0]
+    types = parse_args().types.split(',')
+    midpoint = parse_args().midpoint
+    scale = parse_args().scale
+    threshold = parse_args().threshold
+    benchmark_dir = parse_args().benchmark
+
+    if not os.path.isfile(gff_file):
+        print('GFF file not found')
+        sys.exit(1)
+    if fasta_file is not None and not os.path.isfile(fasta_file[0]):
+        print('FASTA file not found')
+        sys.exit(1)
+    os.makedirs(output_dir, exist_ok=True)
+
+    genes = read_genes(gff_file, types)
+    probability = operon_probability(genes, midpoint, scale)
+    genes = assign_operons(genes, probability, threshold)
+
+    write_list_of_operons(genes, os.path.join(output_dir, 'list_of_operons'))
+    write_gene_pairs(genes, probability, os.path.join(output_dir, 'operonic_gene_pairs'), threshold)
+    orfs = genes.copy()
+    orfs['attributes'] = 'ID=' + orfs['gene_id']
+    write_gff(orfs, os.path.join(output_dir, 'ORFs_coordinates'), header=False)
+    if fasta_file is not None:
+        proteins = translate_genes(genes, fasta_file[0])
+        write_fasta(proteins, os.path.join(output_dir, 'predicted_protein_sequences'))
+    print(f'{genes["operon"].nunique()} operons of {len(genes)} genes written to', output_dir)
+
+    if benchmark_dir:
+        reference = read_reference_operons(os.path.join(benchmark_dir, 'list_of_operons'))
+        for name, value in benchmark(genes, reference).items():
+            print(f'{name}\t{value:.4f}' if isinstance(value, float) else f'{name}\t{value}')
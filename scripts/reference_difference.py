@@ -1,45 +1,169 @@
 import os
 import sys
 import argparse
+import numpy as np
 import pandas as pd
+from gffio import read_gff
+
+
+DIFFERENCE_COLUMNS = ['operon', 'status', 'seq_id', 'strand', 'ref_start', 'ref_end', 'tool_start', 'tool_end',
+                      'attributes']
+SUMMARY_COLUMNS = ['operon', 'seq_id', 'left', 'right', 'ref_genes', 'tool_genes', 'matched', 'shifted',
+                   'missing', 'extra', 'recall', 'precision']
+BATCH_COLUMNS = ['genome', 'reference', 'gff', 'antigens']
+TOTAL = 'total'
+
 
 def parse_args():
-    parser = argparse.ArgumentParser(usage='reference_difference.py -r REFERENCE -g GFF -a ANTIGENS -o OUTPUT',
-                                     description='''Searches for the reference genes that are absent in the found operons.''')
+    parser = argparse.ArgumentParser(usage='reference_difference.py -r REFERENCE -g GFF -a ANTIGENS -o OUTPUT\n'
+                                           '       reference_difference.py -b BATCH -o OUTPUT',
+                                     description='''Compares genes of the found operons with the reference
+                                     annotation: reference genes absent from the tool annotation (missing),
+                                     tool genes absent from the reference (extra) and genes sharing only one
+                                     boundary (shifted), with recall and precision per operon.''')
 
     parser.add_argument('-r', '--reference', default=None, nargs=1,
-                        help='Reference genome annotation')
+                        help='Reference genome annotation (may be gzipped)')
     parser.add_argument('-g', '--gff', default=None, nargs=1,
-                        help='GFF with results of O-antigen search (all steps)')
+                        help='GFF with results of O-antigen search (all steps, may be gzipped)')
     parser.add_argument('-a', '--antigens', default=None, nargs=1,
 					    help='O-antiigens operons table')
+    parser.add_argument('-b', '--batch', default=None, nargs=1,
+                        help=f'tsv with {", ".join(BATCH_COLUMNS)} columns, one genome/reference pair per line, '
+                             f'instead of -r, -g and -a')
+    parser.add_argument('-t', '--types', default=None, nargs='+',
+                        help='Feature types of the reference to compare (default: all)')
     parser.add_argument('-o', '--output', default=None, nargs=1,
-                        help='Output GFF filename')
+                        help='Output tsv filename')
+    parser.add_argument('-s', '--summary', default=None, nargs=1,
+                        help='Per-operon recall/precision tsv filename (default: OUTPUT_summary.tsv)')
     return parser.parse_args()
 
-def read_gff(path_to_gff):
-    """ function to read the .gff file """
-    column_names=["chromosome","source","type","start","end","score","strand","phase","attributes"] # set the column names
-    gff_data = pd.read_csv(path_to_gff, sep='\t', names=column_names) # read the file
-    gff_data = gff_data[gff_data.chromosome.str.startswith("#") == False] # skip the commented lines
-    gff_data = gff_data.astype({'start': 'int', 'end': 'int'}) # set the int type for start and end
-    return gff_data.reset_index(drop=True) # reset index so that after commentaries skipping indexation will be ok
-    
+
+def read_operons(antigens_path: str) -> pd.DataFrame:
+    """
+    :param antigens_path: (str) path to operons table (see extract_operons_from_operonmapper.py)
+    :return: (pandas.DataFrame) with operon, seq_id, left and right columns
+    """
+    operons = pd.read_csv(antigens_path, sep='\t', dtype={'operon': 'str', 'chr': 'str'})
+    return operons.rename(columns={'chr': 'seq_id'})[['operon', 'seq_id', 'left', 'right']]
+
+
+def read_features(gff_path: str, types: list = None) -> pd.DataFrame:
+    """
+    reads gff features, one per unique (seq_id, start, end)
+    :param gff_path: (str) path to gff file (may be gzipped)
+    :param types: (list) of feature types to keep, None keeps all
+    :return: (pandas.DataFrame) with seq_id, start, end, strand and attributes columns
+    """
+    features = read_gff(gff_path, columns=['seq_id', 'type', 'start', 'end', 'strand', 'attributes'],
+                        categorical=False)
+    if types is not None:
+        features = features[features['type'].isin(types)]
+    features = features.drop_duplicates(['seq_id', 'start', 'end'])
+    return features[['seq_id', 'start', 'end', 'strand', 'attributes']].reset_index(drop=True)
+
+
+def genes_in_operons(features: pd.DataFrame, operons: pd.DataFrame) -> pd.DataFrame:
+    """
+    finds features lying within operons. Feature starts are sorted once by (contig, start), the features of
+    every operon are one slice of it found with searchsorted
+    :param features: (pandas.DataFrame) with seq_id, start and end columns
+    :param operons: (pandas.DataFrame) with operon, seq_id, left and right columns
+    :return: (pandas.DataFrame) of features with operon column, a feature appears once per operon it lies in
+    """
+    contigs, _ = pd.factorize(pd.concat([features['seq_id'], operons['seq_id']], ignore_index=True).astype(str))
+    feature_contig, operon_contig = contigs[:len(features)], contigs[len(features):]
+    span = int(max(features['end'].max(), operons['right'].max(), 0)) + 1 if len(features) and len(operons) else 1
+
+    key = feature_contig * span + features['start'].to_numpy(dtype=np.int64)
+    order = np.argsort(key, kind='stable')
+    lo = np.searchsorted(key[order], operon_contig * span + operons['left'].to_numpy(dtype=np.int64), side='left')
+    hi = np.searchsorted(key[order], operon_contig * span + operons['right'].to_numpy(dtype=np.int64), side='right')
+    counts = hi - lo
+
+    operon_idx = np.repeat(np.arange(len(operons)), counts)
+    feature_idx = order[np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                                                    counts)]
+    inside = features['end'].to_numpy()[feature_idx] <= operons['right'].to_numpy()[operon_idx]
+
+    genes = features.iloc[feature_idx[inside]].reset_index(drop=True)
+    genes.insert(0, 'operon', operons['operon'].to_numpy()[operon_idx[inside]])
+    return genes
+
+
+def _pair(genes: pd.DataFrame, other: pd.DataFrame, on: list) -> pd.Series:
+    """
+    :return: (pandas.Series) of index of the first feature of other sharing columns on with every gene, -1 if none
+    """
+    other = other[on].drop_duplicates(on).reset_index(names='other')
+    return genes[on].merge(other, on=on, how='left')['other'].fillna(-1).astype(int)
+
+
+def compare(reference: pd.DataFrame, tool: pd.DataFrame, operons: pd.DataFrame) -> tuple:
+    """
+    classifies reference and tool genes of every operon
+    matched: same seq_id, start and end in both annotations
+    shifted: reference gene without exact match sharing start or end with a tool gene (ex. other start codon)
+    missing: other reference genes, extra: tool genes that are neither matched nor shifted
+    :param reference: (pandas.DataFrame) of reference features (see read_features)
+    :param tool: (pandas.DataFrame) of tool features (see read_features)
+    :param operons: (pandas.DataFrame) of operons (see read_operons)
+    :return: (tuple) of differences (pandas.DataFrame) and per-operon summary (pandas.DataFrame)
+    """
+    ref_genes = genes_in_operons(reference, operons)
+    tool_genes = genes_in_operons(tool, operons)
+
+    exact = _pair(ref_genes, tool, ['seq_id', 'start', 'end'])
+    by_start = _pair(ref_genes, tool, ['seq_id', 'start'])
+    by_end = _pair(ref_genes, tool, ['seq_id', 'end'])
+    shifted_to = by_start.where(by_start >= 0, by_end).where(exact < 0, -1)
+
+    ref_genes['status'] = np.select([exact >= 0, shifted_to >= 0], ['matched', 'shifted'], 'missing')
+    ref_genes['tool_start'] = tool['start'].reindex(shifted_to).to_numpy()
+    ref_genes['tool_end'] = tool['end'].reindex(shifted_to).to_numpy()
+
+    paired = set(exact[exact >= 0]) | set(shifted_to[shifted_to >= 0])
+    tool_idx = _pair(tool_genes, tool, ['seq_id', 'start', 'end'])
+    extra = tool_genes[~tool_idx.isin(paired).to_numpy()].copy()
+    extra['status'] = 'extra'
+
+    differences = pd.concat([
+        ref_genes[ref_genes['status'] != 'matched'].rename(columns={'start': 'ref_start', 'end': 'ref_end'}),
+        extra.rename(columns={'start': 'tool_start', 'end': 'tool_end'})
+    ], ignore_index=True)
+    differences = differences.sort_values(['operon', 'seq_id', 'ref_start', 'tool_start'], kind='stable')
+    differences = differences[DIFFERENCE_COLUMNS].astype({column: 'Int64' for column in DIFFERENCE_COLUMNS[4:8]})
+
+    summary = operons.set_index('operon')
+    summary['ref_genes'] = ref_genes.groupby('operon').size()
+    summary['tool_genes'] = tool_genes.groupby('operon').size()
+    for status, genes in (('matched', ref_genes), ('shifted', ref_genes), ('missing', ref_genes),
+                          ('extra', extra)):
+        summary[status] = genes[genes['status'] == status].groupby('operon').size()
+    summary = summary.fillna(0).astype({column: int for column in SUMMARY_COLUMNS[4:10]}).reset_index()
+    total = summary[SUMMARY_COLUMNS[4:10]].sum().to_frame().T
+    total['operon'] = TOTAL
+    summary = pd.concat([summary, total], ignore_index=True).astype({'left': 'Int64', 'right': 'Int64'})
+    summary['recall'] = (summary['matched'] / summary['ref_genes']).round(4)
+    summary['precision'] = (summary['matched'] / summary['tool_genes']).round(4)
+    return differences, summary[SUMMARY_COLUMNS]
+
+
+def compare_files(reference_file: str, gff_file: str, antigens_file: str, types: list = None) -> tuple:
+    """
+    :return: (tuple) of differences and summary (see compare) of one genome/reference pair
+    """
+    for path, name in ((reference_file, 'Reference'), (gff_file, 'GFF'), (antigens_file, 'O-antigens')):
+        if not os.path.isfile(path):
+            print(f'{name} file {path} not found')
+            sys.exit(1)
+    return compare(read_features(reference_file, types), read_features(gff_file), read_operons(antigens_file))
+
+
 if __name__ == '__main__':
-    reference_file = parse_args().reference[0]
-    gff_file = parse_args().gff[0]
-    antigens_file = parse_args().antigens[0]
-    output_file = parse_args().output
-
-    if not os.path.isfile(reference_file):
-        print('Reference file not found')
-        sys.exit(1)
-    if not os.path.isfile(gff_file):
-        print('GFF file not found')
-        sys.exit(1)
-    if not os.path.isfile(antigens_file):
-        print('O-antigens file not found')
-        sys.exit(1)
+    args = parse_args()
+    output_file = args.output
 
     if output_file is None:
         output_file = 'ref_tool_difference.tsv'
@@ -47,35 +171,22 @@ if __name__ == '__main__':
         output_file = output_file[0]
         if not output_file.endswith('.tsv'):
             output_file = output_file + '.tsv'
-            
-    if reference_file.endswith('.gz'):
-    	print('Reference file should not be gzipped')
-        sys.exit(1)
-    
-	# annotations and operon coordinates upload
-	ref_annotation = read_gff(reference_file)
-	tool_annotation = pd.read_csv(gff_file, sep="\t")
-	operons = pd.read_csv(antigens_file, sep="\t")\
-		.rename(columns={"chr": "chromosome"})
-
-	# o-antigen operons genes from reference annotation
-	ref_annot_genes = operons\
-		.merge(ref_annotation, left_on='chromosome', right_on='chromosome')\
-		.query('start_x <= start_y and end_x >= end_y')\
-		.drop([
-		"start_x", "end_x", "strand_x", "strand_y", "type_y", "color"
-		], axis=1)
-
-	# filtering by not matching coordinates
-	coords = list(set(zip(ref_annot_genes.start_y, ref_annot_genes.end_y))\
-			  .difference(set(zip(tool_annotation.start, tool_annotation.end))))
-	filter_conditions = pd.Series([False] * len(ref_annot_genes), index=ref_annot_genes.index)
-
-	for start, end in coords:
-		filter_conditions |= ((ref_annot_genes.start_y == start) & (ref_annot_genes.end_y == end))
-
-	ref_tool_difference = ref_annot_genes[filter_conditions][['chromosome', 'source', 'start_y', 'end_y', 
-			                                              'score', 'phase', 'attributes']]\
-		.rename(columns={"start_y": "start", "end_y": "end"})
-		
-	ref_tool_difference.to_csv(output_file, sep='\t', index=False, header=False)
+    summary_file = args.summary[0] if args.summary else os.path.splitext(output_file)[0] + '_summary.tsv'
+
+    if args.batch is not None:
+        pairs = pd.read_csv(args.batch[0], sep='\t', dtype=str)
+        differences, summaries = [], []
+        for genome, reference_file, gff_file, antigens_file in pairs[BATCH_COLUMNS].itertuples(index=False):
+            difference, summary = compare_files(reference_file, gff_file, antigens_file, args.types)
+            differences.append(difference.assign(genome=genome))
+            summaries.append(summary.assign(genome=genome))
+        differences = pd.concat(differences, ignore_index=True)[['genome'] + DIFFERENCE_COLUMNS]
+        summaries = pd.concat(summaries, ignore_index=True)[['genome'] + SUMMARY_COLUMNS]
+    else:
+        if args.reference is None or args.gff is None or args.antigens is None:
+            print('Give -r, -g and -a or a batch table (-b)')
+            sys.exit(1)
+        differences, summaries = compare_files(args.reference[0], args.gff[0], args.antigens[0], args.types)
+
+    differences.to_csv(output_file, sep='\t', index=False)
+    summaries.to_csv(summary_file, sep='\t', index=False)
@@ -0,0 +1,281 @@
+"""
+Compact restore file for transposon cut/rebuild.
+
+One file per genome holds, for every contig, the excised insertions
+(2-bit packed sequences, int coordinates and deltas, score strings as
+they were in the GFF and strand) and the MD5 of the original contig. Contig blocks are optionally
+zlib-compressed and an index at the end of the file lets a reader
+seek straight to one contig.
+
+Layout:
+    MAGIC | compression (u1) | block ... | index | index offset (u8) | MAGIC
+"""
+import io
+import zlib
+import struct
+import numpy as np
+import pandas as pd
+
+
+MAGIC = b'WOOFRST\x02'
+MAGIC_V1 = b'WOOFRST\x01'  # scores stored as float64, read only
+RESTORE_COLUMNS = ['insert_index', 'insertion', 'delta', 'score', 'strand']
+NO_COMPRESSION, ZLIB = 0, 1
+
+STRANDS = {'+': 1, '-': -1}
+STRAND_CODES = {1: '+', -1: '-', 0: '.'}
+INDEX_ENTRY = struct.Struct('<QQIQ16s')  # offset, size, insertions, clean length, md5
+
+_CODES = np.full(256, 255, dtype=np.uint8)
+for _code, _base in enumerate(b'ACGT'):
+    _CODES[_base] = _code
+_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def _runs(mask: np.ndarray, values: np.ndarray = None) -> tuple:
+    """
+    finds runs of True in mask, a run also breaks where values change
+    :return: (tuple) of run starts and run ends
+    """
+    first = mask.copy()
+    last = mask.copy()
+    first[1:] &= ~mask[:-1]
+    last[:-1] &= ~mask[1:]
+    if values is not None:
+        change = values[1:] != values[:-1]
+        first[1:] |= mask[1:] & change
+        last[:-1] |= mask[:-1] & change
+    return np.flatnonzero(first), np.flatnonzero(last) + 1
+
+
+def pack_sequence(seq: bytes) -> tuple:
+    """
+    packs nucleotide sequence into 2 bits per base.
+    Lowercase stretches and non-ACGT letters are stored as runs
+    :param seq: (bytes) sequence
+    :return: (tuple) of packed bytes, lowercase runs, exception runs and exception letters
+    """
+    raw = np.frombuffer(seq, dtype=np.uint8)
+    lower = (raw >= ord('a')) & (raw <= ord('z'))
+    upper = np.where(lower, raw - 32, raw).astype(np.uint8)
+    codes = _CODES[upper]
+    exceptions = codes == 255
+
+    lower_runs = np.stack(_runs(lower)).astype(np.uint32)
+    exc_starts, exc_ends = _runs(exceptions, upper)
+    exc_runs = np.stack((exc_starts, exc_ends)).astype(np.uint32)
+    exc_letters = upper[exc_starts]
+
+    codes = np.where(exceptions, 0, codes)
+    codes = np.concatenate((codes, np.zeros(-len(codes) % 4, dtype=np.uint8)))
+    packed = (codes[0::4] << 6) | (codes[1::4] << 4) | (codes[2::4] << 2) | codes[3::4]
+    return packed.astype(np.uint8).tobytes(), lower_runs, exc_runs, exc_letters
+
+
+def unpack_sequence(packed: bytes, length: int, lower_runs: np.ndarray,
+                    exc_runs: np.ndarray, exc_letters: np.ndarray) -> bytes:
+    """
+    reverses pack_sequence
+    :return: (bytes) sequence
+    """
+    packed = np.frombuffer(packed, dtype=np.uint8)
+    codes = np.stack((packed >> 6, (packed >> 4) & 3, (packed >> 2) & 3, packed & 3), axis=1).ravel()
+    seq = _BASES[codes[:length]]
+    for (start, end), letter in zip(exc_runs.T, exc_letters):
+        seq[start:end] = letter
+    for start, end in lower_runs.T:
+        seq[start:end] += 32
+    return seq.tobytes()
+
+
+def _encode_block(deletions: list) -> bytes:
+    insert_index = np.array([d[0] for d in deletions], dtype=np.uint32)
+    delta = np.array([d[2] for d in deletions], dtype=np.uint32)
+    lengths = np.array([len(d[1]) for d in deletions], dtype=np.uint32)
+    scores = [str(d[3]).encode() if not pd.isna(d[3]) else b'.' for d in deletions]
+    score_lengths = np.array([len(score) for score in scores], dtype=np.uint32)
+    strand = np.array([STRANDS.get(d[4], 0) for d in deletions], dtype=np.int8)
+    packed, lower_runs, exc_runs, exc_letters = pack_sequence(''.join(d[1] for d in deletions).encode())
+
+    out = io.BytesIO()
+    out.write(struct.pack('<III', len(deletions), lower_runs.shape[1], exc_runs.shape[1]))
+    for array in (insert_index, delta, lengths, score_lengths, strand,
+                  lower_runs, exc_runs, exc_letters.astype(np.uint8)):
+        out.write(np.ascontiguousarray(array).tobytes())
+    out.write(b''.join(scores))
+    out.write(packed)
+    return out.getvalue()
+
+
+def _decode_block(block: bytes, version: bytes = MAGIC) -> pd.DataFrame:
+    n, n_lower, n_exc = struct.unpack_from('<III', block)
+    offset = struct.calcsize('<III')
+
+    def take(dtype, count, shape=None):
+        nonlocal offset
+        array = np.frombuffer(block, dtype=dtype, count=count, offset=offset)
+        offset += array.nbytes
+        return array if shape is None else array.reshape(shape)
+
+    insert_index = take('<u4', n)
+    delta = take('<u4', n)
+    lengths = take('<u4', n)
+    score_fields = take('<f8' if version == MAGIC_V1 else '<u4', n)
+    strand = take('i1', n)
+    lower_runs = take('<u4', 2 * n_lower, (2, n_lower))
+    exc_runs = take('<u4', 2 * n_exc, (2, n_exc))
+    exc_letters = take('u1', n_exc)
+
+    if version == MAGIC_V1:
+        scores = ['.' if np.isnan(s) else np.format_float_positional(s, trim='-') for s in score_fields]
+    else:
+        score_ends = np.cumsum(score_fields, dtype=np.int64)
+        score_bytes = block[offset:offset + (int(score_ends[-1]) if n else 0)]
+        offset += len(score_bytes)
+        scores = [score_bytes[end - length:end].decode() for length, end in zip(score_fields, score_ends)]
+
+    ends = np.cumsum(lengths, dtype=np.int64)
+    seq = unpack_sequence(block[offset:], int(ends[-1]) if n else 0, lower_runs, exc_runs, exc_letters).decode()
+    starts = ends - lengths
+
+    return pd.DataFrame({
+        'insert_index': insert_index.astype(np.int64),
+        'insertion': pd.Series([seq[s:e] for s, e in zip(starts, ends)], dtype=object),
+        'delta': delta.astype(np.int64),
+        'score': pd.Series(scores, dtype=object),
+        'strand': pd.Series([STRAND_CODES[s] for s in strand], dtype=object),
+    }, columns=RESTORE_COLUMNS)
+
+
+class RestoreWriter:
+    """
+    Writes restore file contig by contig
+    """
+
+    def __init__(self, path: str, compress: bool = False):
+        self.file = open(path, 'wb')
+        self.compression = ZLIB if compress else NO_COMPRESSION
+        self.index = {}
+        self.file.write(MAGIC + struct.pack('<B', self.compression))
+
+    def add(self, seq_id: str, deletions: list, clean_length: int, checksum: str) -> None:
+        """
+        :param seq_id: (str) contig id
+        :param deletions: (list) of (new index, removed string, delta_at_current_pos, score, strand)
+        :param clean_length: (int) length of transposon-free contig
+        :param checksum: (str) hex MD5 of original contig
+        """
+        block = _encode_block(deletions)
+        if self.compression == ZLIB:
+            block = zlib.compress(block)
+        self.index[seq_id] = (self.file.tell(), len(block), len(deletions),
+                              clean_length, bytes.fromhex(checksum))
+        self.file.write(block)
+
+    def close(self) -> None:
+        index_offset = self.file.tell()
+        self.file.write(struct.pack('<I', len(self.index)))
+        for seq_id, entry in self.index.items():
+            name = seq_id.encode()
+            self.file.write(struct.pack('<H', len(name)) + name + INDEX_ENTRY.pack(*entry))
+        self.file.write(struct.pack('<Q', index_offset) + MAGIC)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RestoreReader:
+    """
+    Reads restore file, only the index is loaded on open
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        self.version = self.file.read(len(MAGIC))
+        if self.version not in (MAGIC, MAGIC_V1):
+            raise ValueError(f'{path} is not a restore file')
+        self.compression, = struct.unpack('<B', self.file.read(1))
+
+        self.file.seek(-(8 + len(MAGIC)), io.SEEK_END)
+        index_offset, = struct.unpack('<Q', self.file.read(8))
+        self.file.seek(index_offset)
+        data = self.file.read()
+
+        self.index = {}
+        count, = struct.unpack_from('<I', data)
+        offset = 4
+        for _ in range(count):
+            size, = struct.unpack_from('<H', data, offset)
+            seq_id = data[offset + 2:offset + 2 + size].decode()
+            offset += 2 + size
+            self.index[seq_id] = INDEX_ENTRY.unpack_from(data, offset)
+            offset += INDEX_ENTRY.size
+
+    @property
+    def seq_ids(self) -> list:
+        return list(self.index)
+
+    def checksum(self, seq_id: str) -> str:
+        return self.index[seq_id][4].hex()
+
+    def clean_length(self, seq_id: str) -> int:
+        return self.index[seq_id][3]
+
+    def read(self, seq_id: str) -> pd.DataFrame:
+        """
+        reads restore data of one contig
+        :param seq_id: (str) contig id
+        :return: (pandas.DataFrame) with RESTORE_COLUMNS
+        """
+        offset, size, *_ = self.index[seq_id]
+        self.file.seek(offset)
+        block = self.file.read(size)
+        if self.compression == ZLIB:
+            block = zlib.decompress(block)
+        return _decode_block(block, self.version)
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def is_restore_file(path: str) -> bool:
+    with open(path, 'rb') as file:
+        return file.read(len(MAGIC)) in (MAGIC, MAGIC_V1)
+
+
+def read_restore(path: str, seq_id: str) -> pd.DataFrame:
+    """
+    reads restore data of one contig from restore file or legacy csv
+    :param path: (str) path to restore file or `<output>_<seq_id>.rebuild.csv`
+    :param seq_id: (str) contig id
+    :return: (pandas.DataFrame) with RESTORE_COLUMNS
+    """
+    if is_restore_file(path):
+        with RestoreReader(path) as reader:
+            return reader.read(seq_id)
+    try:
+        return pd.read_csv(path, names=RESTORE_COLUMNS, dtype={'insertion': str, 'score': str, 'strand': str})
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame(columns=RESTORE_COLUMNS)
+
+
+def write_csv(restore: pd.DataFrame, out_path: str) -> None:
+    """
+    writes restore data of one contig in legacy csv format
+    :param restore: (pandas.DataFrame) with RESTORE_COLUMNS
+    :param out_path: (str) path to output file
+    :return: None
+    """
+    with open(out_path, 'w') as out:
+        for idx, insertion, delta, score, strand in restore[RESTORE_COLUMNS].itertuples(index=False):
+            print(f"{idx},{insertion},{delta},{score},{strand}", file=out)
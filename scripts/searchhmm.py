@@ -0,0 +1,338 @@
+"""
+In-process HMM search of proteomes with pyhmmer.
+
+Profiles are loaded and optimized once (from the hmmpress database next to
+the .hmm file when it is there and up to date) and then every proteome is
+searched on all cores. Hits go straight to the parsehmm reduction and KEGG
+decoding, no text table is parsed back. Proteome paths can be given on the
+command line or streamed on stdin, so one process serves many genomes.
+With --prefilter only proteins shortlisted by the k-mer index (see
+kmerfilter.py) are searched, E-values still refer to the whole proteome.
+With --cohort all proteomes go into one search: identical proteins are
+searched once (and with --store never again, see hitstore.py) and hits are
+fanned back out to every protein of every genome carrying the sequence, with
+E-values of the genome's own search, so the tsv files are the same as of one
+search per genome.
+"""
+import os
+import sys
+import argparse
+from parsehmm import Hit, filter_hits, best_per_kegg, best_per_protein, read_decoder, prettify_tsv, write_tsv, \
+    BEST_CHOICES
+from kmerfilter import load_index, shortlist, MIN_SHARED
+from hitstore import HitStore, STORE_PVALUE, sequence_hash, profile_keys, demultiplex, max_pvalue
+
+import pyhmmer
+from pyhmmer.easel import Alphabet, SequenceFile, TextSequence, TextSequenceBlock
+from pyhmmer.plan7 import HMMFile, Background, Profile
+
+
+PRESSED_SUFFIXES = ('.h3m', '.h3i', '.h3f', '.h3p')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=
+                                     """Part of finding domains using hmms pipeline.
+                                     Searches proteomes with HMM profiles in-process and writes
+                                     the same tsv as parsehmm.py.
+                                     """
+                                     )
+    parser.add_argument('hmms', help='HMM profiles (.hmm, pressed database is used if present)')
+    parser.add_argument('decoder', help='tsv table of kegg id to gene name correspondence')
+    parser.add_argument('proteomes', nargs='*',
+                        help='proteome fasta files as PATH or NAME=PATH (read from stdin one per line if omitted), '
+                             'output is named after NAME or file name')
+    parser.add_argument('-o', '--output', default=None,
+                        help='output tsv (single proteome)')
+    parser.add_argument('--out-dir', default=None,
+                        help='output directory, writes <proteome name>.tsv for every proteome')
+    parser.add_argument('--tblout', default=None,
+                        help='also write hmmsearch-like --tblout table (single proteome)')
+    parser.add_argument('-E', '--evalue', default=10.0, type=float,
+                        help='report hits with full sequence E-value not higher than this')
+    parser.add_argument('--domE', default=10.0, type=float,
+                        help='report domains with E-value not higher than this')
+    parser.add_argument('-T', '--score', default=None, type=float,
+                        help='report hits with full sequence bit score not lower than this')
+    parser.add_argument('--best', default='kegg', choices=BEST_CHOICES,
+                        help='keep only the best hit per protein x KEGG (default), per protein or keep all hits')
+    parser.add_argument('--press', action='store_true',
+                        help='press profiles into binary database next to .hmm file for faster loading')
+    parser.add_argument('--prefilter', default=None,
+                        help='k-mer index (see kmerfilter.py build), search only shortlisted proteins')
+    parser.add_argument('--min-shared', default=MIN_SHARED, type=int,
+                        help='minimal number of k-mers shared with the prefilter index')
+    parser.add_argument('--cohort', action='store_true',
+                        help='search unique proteins of all proteomes at once and demultiplex hits into --out-dir')
+    parser.add_argument('--store', default=None,
+                        help='sqlite store of hits (--cohort), only profile x protein pairs missing from it are '
+                             'searched, created if absent')
+    parser.add_argument('--cpu', default=0, type=int,
+                        help='number of threads, 0 is all cores')
+    return parser.parse_args()
+
+
+def _is_pressed(hmm_path: str) -> bool:
+    mtime = os.path.getmtime(hmm_path)
+    return all(os.path.isfile(hmm_path + suffix) and os.path.getmtime(hmm_path + suffix) >= mtime
+               for suffix in PRESSED_SUFFIXES)
+
+
+def press_profiles(hmm_path: str) -> None:
+    """
+    writes hmmpress database (<hmm_path>.h3m/.h3i/.h3f/.h3p) unless an up to date one exists
+    :param hmm_path: (str) path to .hmm file
+    :return: None
+    """
+    if _is_pressed(hmm_path):
+        return
+    for suffix in PRESSED_SUFFIXES:
+        if os.path.exists(hmm_path + suffix):
+            os.remove(hmm_path + suffix)
+    with HMMFile(hmm_path, db=False) as hmm_file:
+        pyhmmer.hmmer.hmmpress(hmm_file, hmm_path)
+
+
+def load_profiles(hmm_path: str) -> list:
+    """
+    loads optimized profiles, from pressed database if it is up to date
+    :param hmm_path: (str) path to .hmm file
+    :return: (list) of pyhmmer.plan7.OptimizedProfile
+    """
+    pressed = _is_pressed(hmm_path)
+    with HMMFile(hmm_path, db=pressed) as hmm_file:
+        if pressed and hmm_file.is_pressed():
+            return list(hmm_file.optimized_profiles())
+        hmms = list(hmm_file)
+
+    profiles = []
+    for hmm in hmms:
+        profile = Profile(hmm.M, hmm.alphabet)
+        profile.configure(hmm, Background(hmm.alphabet))
+        profiles.append(profile.to_optimized())
+    return profiles
+
+
+def read_proteome(fasta_path: str, alphabet: Alphabet = None, prefilter: tuple = None,
+                  min_shared: int = MIN_SHARED) -> tuple:
+    """
+    :param fasta_path: (str) path to proteome fasta
+    :param alphabet: (pyhmmer.easel.Alphabet) sequence alphabet
+    :param prefilter: (tuple) of k-mer index, k and alphabet (see kmerfilter.load_index)
+    :param min_shared: (int) minimal number of k-mers shared with prefilter index
+    :return: (tuple) of pyhmmer.easel.DigitalSequenceBlock of (shortlisted) proteins
+     and total number of proteins
+    """
+    proteins, total = _read_text(fasta_path, prefilter, min_shared)
+    return proteins.digitize(alphabet or Alphabet.amino()), total
+
+
+def _read_text(fasta_path: str, prefilter: tuple = None, min_shared: int = MIN_SHARED) -> tuple:
+    with SequenceFile(fasta_path, digital=False) as seq_file:
+        proteins = seq_file.read_block()
+    total = len(proteins)
+    if prefilter is not None:
+        index, k, kmer_alphabet = prefilter
+        passed = shortlist([protein.sequence for protein in proteins], index, k, kmer_alphabet, min_shared)
+        proteins = TextSequenceBlock(protein for protein, keep in zip(proteins, passed) if keep)
+    return proteins, total
+
+
+def search(profiles: list, proteins, cpus: int = 0, evalue: float = 10.0, dom_evalue: float = 10.0,
+           tblout=None, z: int = None):
+    """
+    searches proteins with every profile
+    :param profiles: (list) of profiles (see load_profiles)
+    :param proteins: (pyhmmer.easel.DigitalSequenceBlock) of proteins (see read_proteome)
+    :param cpus: (int) number of threads, 0 is all cores
+    :param evalue: (float) reporting E-value threshold
+    :param dom_evalue: (float) reporting domain E-value threshold
+    :param tblout: (file) opened in binary mode to write hmmsearch-like --tblout table into
+    :param z: (int) database size for E-values (number of proteins before prefiltering)
+    :return: (generator) of Hit
+    """
+    header = True
+    options = {} if z is None else {'Z': z}
+    for top_hits in pyhmmer.hmmer.hmmsearch(profiles, proteins, cpus=cpus, E=evalue, domE=dom_evalue, **options):
+        if tblout is not None:
+            top_hits.write(tblout, format='targets', header=header)
+            header = False
+        kegg_id = top_hits.query.name
+        for hit in top_hits.reported:
+            yield Hit(hit.name, kegg_id, f'{hit.evalue:.2g}', hit.score)
+
+
+def read_cohort(fasta_paths: list, prefilter: tuple = None, min_shared: int = MIN_SHARED) -> tuple:
+    """
+    reads proteomes and collapses identical proteins
+    :param fasta_paths: (list) of paths to proteome fasta files
+    :param prefilter: (tuple) of k-mer index, k and alphabet (see kmerfilter.load_index)
+    :param min_shared: (int) minimal number of k-mers shared with prefilter index
+    :return: (tuple) of dict of unique (shortlisted) sequences by hash,
+     list of lists of (protein id, hash), one per genome, and list of total numbers of proteins of every genome
+    """
+    unique = {}
+    genomes = []
+    totals = []
+    for fasta_path in fasta_paths:
+        proteins, total = _read_text(fasta_path, prefilter, min_shared)
+        genome = []
+        for protein in proteins:
+            seq_hash = sequence_hash(protein.sequence)
+            unique.setdefault(seq_hash, protein.sequence)
+            genome.append((protein.name, seq_hash))
+        genomes.append(genome)
+        totals.append(total)
+    return unique, genomes, totals
+
+
+def search_unique(profiles: list, sequences: dict, cpus: int = 0, pvalue: float = 10.0,
+                  dom_evalue: float = 10.0, alphabet: Alphabet = None) -> dict:
+    """
+    searches unique sequences with Z = 1, so hit E-value is its p-value
+    :param profiles: (list) of profiles (see load_profiles)
+    :param sequences: (dict) of sequences by hash (see read_cohort)
+    :param cpus: (int) number of threads, 0 is all cores
+    :param pvalue: (float) reporting p-value threshold
+    :param dom_evalue: (float) reporting domain E-value threshold, for Z = 1
+    :param alphabet: (pyhmmer.easel.Alphabet) sequence alphabet
+    :return: (dict) of lists of hits (query index, kegg id, p-value, score) by hash
+    """
+    hits = {}
+    if not sequences:
+        return hits
+    block = TextSequenceBlock(TextSequence(name=seq_hash.hex(), sequence=seq)
+                              for seq_hash, seq in sequences.items()).digitize(alphabet or Alphabet.amino())
+    for query, top_hits in enumerate(pyhmmer.hmmer.hmmsearch(profiles, block, cpus=cpus, Z=1, E=pvalue,
+                                                             domZ=1, domE=dom_evalue)):
+        kegg_id = top_hits.query.name
+        for hit in top_hits.reported:
+            hits.setdefault(bytes.fromhex(hit.name), []).append((query, kegg_id, hit.pvalue, hit.score))
+    return hits
+
+
+def search_cohort(profiles: list, sequences: dict, genomes: list, totals: list, cpus: int = 0,
+                  evalue: float = 10.0, dom_evalue: float = 10.0, store: HitStore = None, keys: list = None) -> list:
+    """
+    searches unique sequences of all genomes once and splits hits by genome. With store only profile x sequence
+    pairs missing from it are searched, profiles missing the same sequences are searched together
+    :param profiles: (list) of profiles (see load_profiles)
+    :param sequences: (dict) of unique sequences by hash (see read_cohort)
+    :param genomes: (list) of lists of (protein id, hash), one per genome (see read_cohort)
+    :param totals: (list) of numbers of proteins of every genome
+    :param cpus: (int) number of threads, 0 is all cores
+    :param evalue: (float) reporting E-value threshold
+    :param dom_evalue: (float) reporting domain E-value threshold
+    :param store: (HitStore) of already searched sequences
+    :param keys: (list) of (profile key, name) of profiles (see hitstore.profile_keys), needed with store
+    :return: (list) of lists of Hit, one per genome
+    """
+    threshold = max_pvalue(evalue, totals)
+    dom_threshold = max_pvalue(dom_evalue, totals)
+    if store is None:
+        hits = search_unique(profiles, sequences, cpus, threshold, dom_threshold, profiles[0].alphabet)
+        return demultiplex(genomes, totals, hits, evalue)
+
+    groups = {}
+    for query, missing in enumerate(store.missing(keys, list(sequences), threshold)):
+        if missing:
+            groups.setdefault(frozenset(missing), []).append(query)
+    print(f'{len(sequences)} unique of {sum(map(len, genomes))} proteins, '
+          f'{sum(len(missing) * len(queries) for missing, queries in groups.items())} of '
+          f'{len(sequences) * len(profiles)} profile x protein pairs to search', flush=True)
+
+    store_threshold = max(threshold, STORE_PVALUE)
+    for missing, queries in groups.items():
+        found = search_unique([profiles[query] for query in queries],
+                              {seq_hash: sequences[seq_hash] for seq_hash in missing},
+                              cpus, store_threshold, max(dom_threshold, STORE_PVALUE), profiles[0].alphabet)
+        store.add([keys[query] for query in queries], list(missing), found, store_threshold)
+    return demultiplex(genomes, totals, store.hits(keys, list(sequences)), evalue)
+
+
+def reduce_hits(hits, min_score: float = None, best: str = 'kegg'):
+    """
+    applies score cutoff and best hit reduction (see parsehmm)
+    :return: (generator) of Hit
+    """
+    hits = filter_hits(hits, min_score=min_score)
+    if best == 'kegg':
+        hits = best_per_kegg(hits)
+    elif best == 'protein':
+        hits = best_per_protein(hits)
+    return hits
+
+
+def _write_hits(hits, out_file: str, kegg2gene: dict, decoder: str) -> int:
+    missing_keggs = set()
+    written = write_tsv(prettify_tsv(hits, kegg2gene, missing=missing_keggs), out_file)
+    if missing_keggs:
+        print(f'KEGG ids absent from {decoder}: {", ".join(sorted(missing_keggs))}', file=sys.stderr)
+    return written
+
+
+def _split_proteome(proteome: str) -> tuple:
+    """
+    :param proteome: (str) PATH or NAME=PATH
+    :return: (tuple) of name and path
+    """
+    name, sep, path = proteome.partition('=')
+    if not sep:
+        return os.path.splitext(os.path.basename(proteome))[0], proteome
+    return name, path
+
+
+def _output_path(name: str, out_dir: str) -> str:
+    return os.path.join(out_dir, name + '.tsv')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if (len(args.proteomes) != 1 or args.cohort) and (args.output or args.tblout):
+        sys.exit('--output and --tblout need a single proteome on the command line and no --cohort')
+    if (len(args.proteomes) != 1 or args.cohort) and args.out_dir is None and not args.store:
+        sys.exit('Use --out-dir for several proteomes and --cohort (or --store to only update the store)')
+    if args.store and not args.cohort:
+        sys.exit('--store needs --cohort')
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    if args.press:
+        press_profiles(args.hmms)
+    profiles = load_profiles(args.hmms)
+    kegg2gene = read_decoder(dec_path=args.decoder)
+    prefilter = load_index(args.prefilter) if args.prefilter else None
+
+    if args.cohort:
+        proteomes = [_split_proteome(proteome) for proteome in
+                     args.proteomes or [line.strip() for line in sys.stdin if line.strip()]]
+        sequences, genomes, totals = read_cohort([path for _, path in proteomes], prefilter, args.min_shared)
+        store = HitStore(args.store) if args.store else None
+        try:
+            cohort_hits = search_cohort(profiles, sequences, genomes, totals, cpus=args.cpu, evalue=args.evalue,
+                                        dom_evalue=args.domE, store=store,
+                                        keys=profile_keys(args.hmms) if store is not None else None)
+        finally:
+            if store is not None:
+                store.close()
+        for (name, proteome), hits in zip(proteomes, cohort_hits if args.out_dir else []):
+            out_file = _output_path(name, args.out_dir)
+            written = _write_hits(reduce_hits(hits, args.score, args.best), out_file, kegg2gene, args.decoder)
+            print(f'{written} hits of {proteome} written to {out_file}', flush=True)
+        sys.exit(0)
+
+    proteomes = args.proteomes or (line.strip() for line in sys.stdin if line.strip())
+    for name, proteome in map(_split_proteome, proteomes):
+        out_file = args.output if args.output else _output_path(name, args.out_dir)
+        tblout = open(args.tblout, 'wb') if args.tblout else None
+        try:
+            proteins, total = read_proteome(proteome, profiles[0].alphabet, prefilter, args.min_shared)
+            if prefilter is not None:
+                print(f'{len(proteins)} of {total} proteins of {proteome} shortlisted', flush=True)
+            hits = search(profiles, proteins, cpus=args.cpu, evalue=args.evalue, dom_evalue=args.domE,
+                          tblout=tblout, z=total if prefilter is not None else None)
+            written = _write_hits(reduce_hits(hits, args.score, args.best), out_file, kegg2gene, args.decoder)
+        finally:
+            if tblout is not None:
+                tblout.close()
+        print(f'{written} hits of {proteome} written to {out_file}', flush=True)
@@ -0,0 +1,96 @@
+"""
+Sweep of HMM E-value threshold x minimal number of target genes per operon.
+
+Hits are read once (found at the loosest E-value of the grid) together with
+the operon GFF. Every target gene is binned by its best E-value into the
+grid, so the number of target genes of every operon at every E-value is one
+cumulative sum over a operon x E-value count table, and the operons passing
+every kegg_minimal follow by comparison. The output has one line per grid
+point, the same operons `findtargetoperon.py` selects with these settings.
+"""
+import argparse
+import numpy as np
+import pandas as pd
+from gffio import read_gff
+from parsehmm import parse_hmm
+
+
+EVALUES = [1e-50, 1e-40, 1e-30, 1e-19, 1e-10, 1e-5]
+KEGG_MINIMAL = [1, 2, 3, 4, 5, 6]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=
+                                     """Part of finding o-antigen operons.
+                                     Selects operons with genes of interest for every
+                                     E-value x kegg_minimal combination at once.
+                                     """
+                                     )
+    parser.add_argument('in_gff', help='operons gff with locus_tag and operon attributes')
+    parser.add_argument('in_hits', help='hits found at the loosest E-value of the grid: '
+                                        'parsehmm.py tsv or hmmsearch --tblout (with --tblout)')
+    parser.add_argument('out_file', help='output tsv')
+    parser.add_argument('--tblout', action='store_true', help='in_hits is hmmsearch --tblout table')
+    parser.add_argument('-E', '--evalues', nargs='+', type=float, default=EVALUES,
+                        help='E-value thresholds of the grid')
+    parser.add_argument('-k', '--kegg-minimal', nargs='+', type=int, default=KEGG_MINIMAL,
+                        help='minimal numbers of target genes in operon of the grid')
+    return parser.parse_args()
+
+
+def read_hits(hits_path: str, tblout: bool = False) -> pd.Series:
+    """
+    :param hits_path: (str) path to parsehmm.py tsv (target, kegg id, gene name, E-value) or hmmsearch --tblout
+    :param tblout: (bool) hits_path is hmmsearch --tblout table
+    :return: (pandas.Series) of best E-value of every target locus_tag
+    """
+    if tblout:
+        hits = pd.DataFrame(((hit.target, float(hit.evalue)) for hit in parse_hmm(hits_path)),
+                            columns=['locus_tag', 'evalue'])
+    else:
+        hits = pd.read_csv(hits_path, sep='\t', header=None, usecols=[0, 3], names=['locus_tag', 'evalue'],
+                           dtype={'locus_tag': 'str', 'evalue': 'float64'})
+    return hits.groupby('locus_tag', sort=False)['evalue'].min()
+
+
+def sweep(gff_df, best_evalues: pd.Series, evalues: list, kegg_minimal: list) -> pd.DataFrame:
+    """
+    selects target operons for every grid point
+    :param gff_df: (pandas.DataFrame), containing information from gff file
+    :param best_evalues: (pandas.Series) of best E-value of every target locus_tag (see read_hits)
+    :param evalues: (list) of E-value thresholds
+    :param kegg_minimal: (list) of minimal numbers of target genes in operon
+    :return: (pandas.DataFrame) with evalue, kegg_minimal, operons (number), genes (number) and operon_ids
+    """
+    evalues = np.sort(np.asarray(evalues, dtype=float))
+    kegg_minimal = np.sort(np.asarray(kegg_minimal, dtype=int))
+
+    genes = gff_df[['locus_tag', 'operon']].dropna(subset=['operon'])
+    operon_ids, operon = np.unique(genes['operon'].to_numpy(dtype=str), return_inverse=True)
+    operon_size = np.bincount(operon, minlength=len(operon_ids))
+
+    # first grid E-value every target gene passes, len(evalues) if none
+    gene_evalue = genes['locus_tag'].map(best_evalues).to_numpy(dtype=float)
+    is_target = ~np.isnan(gene_evalue)
+    first_bin = np.searchsorted(evalues, gene_evalue[is_target], side='left')
+    passing = first_bin < len(evalues)
+    counts = np.zeros((len(operon_ids), len(evalues)), dtype=np.int64)
+    np.add.at(counts, (operon[is_target][passing], first_bin[passing]), 1)
+    counts = np.cumsum(counts, axis=1)
+
+    rows = []
+    for j, evalue in enumerate(evalues):
+        for thres in kegg_minimal:
+            selected = np.flatnonzero(counts[:, j] >= thres)
+            rows.append((f'{evalue:.2g}', thres, len(selected), int(operon_size[selected].sum()),
+                         ','.join(operon_ids[selected])))
+    return pd.DataFrame(rows, columns=['evalue', 'kegg_minimal', 'operons', 'genes', 'operon_ids'])
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    gff = read_gff(gff_path=args.in_gff, columns=[], attributes=['locus_tag', 'operon'])
+    best = read_hits(hits_path=args.in_hits, tblout=args.tblout)
+    table = sweep(gff_df=gff, best_evalues=best, evalues=args.evalues, kegg_minimal=args.kegg_minimal)
+    table.to_csv(args.out_file, sep='\t', index=False)
@@ -1,232 +1,241 @@
-from findtargetoperon import read_gff, write_gff
-from Bio import SeqIO
-from Bio.SeqRecord import SeqRecord
-from Bio.Seq import Seq
+from gffio import read_gff, write_gff
+from liftover import offset_table, lift_annotation, insertion_features, fill_operons, write_chain
+from restore import RESTORE_COLUMNS, RestoreWriter, RestoreReader, read_restore, is_restore_file, write_csv
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-import math
-
-
-def remove_transposaes(seq_record: SeqRecord, insertions: pd.DataFrame):
-    seq = seq_record.seq
-
+import hashlib
+import sys
+import os
+
+
+CHUNK_SIZE = 1 << 20
+FASTA_WIDTH = 60
+
+
+def remove_transposaes(seq: str, insertions: pd.DataFrame, seq_id: str = ''):
+    """
+    walks over sorted insertions of one sequence without copying clean parts.
+    Overlapping insertions are merged: an insertion starting inside the previous cut is cut from its end,
+    an insertion lying entirely within the previous cut is skipped (it is removed with it and has no deletion
+    of its own). Both cases are reported on stderr
+    :param seq: (str) sequence
+    :param insertions: (pandas.DataFrame) insertion_sequence features of this sequence
+    :param seq_id: (str) sequence id used in messages
+    :return: (tuple) of clean spans [(from, to)] and deletions
+     [(new index, removed string, delta_at_current_pos, score, strand)]
+    """
     pos = 0
     delta = 0
 
-    deletions = []  # new index, removed string, delta_at_current_pos
-    cleaned = []
-
-    for _, insertion in insertions.iterrows():
-        start = insertion["start"]
-        end = insertion["end"]
+    deletions = []
+    spans = []
 
+    for start, end, score, strand in zip(insertions['start'], insertions['end'],
+                                         insertions['score'], insertions['strand']):
+        if end <= pos:
+            print(f'{seq_id}: insertion_sequence {start}-{end} lies within the previous cut ending at {pos}, '
+                  f'skipped', file=sys.stderr)
+            continue
         if start < pos:
+            print(f'{seq_id}: insertion_sequence {start}-{end} overlaps the previous cut ending at {pos}, '
+                  f'cut from {pos}', file=sys.stderr)
             start = pos
 
-        clean = seq[pos:start]
-
-        cleaned.append(clean)
+        spans.append((pos, start))
         transposone_seq = seq[start:end]
         assert len(transposone_seq) == end - start
-        new_delta = delta + len(transposone_seq)
 
-        deletions.append((
-            start - delta, 
-            transposone_seq, 
-            delta,
-            insertion['score'],
-            insertion['strand']
-        ))
+        deletions.append((start - delta, transposone_seq, delta, score, strand))
 
-        delta = new_delta
+        delta += len(transposone_seq)
         pos = end
 
-    cleaned.append(seq[pos : len(seq)])
+    spans.append((pos, len(seq)))
+
+    return spans, deletions
+
+
+class RebuildChecksum:
+    """
+    Rolling checksum of the sequence `rebuild` would produce from the
+    clean sequence fed chunk by chunk and the deletions
+    """
+
+    def __init__(self, deletions):
+        self.digest = hashlib.md5()
+        self.pending = iter(deletions)
+        self.next = next(self.pending, None)
+        self.pos = 0
+
+    def _insert_due(self):
+        while self.next is not None and self.next[0] == self.pos:
+            self.digest.update(self.next[1].encode())
+            self.next = next(self.pending, None)
+
+    def update(self, chunk: str):
+        while chunk:
+            self._insert_due()
+            size = len(chunk) if self.next is None else min(len(chunk), self.next[0] - self.pos)
+            self.digest.update(chunk[:size].encode())
+            self.pos += size
+            chunk = chunk[size:]
+
+    def hexdigest(self) -> str:
+        self._insert_due()
+        assert self.next is None, 'insertion index is out of clean sequence'
+        return self.digest.hexdigest()
+
+
+def sequence_checksum(seq: str, chunk_size: int = CHUNK_SIZE) -> str:
+    digest = hashlib.md5()
+    for i in range(0, len(seq), chunk_size):
+        digest.update(seq[i:i + chunk_size].encode())
+    return digest.hexdigest()
+
+
+def write_clean_record(out, title: str, seq: str, spans: list, checksum: RebuildChecksum,
+                       chunk_size: int = CHUNK_SIZE, width: int = FASTA_WIDTH) -> int:
+    """
+    writes clean parts of one sequence into opened fasta file in fixed-size chunks
+    :return: (int) length of written sequence
+    """
+    print(f'>{title}', file=out)
+    carry = ''
+    written = 0
+    for frm, to in spans:
+        for i in range(frm, to, chunk_size):
+            chunk = seq[i:min(i + chunk_size, to)]
+            checksum.update(chunk)
+            written += len(chunk)
+
+            chunk = carry + chunk
+            tail = len(chunk) - len(chunk) % width
+            out.write(''.join(chunk[j:j + width] + '\n' for j in range(0, tail, width)))
+            carry = chunk[tail:]
+    if carry:
+        out.write(carry + '\n')
+    return written
 
-    clean_seq = Seq("".join(str(s) for s in cleaned))
 
-    sr = seq
-    sc = clean_seq
+def _splice(args):
+    annotation = read_gff(args.gff, columns=['seq_id', 'type', 'start', 'end', 'score', 'strand'])
+    annotation = annotation[annotation["type"] == "insertion_sequence"]
+    annotation = annotation.sort_values(by="start", kind="stable")
+    by_seq = {seq_id: group for seq_id, group in annotation.groupby('seq_id', observed=True, sort=False)}
+    no_insertions = annotation.iloc[:0]
 
-    assert len(sr) - len(sc) - delta == 0
+    restore_file = f"{args.output}.restore"
+    print(f"{args.output}")
+    with open(args.fasta) as fasta, open(args.output, "w") as out, \
+            RestoreWriter(restore_file, compress=args.compress) as restore:
+        for title, seq in SimpleFastaParser(fasta):
+            seq_id, *description = title.split(None, 1)
+            spans, ds = remove_transposaes(seq, by_seq.get(seq_id, no_insertions), seq_id)
 
-    return clean_seq, deletions
+            # Just checking if we'll be able to rebuild sequence later
+            checksum = RebuildChecksum(ds)
+            # the title stays apart from the id, so the id matches the restore file
+            clean_title = f"{title}, transposon free" if description else f"{seq_id} transposon free"
+            written = write_clean_record(out, clean_title, seq, spans, checksum,
+                                         chunk_size=args.chunk_size)
+            assert len(seq) - written - sum(len(d[1]) for d in ds) == 0
+            original_checksum = sequence_checksum(seq, args.chunk_size)
+            assert checksum.hexdigest() == original_checksum
 
+            restore.add(seq_id, ds, written, original_checksum)
+            if args.csv:
+                file = f"{args.output}_{seq_id}.rebuild.csv"
+                write_csv(pd.DataFrame(ds, columns=RESTORE_COLUMNS), file)
+                print(file)
+    print(restore_file)
 
-def _splice(args):
-    secs = list(SeqIO.parse(args.fasta, "fasta"))
-    annotation = read_gff(args.gff)
-    annotation = annotation.sort_values(by="start")
-    insertions = annotation["type"] == "insertion_sequence"
-    annotation = annotation[insertions]
 
-    annotation = annotation.reset_index(drop=True)
+def reindex_annotation(seq_id: str, buildfile: pd.DataFrame, annotation: pd.DataFrame):
+    lengths = buildfile['insertion'].str.len()
+    positions, shifts = offset_table(buildfile['insert_index'], lengths)
 
-    sequences = []
-    dels = []
+    annotation = lift_annotation(annotation, positions, shifts)
+    inserts = insertion_features(seq_id, buildfile['insert_index'], lengths,
+                                 buildfile['score'], buildfile['strand'])
 
-    for seq_record in secs:
-        this_seq = annotation["seq_id"] == seq_record.id
-        cs, ds = remove_transposaes(seq_record, annotation[this_seq])
+    annotation = pd.concat([annotation, inserts], ignore_index=True)
+    annotation = annotation.sort_values(by='start', kind='stable', ignore_index=True)
+    return fill_operons(annotation)
 
-        s = seq_record[:1]
-        s.seq = cs
-        s.description = s.description + ", transposon free"
 
-        sequences.append(s)
-        dels.append(ds)
+def _rebuild_contig(job):
+    """
+    checks that one contig is rebuilt into the original one and lifts its annotation
+    """
+    seq_id, seq, buildfile, annotation, expected = job
 
-        # Just checking if we'll be able to rebuild sequence later
-        reb = rebuild(cs, ds)
-        assert len(seq_record.seq) == len(reb)
-        assert seq_record.seq == reb
+    checksum = RebuildChecksum(buildfile[['insert_index', 'insertion']].itertuples(index=False))
+    for i in range(0, len(seq), CHUNK_SIZE):
+        checksum.update(seq[i:i + CHUNK_SIZE])
+    digest = checksum.hexdigest()
+    for original in expected:
+        assert digest == original, f'{seq_id}: rebuilt sequence does not match original one'
 
-    SeqIO.write(sequences, args.output, format="fasta")
-    print(f"{args.output}")
-    for sequence, ds in zip(sequences, dels):
-        file = f"{args.output}_{sequence.id}.rebuild.csv"
-        with open(file, "w") as out:
-            for idx, seq, delta, score, strand in ds:
-                print(f"{idx},{seq},{delta},{score},{strand}", file=out)
-        print(file)
+    return reindex_annotation(seq_id, buildfile, annotation)
 
 
-def rebuild(seq: Seq, deletions):
-    out = []
-    pos = 0
-    for insert_idx, insertion, *_ in deletions:
-        prev = seq[pos:insert_idx]
-        out.append(prev)
-        out.append(insertion)
-        pos = insert_idx
-
-    out.append(seq[pos : len(seq)])
-
-    return Seq("".join(str(s) for s in out))
-
-
-def _remap_genes(frm, to, delta, annotation):
-    
-    start_filter = (annotation['start'] >= frm) & (annotation['start'] < to)
-    annotation.loc[start_filter, 'nstart'] = annotation.loc[start_filter, 'start'] + delta
-    
-    end_filter = (annotation['end'] >= frm) & (annotation['end'] < to)
-    annotation.loc[end_filter, 'nend'] = annotation.loc[end_filter, 'end'] + delta
-
-    return annotation
-    
-
-def mktrns(id, start, end, score, strand, attribs):
-    return {
-        'seq_id': id,
-        'source': 'transposon_cutter',
-        'type': 'insertion_sequence',
-        'nstart': start,
-        'nend': end,
-        'score': score,
-        'strand': strand,
-        'phase': 0,
-        'attributes': attribs,
-        'gene_name': f'TRANSP_{str(start).zfill(5)}'
-    }
-    
-
-def _encode(d: dict):
-    res = []
-    for x, y in d.items():
-        res.append(f'{x}={y}')
-    return ';'.join(res)
-
-
-def fill_operons(annotation: pd.DataFrame):
-    operon = float('nan')
-
-    indexes = []
-    buffer = []
-    
-    for i, row in annotation.iterrows():
-        op = float(annotation.at[i, 'operon'])
-        
-        if row['type'] == 'insertion_sequence':
-            annotation.at[i, 'attributes'] = 'function=transposasa'
-        
-        if not math.isnan(op):
-            if buffer:
-                if op == operon:
-                    indexes.extend(buffer)
-                buffer = []
-
-            operon = op
-        else:
-            if row['type'] == 'insertion_sequence':
-                buffer.append((i, operon))
-      
-    for idx, operon in indexes:
-        annotation.at[idx, 'attributes'] += ';' + _encode({'operon': int(operon)}) 
-        
-    return annotation         
-        
-
-def reindex_annotation(rec: SeqRecord, buildfile: pd.DataFrame, annotation: pd.DataFrame):
-    seq = rec.seq
-    out = []
-    pos = 0
-    inserts = []
-
-    for _, (insert_idx, insertion, delta, score, strand) in buildfile.iterrows():
-        prev = seq[pos:insert_idx]
-        out.append(prev)
-        out.append(insertion)
-        
-        _remap_genes(pos, insert_idx, delta, annotation)
-        basis = insert_idx + delta
-
-        inserts.append(
-            mktrns(
-                rec.id, 
-                basis, 
-                basis + len(insertion), 
-                score,
-                strand or '+',
-                ""
-            )
-        )
-        
-        pos = insert_idx
-        delta += len(insertion)
-
-    _remap_genes(pos, len(seq), delta, annotation)
-    out.append(seq[pos : len(seq)])
-    
-    for _, row_data in enumerate(inserts):
-        annotation.loc[len(annotation)] = row_data
-
-    annotation['start'] = annotation['nstart']
-    annotation['end'] = annotation['nend']
-    
-    annotation = annotation.sort_values(by='start')
-    annotation.reset_index()
-    
-    annotation = fill_operons(annotation)
-
-    return Seq("".join(str(s) for s in out)), annotation
+def _read_checksums(fasta_path: str) -> dict:
+    with open(fasta_path) as fasta:
+        return {title.split(None, 1)[0]: sequence_checksum(seq) for title, seq in SimpleFastaParser(fasta)}
 
 
 def _rebuild(args):
-    buildfile = pd.read_csv(args.restore, 
-                            names=['insert_index', 'insertion', 'delta', 'score', 'strand'])
-    sequence = list(SeqIO.parse(args.fasta, 'fasta'))
-    assert len(sequence) == 1
-    sequence = sequence[0]
-    
-    operons = read_gff(args.gff)
-    
-    sq, reindexed = reindex_annotation(sequence, buildfile, operons)
-    
-    orig = list(SeqIO.parse(args.validation, 'fasta'))[0].seq
-    assert sq == orig
+    with open(args.fasta) as fasta:
+        sequences = [(title.split(None, 1)[0], seq) for title, seq in SimpleFastaParser(fasta)]
+    validation = _read_checksums(args.validation) if args.validation else {}
+
+    operons = read_gff(args.gff, attributes=['operon'])
+    by_seq = {seq_id: group for seq_id, group in operons.groupby('seq_id', observed=True, sort=False)}
+    unknown = set(by_seq) - {seq_id for seq_id, _ in sequences}
+    if unknown:
+        print(f'Features on sequences absent from {args.fasta} are kept unchanged: {", ".join(sorted(unknown))}',
+              file=sys.stderr)
+
+    buildfiles, expected = {}, {seq_id: [checksum] for seq_id, checksum in validation.items()}
+    if is_restore_file(args.restore):
+        with RestoreReader(args.restore) as reader:
+            for seq_id, _ in sequences:
+                if seq_id in reader.index:
+                    buildfiles[seq_id] = reader.read(seq_id)
+                    expected.setdefault(seq_id, []).append(reader.checksum(seq_id))
+    elif len(sequences) == 1:
+        buildfiles[sequences[0][0]] = read_restore(args.restore, sequences[0][0])
+    else:
+        sys.exit('Restore csv holds a single sequence, use restore file for multi-sequence genomes')
+
+    no_insertions = pd.DataFrame(columns=RESTORE_COLUMNS)
+    jobs = [(seq_id, seq, buildfiles.get(seq_id, no_insertions),
+             by_seq.get(seq_id, operons.iloc[:0]), expected.get(seq_id, []))
+            for seq_id, seq in sequences]
+
+    with ProcessPoolExecutor(max_workers=args.threads) as pool:
+        reindexed = list(pool.map(_rebuild_contig, jobs))
     print('Rebuild successful!')
-    
-    write_gff(reindexed, args.output)
+
+    reindexed += [by_seq[seq_id] for seq_id in sorted(unknown)]
+    reindexed = pd.concat(reindexed, ignore_index=True)
+    write_gff(reindexed.sort_values(['seq_id', 'start'], kind='stable', ignore_index=True), args.output)
+
+    if args.chain:
+        with open(args.chain, 'w') as chain:
+            for chain_id, (seq_id, seq, buildfile, *_) in enumerate(jobs, start=1):
+                write_chain(chain, seq_id, len(seq), buildfile['insert_index'],
+                            buildfile['insertion'].str.len(), chain_id=chain_id)
+        print(args.chain)
+
+
+def _export(args):
+    with RestoreReader(args.restore) as reader:
+        for seq_id in reader.seq_ids:
+            file = f"{args.output}_{seq_id}.rebuild.csv"
+            write_csv(reader.read(seq_id), file)
+            print(file)
 
 
 def main():
@@ -239,18 +248,37 @@ def main():
     splice.add_argument("fasta", help="complete genome")
     splice.add_argument("gff", help="transposon annotation (with insertion_sequence)")
     splice.add_argument(
-        "-o", "--output", help="out transposone-free .fna + .fna.restore.csv"
+        "-o", "--output", help="out transposone-free .fna + .fna.restore"
+    )
+    splice.add_argument(
+        "--compress", action="store_true", help="compress restore file"
+    )
+    splice.add_argument(
+        "--csv", action="store_true", help="also export restore data as <output>_<seq_id>.rebuild.csv"
+    )
+    splice.add_argument(
+        "--chunk-size", type=int, default=CHUNK_SIZE, help="sequence chunk size used for writing and checksums"
     )
     splice.set_defaults(func=_splice)
 
     rebuild = subs.add_parser("rebuild")
     rebuild.add_argument("fasta", help="transposone-free genome")
-    rebuild.add_argument("restore", help="restore file (was generated by `splice`)")
+    rebuild.add_argument("restore", help="restore file or restore csv (was generated by `cut`)")
     rebuild.add_argument("--gff", required=True, help="annotation to be changed")
-    rebuild.add_argument("--validation", required=True, help="original fasta to validate")
+    rebuild.add_argument("--validation", default=None,
+                         help="original fasta to validate (restore file checksums are always checked)")
     rebuild.add_argument("-o", "--output", help="new annotation and rebuilt genome")
+    rebuild.add_argument("-t", "--threads", type=int, default=os.cpu_count(),
+                         help="number of processes used to rebuild contigs")
+    rebuild.add_argument("--chain", default=None,
+                         help="also write chain file lifting transposon-free coordinates to original ones")
     rebuild.set_defaults(func=_rebuild)
 
+    export = subs.add_parser("export")
+    export.add_argument("restore", help="restore file (was generated by `cut`)")
+    export.add_argument("-o", "--output", required=True, help="prefix of <output>_<seq_id>.rebuild.csv files")
+    export.set_defaults(func=_export)
+
     args = parser.parse_args()
 
     return args.func(args)